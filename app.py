@@ -1,60 +1,263 @@
 import os
 from dotenv import load_dotenv
-import time
+import time as time_module
 import requests
 import threading
-from bs4 import BeautifulSoup
-from functools import wraps
-from concurrent.futures import ThreadPoolExecutor, as_completed
-
-from flask import Flask, request, jsonify, g, render_template, redirect, url_for
+import re
+import codecs
+from html.parser import HTMLParser
+from functools import wraps, partial
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+from requests.adapters import HTTPAdapter
+
+from flask import Flask, Response, request, jsonify, g, render_template, redirect, url_for
+import click
 from flask_cors import CORS
 import google.generativeai as genai
 
 import firebase_admin
 from firebase_admin import credentials, firestore, auth
 
+import job_queue
+import fetch_cache
+import host_scheduler
+import gemini_client
+import metrics
+import keyword_filter
+import history_upload
+import batch_writer
+import recommender
+import candidate_scheduler
+
 import uuid
-import google.generativeai as genai
+import json
 
 import random
+import hashlib
+from collections import OrderedDict
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 
-from datetime import datetime, time, timezone
+from datetime import datetime, time, timezone, timedelta
 
 load_dotenv()
 
-try:
-    # firebaseへの接続
-    cred_path = os.environ.get('FIREBASE_ADMINSDK_JSON_PATH')
-    cred = credentials.Certificate(cred_path)
-    firebase_admin.initialize_app(cred)
-    db = firestore.client()
-    print("✅ Firebaseとの接続に成功しました。")
-except Exception as e:
-    print(f"❌ Firebaseの初期化中にエラーが発生しました: {e}")
-    db = None
-
 app = Flask(__name__)
 CORS(app)
 
-try:
-    # Gemini APIの使用
-    API_KEY = os.environ.get('GEMINI_API_KEY')
-    if not API_KEY or "YOUR_GEMINI_API_KEY" in API_KEY:
-        print("⚠️ 警告: Gemini APIキーが.envファイルに設定されていません。")
-    genai.configure(api_key=API_KEY)
-    model_name = 'gemini-2.5-flash-lite'
+# プロセス内で使うSQLite（ジョブキュー・取得キャッシュ・Geminiのレート制限・計測値・ドメインの評判）の初期化
+# import しただけではファイルを作らず、最初のリクエスト（またはワーカーの起動）時に1度だけ行う。
+_local_stores_lock = threading.Lock()
+_local_stores_ready = False
+
+def init_local_stores():
+    global _local_stores_ready
+    if _local_stores_ready:
+        return
+    with _local_stores_lock:
+        if not _local_stores_ready:
+            job_queue.init_queue()
+            fetch_cache.init_cache()
+            gemini_client.init_limiter()
+            metrics.init_metrics()
+            candidate_scheduler.init_reputation()
+            _local_stores_ready = True
+
+# 外部サービス（Firebase・Gemini）の遅延初期化
+# 起動時には接続せず、最初に使う時点（または起動後のバックグラウンドの準備処理）で初期化する。
+# 初期化に失敗した場合は INIT_RETRY_SECONDS 秒経つまで再試行しない。
+INIT_RETRY_SECONDS = int(os.environ.get('INIT_RETRY_SECONDS', 30))
+WARM_UP_ON_START = os.environ.get('WARM_UP_ON_START', '1') == '1'
+# 使用するGeminiモデル名。指定した場合はモデル一覧の取得（list_models）を行わない
+GEMINI_MODEL_NAME = os.environ.get('GEMINI_MODEL_NAME')
+DEFAULT_GEMINI_MODEL = 'gemini-2.5-flash-lite'
+# list_models で決めたモデル名を保存しておくファイルと、その有効期間
+GEMINI_MODEL_CACHE_PATH = os.environ.get('GEMINI_MODEL_CACHE_PATH', 'gemini_model.json')
+GEMINI_MODEL_CACHE_TTL_SECONDS = int(os.environ.get('GEMINI_MODEL_CACHE_TTL_SECONDS', 24 * 60 * 60))
+
+_init_lock = threading.Lock()
+_db = None
+_llm = None
+_init_state = {
+    'firebase': {'status': 'pending', 'lastAttempt': None},
+    'gemini': {'status': 'pending', 'lastAttempt': None, 'model': None}
+}
+
+def _should_try_init(name):
+    last_attempt = _init_state[name]['lastAttempt']
+    return last_attempt is None or time_module.monotonic() - last_attempt >= INIT_RETRY_SECONDS
+
+def get_db():
+    """
+    Firestoreクライアントを返す。最初の呼び出し時にFirebaseを初期化し、初期化できなければ None を返す。
+    """
+    global _db
+    if _db is not None:
+        return _db
+    with _init_lock:
+        if _db is None and _should_try_init('firebase'):
+            _init_state['firebase']['lastAttempt'] = time_module.monotonic()
+            try:
+                # firebaseへの接続
+                try:
+                    firebase_admin.get_app()
+                except ValueError:
+                    cred_path = os.environ.get('FIREBASE_ADMINSDK_JSON_PATH')
+                    cred = credentials.Certificate(cred_path)
+                    firebase_admin.initialize_app(cred)
+                _db = firestore.client()
+                _init_state['firebase']['status'] = 'ready'
+                print("✅ Firebaseとの接続に成功しました。")
+            except Exception as e:
+                _init_state['firebase']['status'] = 'error'
+                print(f"❌ Firebaseの初期化中にエラーが発生しました: {e}")
+    return _db
+
+def _load_cached_model_name():
+    try:
+        with open(GEMINI_MODEL_CACHE_PATH, encoding='utf-8') as f:
+            cached = json.load(f)
+        if time_module.time() - cached.get('resolvedAt', 0) < GEMINI_MODEL_CACHE_TTL_SECONDS:
+            return cached.get('modelName')
+    except (OSError, ValueError):
+        pass
+    return None
+
+def _save_cached_model_name(model_name):
+    try:
+        tmp_path = f"{GEMINI_MODEL_CACHE_PATH}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'modelName': model_name, 'resolvedAt': time_module.time()}, f)
+        os.replace(tmp_path, GEMINI_MODEL_CACHE_PATH)
+    except OSError as e:
+        print(f"モデル名の保存中にエラー: {e}")
+
+def resolve_model_name():
+    """
+    使用するGeminiモデル名を決める。
+    GEMINI_MODEL_NAME の指定 → 保存済みのモデル名 → list_models の順に使い、list_models の結果は保存する。
+    """
+    if GEMINI_MODEL_NAME:
+        return GEMINI_MODEL_NAME
+    model_name = _load_cached_model_name()
+    if model_name:
+        return model_name
+    model_name = DEFAULT_GEMINI_MODEL
     for m in genai.list_models():
         if 'generateContent' in m.supported_generation_methods:
             if 'flash' in m.name:
                 model_name = m.name
                 break
-    
-    model = genai.GenerativeModel(model_name)
-    print(f"✅ Geminiモデル ({model_name}) の準備ができました。")
-except Exception as e:
-    print(f"❌ APIキーの設定中にエラーが発生しました: {e}")
-    model = None
+    _save_cached_model_name(model_name)
+    return model_name
+
+def get_llm():
+    """
+    Gemini呼び出し用のクライアントを返す。最初の呼び出し時にモデルを準備し、準備できなければ None を返す。
+    Geminiの呼び出しは全てレート制限・再試行付きのクライアント（gemini_client）を通す。
+    """
+    global _llm
+    if _llm is not None:
+        return _llm
+    with _init_lock:
+        if _llm is None and _should_try_init('gemini'):
+            _init_state['gemini']['lastAttempt'] = time_module.monotonic()
+            try:
+                # Gemini APIの使用
+                api_key = os.environ.get('GEMINI_API_KEY')
+                if not api_key or "YOUR_GEMINI_API_KEY" in api_key:
+                    print("⚠️ 警告: Gemini APIキーが.envファイルに設定されていません。")
+                genai.configure(api_key=api_key)
+                model_name = resolve_model_name()
+                _llm = gemini_client.GeminiClient(genai.GenerativeModel(model_name))
+                _init_state['gemini'].update(status='ready', model=model_name)
+                print(f"✅ Geminiモデル ({model_name}) の準備ができました。")
+            except Exception as e:
+                _init_state['gemini']['status'] = 'error'
+                print(f"❌ APIキーの設定中にエラーが発生しました: {e}")
+    return _llm
+
+def warm_up_dependencies():
+    get_db()
+    get_llm()
+
+_warm_up_started = False
+
+def start_warm_up():
+    """
+    Firebase・Geminiの準備をバックグラウンドで1度だけ始める（WARM_UP_ON_START が有効な場合）。
+    """
+    global _warm_up_started
+    if not WARM_UP_ON_START or _warm_up_started:
+        return
+    with _init_lock:
+        if _warm_up_started:
+            return
+        _warm_up_started = True
+    threading.Thread(target=warm_up_dependencies, daemon=True).start()
+
+@app.before_request
+def prepare_process():
+    # 最初のリクエスト（起動直後のヘルスチェックを含む）で、ローカルのSQLiteの作成と外部サービスの準備を始める
+    init_local_stores()
+    start_warm_up()
+
+# 認証結果のキャッシュ
+# 検証済みのIDトークンはトークンの有効期限（exp）まで、ユーザー情報は一定時間プロセス内に保持し、
+# ページ遷移のたびにFirebase Authへ問い合わせないようにする。
+TOKEN_CACHE_MAX_ENTRIES = int(os.environ.get('TOKEN_CACHE_MAX_ENTRIES', 1024))
+USER_CACHE_MAX_ENTRIES = int(os.environ.get('USER_CACHE_MAX_ENTRIES', 1024))
+USER_CACHE_TTL_SECONDS = int(os.environ.get('USER_CACHE_TTL_SECONDS', 300))
+
+_token_cache = OrderedDict()
+_user_cache = OrderedDict()
+_auth_cache_lock = threading.Lock()
+auth_cache_stats = {'token_hits': 0, 'token_misses': 0, 'user_hits': 0, 'user_misses': 0}
+
+def _cache_get(cache, key, stat_prefix):
+    with _auth_cache_lock:
+        entry = cache.get(key)
+        if entry and entry[0] > time_module.time():
+            cache.move_to_end(key)
+            auth_cache_stats[f'{stat_prefix}_hits'] += 1
+            return entry[1]
+        if entry:
+            del cache[key]
+        auth_cache_stats[f'{stat_prefix}_misses'] += 1
+        return None
+
+def _cache_put(cache, key, expires_at, value, max_entries):
+    with _auth_cache_lock:
+        cache[key] = (expires_at, value)
+        cache.move_to_end(key)
+        while len(cache) > max_entries:
+            cache.popitem(last=False)
+
+def verify_id_token_cached(id_token):
+    """
+    auth.verify_id_token の結果を、トークンの有効期限までキャッシュして返す。
+    """
+    key = hashlib.sha256(id_token.encode('utf-8')).hexdigest()
+    decoded_token = _cache_get(_token_cache, key, 'token')
+    if decoded_token:
+        return decoded_token
+    get_db()
+    decoded_token = auth.verify_id_token(id_token)
+    _cache_put(_token_cache, key, decoded_token.get('exp', 0), decoded_token, TOKEN_CACHE_MAX_ENTRIES)
+    return decoded_token
+
+def get_user_cached(uid):
+    """
+    auth.get_user の結果を USER_CACHE_TTL_SECONDS 秒キャッシュして返す。
+    """
+    user = _cache_get(_user_cache, uid, 'user')
+    if user:
+        return user
+    get_db()
+    user = auth.get_user(uid)
+    _cache_put(_user_cache, uid, time_module.time() + USER_CACHE_TTL_SECONDS, user, USER_CACHE_MAX_ENTRIES)
+    return user
 
 # web用のログインしていないユーザーを弾く
 def login_required_for_web(f):
@@ -64,9 +267,9 @@ def login_required_for_web(f):
         if not id_token:
             return redirect(url_for('login_page'))
         try:
-            decoded_token = auth.verify_id_token(id_token)
+            decoded_token = verify_id_token_cached(id_token)
             g.user_id = decoded_token['uid']
-            g.user = auth.get_user(decoded_token['uid'])
+            g.user = get_user_cached(decoded_token['uid'])
         except Exception as e:
             print(f"Web token verification failed: {e}")
             return redirect(url_for('login_page'))
@@ -82,7 +285,7 @@ def login_required_for_api(f):
             return jsonify({"error": "Authorization header is missing or invalid"}), 401
         id_token = auth_header.split('Bearer ')[1]
         try:
-            decoded_token = auth.verify_id_token(id_token)
+            decoded_token = verify_id_token_cached(id_token)
             g.user_id = decoded_token['uid']
         except Exception as e:
             print(f"API token verification failed: {e}")
@@ -90,67 +293,248 @@ def login_required_for_api(f):
         return f(*args, **kwargs)
     return decorated_function
 
-# 第一のキーワードによるフィルタリング
-def is_it_tech(title, url):
-    keywords = [
-        '技術', 'IT', 'プログラミング', 'エンジニア', '開発', 'API', 'AI', '人工知能', 'Python', 'JavaScript', 
-        'プログラム', 'システム', 'ソフトウェア', 'ハードウェア', 'クラウド', 'サーバ', 'データ', 'ネットワーク', 'セキュリティ', 'Web技術', 
-        'IT技術', 'Google', 'Chrome', 'Takeout', 'GitHub', 'コード','API', 'AI', 'ML', '機械学習', 
-        'Deep Learning', 'チュートリアル', '基礎', 'HTML', 'CSS', 'React', 'フロントエンド', 'バックエンド'
-    ]
-    title = title or ""
-    url = url or ""
-    for keyword in keywords:
-        if keyword.lower() in title.lower() or keyword.lower() in url.lower():
-            return True
-    return False
-
-# フィルタリングの際に除外したいキーワード
-def is_info_page(title, url):
-    exclude_keywords = [
-        'ホーム', 'トップ', 'home', 'drive', 'mail', 'inbox', 'login', 'signin', 'sign in', '検索結果',
-        'Google cloud', 'Google 検索', 'google_vignette',
-        'twitter.com', 'x.com', 'facebook.com', 'youtube.com', 'youtu.be', 'instagram.com',
-        'amazon.co.jp', 'amazon.com', 'rakuten.co.jp', 'finance.yahoo.co.jp',
-        'ツイッター', 'フェイスブック', 'ユーチューブ', 'アマゾン', '楽天', 'ヤフーファイナンス'
-    ]
-    title = title or ""
-    url = url or ""
-    for kw in exclude_keywords:
-        if kw.lower() in title.lower() or kw.lower() in url.lower():
-            return False
-    if '.google.com' in url and not 'developers.google.com' in url and not 'cloud.google.com/blog' in url:
-        return False
-    return True
-
 # スクレイピング処理
-def scrape_content(url):
+# 全ての取得で接続を使い回すための共有セッション
+FETCH_CONCURRENCY = int(os.environ.get('FETCH_CONCURRENCY', 16))
+FETCH_PER_HOST_LIMIT = int(os.environ.get('FETCH_PER_HOST_LIMIT', 2))
+SCRAPE_HEADERS = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'}
+
+http_session = requests.Session()
+http_session.headers.update(SCRAPE_HEADERS)
+_http_adapter = HTTPAdapter(pool_connections=FETCH_CONCURRENCY, pool_maxsize=FETCH_CONCURRENCY)
+http_session.mount('http://', _http_adapter)
+http_session.mount('https://', _http_adapter)
+
+# 取得する本文の上限（バイト）と、抜き出す本文テキストの文字数
+SCRAPE_MAX_BYTES = int(os.environ.get('SCRAPE_MAX_BYTES', 1024 * 1024))
+SCRAPE_TEXT_LIMIT = 2000
+SCRAPE_CHUNK_SIZE = 16 * 1024
+# 文字コードを決めるために、復号を始める前に読んでおく先頭のバイト数
+META_SNIFF_BYTES = 4096
+HTML_CONTENT_TYPES = ('text/html', 'application/xhtml+xml')
+SKIP_EXTENSIONS = (
+    '.pdf', '.zip', '.gz', '.tar', '.dmg', '.exe', '.msi', '.apk',
+    '.png', '.jpg', '.jpeg', '.gif', '.webp', '.svg', '.mp4', '.mp3', '.mov'
+)
+SKIP_TAGS = {'script', 'style', 'nav', 'header', 'footer', 'aside', 'form'}
+# 終了タグを持たない要素（開いている要素の記録に積まない）
+VOID_TAGS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'param', 'source', 'track', 'wbr'}
+META_CHARSET_PATTERN = re.compile(rb'<meta[^>]+charset=["\']?([\w-]+)', re.IGNORECASE)
+
+def _html_decoder(content_type, head):
+    """
+    Content-Type（指定がなければ先頭のmetaタグ）の文字コードで、本文を少しずつ復号するデコーダを返す。
+    """
+    encoding = None
+    if 'charset=' in content_type:
+        encoding = content_type.split('charset=', 1)[1].split(';')[0].strip().strip('"\'')
+    if not encoding:
+        match = META_CHARSET_PATTERN.search(head[:META_SNIFF_BYTES])
+        if match:
+            encoding = match.group(1).decode('ascii', 'ignore')
+    try:
+        return codecs.getincrementaldecoder(encoding or 'utf-8')(errors='replace')
+    except LookupError:
+        return codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+def _retry_after_seconds(response):
+    value = response.headers.get('Retry-After', '')
+    return min(float(value), 300) if value.isdigit() else None
+
+def _cached_scrape_result(cached):
+    return {'text': cached['text'], 'ogp': cached['ogp']} if cached and cached['text'] is not None else None
+
+def lookup_fetch(url):
+    """
+    HTTPリクエストを送らずにページの取得結果が決まるかどうかを調べる。
+    決まる場合（HTML以外・キャッシュが新しい・失敗後の待機中・ホストへの取得を停止中）は (True, 結果) を、
+    取得が必要な場合は (False, 取得キャッシュ or None) を返す。後者は request_page に渡す。
+    結果は request_page と同じ形で、キャッシュを使う場合は {'cached': スクレイピング結果}、使えない場合は None。
+    """
+    if urlsplit(url).path.lower().endswith(SKIP_EXTENSIONS):
+        print(f"HTML以外のためスキップ ({url})")
+        return True, None
+
+    cached = fetch_cache.lookup(url)
+    cached_result = _cached_scrape_result(cached)
+    if cached:
+        if fetch_cache.is_backing_off(cached):
+            print(f"前回の取得失敗のため再取得を見送り ({url})")
+            metrics.record_cache('fetch', 'backoff')
+            return True, ({'cached': cached_result} if cached_result else None)
+        if fetch_cache.is_fresh(cached):
+            metrics.record_cache('fetch', 'fresh')
+            return True, {'cached': cached_result}
+
+    if not host_scheduler.default_scheduler.allow(host_scheduler.host_of(url)):
+        print(f"取得を停止中のホストのためスキップ ({url})")
+        return True, ({'cached': cached_result} if cached_result else None)
+    return False, cached
+
+def request_page(url, cached=None):
+    """
+    HTTPリクエストを送ってページを取得する（lookup_fetch で取得が必要と分かった場合に使う）。
+    取得キャッシュ（cached）がある場合は条件付きリクエストで再検証する。
+    キャッシュが使える場合（304 Not Modified・失敗時にキャッシュがある場合）は {'cached': スクレイピング結果} を、
+    取得できた場合は {'scraped': スクレイピング結果, 'etag': ..., 'last_modified': ...} を返す。
+    失敗した場合やHTML以外の場合は None を返す。
+    本文は少しずつ読み込みながら復号して PageExtractor に渡し、本文テキストが十分に集まった時点
+    （または SCRAPE_MAX_BYTES に達した時点）で残りを読まずに接続を閉じる。
+    """
+    cached_result = _cached_scrape_result(cached)
+    host = host_scheduler.host_of(url)
+    scheduler = host_scheduler.default_scheduler
+    headers = {}
+    if cached_result:
+        if cached['etag']:
+            headers['If-None-Match'] = cached['etag']
+        if cached['last_modified']:
+            headers['If-Modified-Since'] = cached['last_modified']
+
+    if not scheduler.start_request(host):
+        print(f"取得を停止中のホストのためスキップ ({url})")
+        return {'cached': cached_result} if cached_result else None
     try:
-        headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'}
-        response = requests.get(url, headers=headers, timeout=20)
-        response.raise_for_status()
-        soup = BeautifulSoup(response.content, 'html.parser')
-
-        ogp_data = {}
-        for meta in soup.find_all('meta'):
-            prop = meta.get('property')
+        with http_session.get(url, headers=headers, timeout=scheduler.timeout_for(host), stream=True) as response:
+            if response.status_code == 429 or response.status_code >= 500:
+                scheduler.record_failure(host, _retry_after_seconds(response))
+            else:
+                scheduler.record_success(host, response.elapsed.total_seconds())
+            if response.status_code == 304 and cached_result:
+                fetch_cache.mark_not_modified(url)
+                metrics.record_cache('fetch', 'not_modified')
+                return {'cached': cached_result}
+            metrics.record_cache('fetch', 'revalidated' if cached_result else 'miss')
+            response.raise_for_status()
+            content_type = response.headers.get('Content-Type', '').lower()
+            if content_type and not content_type.startswith(HTML_CONTENT_TYPES):
+                print(f"HTML以外のためスキップ ({url}): {content_type}")
+                fetch_cache.store_failure(url, f"unsupported content type: {content_type}")
+                return None
+
+            extractor = PageExtractor()
+            decoder = None
+            head = b''
+            size = 0
+            for chunk in response.iter_content(chunk_size=SCRAPE_CHUNK_SIZE):
+                chunk = chunk[:SCRAPE_MAX_BYTES - size]
+                size += len(chunk)
+                if decoder is None:
+                    # 文字コードが分かるまで（先頭の META_SNIFF_BYTES バイトを読むまで）は復号を待つ
+                    head += chunk
+                    if len(head) < META_SNIFF_BYTES and size < SCRAPE_MAX_BYTES:
+                        continue
+                    decoder = _html_decoder(content_type, head)
+                    chunk, head = head, b''
+                extractor.feed_text(decoder.decode(chunk))
+                if extractor.done or size >= SCRAPE_MAX_BYTES:
+                    break
+            if decoder is None:
+                decoder = _html_decoder(content_type, head)
+                extractor.feed_text(decoder.decode(head))
+            if not extractor.done:
+                extractor.feed_text(decoder.decode(b'', final=True))
+                extractor.close()
+            return {
+                'scraped': extractor.result(),
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified')
+            }
+    except Exception as e:
+        print(f"スクレイピングエラー ({url}): {e}")
+        if isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+            scheduler.record_failure(host)
+        try:
+            fetch_cache.store_failure(url, e)
+        except Exception as cache_error:
+            print(f"取得キャッシュの更新中にエラー ({url}): {cache_error}")
+        return {'cached': cached_result} if cached_result else None
+
+class PageExtractor(HTMLParser):
+    """
+    HTMLを先頭から順に読み、og:メタタグと表示テキストを集める。
+    script・style・ナビゲーション等の中身は読み飛ばし、本文が十分に集まった時点で done になる。
+    読み飛ばす要素が閉じられていない場合も、それを含む要素（または body）が閉じた時点で読み飛ばしをやめる。
+    """
+    def __init__(self, text_limit=SCRAPE_TEXT_LIMIT):
+        super().__init__(convert_charrefs=True)
+        self.text_limit = text_limit
+        self.ogp = {}
+        self.parts = []
+        self.text_length = 0
+        # 開いている要素と、読み飛ばす要素を開いた時点の open_tags の長さ
+        self.open_tags = []
+        self.skip_starts = []
+        self.done = False
+        self._text = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'meta':
+            attrs = dict(attrs)
+            prop = attrs.get('property')
             if prop and prop.startswith('og:'):
                 key = prop.split(':')[1]
-                ogp_data[key] = meta.get('content')
+                self.ogp[key] = attrs.get('content')
+        if tag in VOID_TAGS:
+            return
+        if tag in SKIP_TAGS:
+            self.skip_starts.append(len(self.open_tags))
+        self.open_tags.append(tag)
+
+    def handle_endtag(self, tag):
+        if tag in ('body', 'html'):
+            self.skip_starts.clear()
+        if tag not in self.open_tags:
+            return
+        # 閉じられていない子要素もまとめて閉じる
+        del self.open_tags[len(self.open_tags) - 1 - self.open_tags[::-1].index(tag):]
+        while self.skip_starts and self.skip_starts[-1] >= len(self.open_tags):
+            self.skip_starts.pop()
+
+    def handle_data(self, data):
+        if not self.skip_starts:
+            self.parts.append(data)
+            self.text_length += len(' '.join(data.split())) + 1
+
+    def text(self):
+        # 読み終えてから1回だけ組み立てる
+        if self._text is None:
+            self._text = ' '.join(''.join(self.parts).split())
+        return self._text
+
+    def feed_text(self, text):
+        """
+        復号済みのHTMLの続きを読む。本文テキストがおよそ text_limit 文字に達したら done になる。
+        """
+        if self.done or not text:
+            return self
+        self.feed(text)
+        if self.text_length >= self.text_limit:
+            self.done = True
+        return self
 
-        for element in soup(['script', 'style', 'nav', 'header', 'footer', 'aside', 'form']):
-            element.decompose()
-        text = ' '.join(t.strip() for t in soup.get_text().split())
-        return {'text': text[:2000], 'ogp': ogp_data}
+    def result(self):
+        return {'text': self.text()[:self.text_limit], 'ogp': self.ogp}
+
+def parse_fetched_page(url, fetched):
+    """
+    lookup_fetch / request_page の結果からスクレイピング結果（本文とOGP）を取り出し、取得キャッシュに保存する。
+    """
+    if 'cached' in fetched:
+        return fetched['cached']
+    scrape_result = fetched['scraped']
+    try:
+        fetch_cache.store_success(url, scrape_result['text'], scrape_result['ogp'], fetched['etag'], fetched['last_modified'])
     except Exception as e:
-        print(f"スクレイピングエラー ({url}): {e}")
-        return None
+        print(f"取得キャッシュの保存中にエラー ({url}): {e}")
+    return scrape_result
 
 # 第二のGeminiによるフィルタリング
 def classify_content(text_snippet):
-    if not model:
+    llm = get_llm()
+    if not llm:
         print("エラー: Geminiモデルが初期化されていません。")
-        return False
+        return None
     prompt = f"""
         以下の文章は「IT技術解説の記事」か「IT無関係の記事」かを分類してください。
         文章: {text_snippet}
@@ -158,41 +542,229 @@ def classify_content(text_snippet):
         情報サイトのTOP場合もnoneと答えてください。
     """
     try:
-        response = model.generate_content(prompt)
+        response = llm.generate_content(prompt)
         answer = response.text.strip().lower()
         return 'technical' in answer
+    except gemini_client.GeminiUnavailableError:
+        # レート制限などで判定できなかった記事は、後で再試行できるよう呼び出し元に伝える
+        raise
     except Exception as e:
         print(f"Geminiでの分類失敗: {e}")
-        return False
+        # 判定結果ではないため None を返す（キャッシュに「none」として残さないため）
+        return None
 
-# Geminiによる要約やタグ付の処理
-def process_and_summarize_entry(entry):
+# ユーザー横断のコンテンツキャッシュ
+# 同じ記事（正規化したURL単位）のスクレイピング結果・分類結果・要約結果を共有し、
+# 2人目以降はHTTP取得もGemini呼び出しも行わない。
+CONTENT_CACHE_COLLECTION = 'contentCache'
+CONTENT_CACHE_TTL = timedelta(seconds=int(os.environ.get('CONTENT_CACHE_TTL_SECONDS', 7 * 24 * 60 * 60)))
+CONTENT_CACHE_MAX_ENTRIES = int(os.environ.get('CONTENT_CACHE_MAX_ENTRIES', 2000))
+
+# どのサイトでもトラッキングにしか使われないクエリ（utm_* などの計測用と、広告のクリックID）
+TRACKING_PARAM_PREFIXES = ('utm_', 'mc_', 'pk_', 'hsa_')
+TRACKING_PARAMS = {'fbclid', 'gclid', 'dclid', 'yclid', 'msclkid', 'igshid', 'twclid', 'ttclid', '_ga', '_gl'}
+# ref などはサイトによって意味がある（コードホスティングの ?ref=ブランチ など）ため、分かっているホストでだけ取り除く
+# （サブドメインにも当てはめる）
+TRACKING_PARAMS_BY_HOST = {
+    'twitter.com': {'ref_src', 'ref_url', 's', 't'},
+    'x.com': {'ref_src', 'ref_url', 's', 't'},
+    'qiita.com': {'ref'},
+    'zenn.dev': {'ref'},
+    'note.com': {'ref'},
+    'aliexpress.com': {'spm'},
+    'taobao.com': {'spm'},
+}
+
+_content_cache = OrderedDict()
+_content_cache_lock = threading.Lock()
+
+def canonicalize_url(url):
+    """
+    トラッキング用のクエリとフラグメントを取り除き、キャッシュキーとして使える形にURLを正規化する。
     """
-    単一の履歴エントリに対して、取得・分類・要約までを一貫して行う関数。
-    ThreadPoolExecutorによって並列で実行される。
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc.lower()
+    if (scheme == 'http' and netloc.endswith(':80')) or (scheme == 'https' and netloc.endswith(':443')):
+        netloc = netloc.rsplit(':', 1)[0]
+    path = parts.path or '/'
+    hostname = parts.hostname or ''
+    host_params = set()
+    for host, params in TRACKING_PARAMS_BY_HOST.items():
+        if hostname == host or hostname.endswith('.' + host):
+            host_params |= params
+    query_items = [
+        (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if key.lower() not in TRACKING_PARAMS and key.lower() not in host_params
+        and not key.lower().startswith(TRACKING_PARAM_PREFIXES)
+    ]
+    query = urlencode(sorted(query_items))
+    return urlunsplit((scheme, netloc, path, query, ''))
+
+def _content_cache_doc_id(canonical_url):
+    return hashlib.sha256(canonical_url.encode('utf-8')).hexdigest()
+
+def get_cached_content(canonical_url):
+    """
+    正規化URLに対応するキャッシュを返す。プロセス内LRU → Firestoreの順に参照し、期限切れは無視する。
+    """
+    now = datetime.now(timezone.utc)
+    with _content_cache_lock:
+        cached = _content_cache.get(canonical_url)
+        if cached:
+            if cached['expiresAt'] > now:
+                _content_cache.move_to_end(canonical_url)
+                metrics.record_cache('content', 'memory_hit')
+                return cached
+            del _content_cache[canonical_url]
+
+    db = get_db()
+    if not db:
+        return None
+    try:
+        doc = db.collection(CONTENT_CACHE_COLLECTION).document(_content_cache_doc_id(canonical_url)).get()
+        if not doc.exists:
+            metrics.record_cache('content', 'miss')
+            return None
+        cached = doc.to_dict()
+        expires_at = cached.get('expiresAt')
+        if not expires_at or expires_at <= now:
+            metrics.record_cache('content', 'expired')
+            return None
+        _remember_content(canonical_url, cached)
+        metrics.record_cache('content', 'hit')
+        return cached
+    except Exception as e:
+        print(f"コンテンツキャッシュの取得中にエラー ({canonical_url}): {e}")
+        return None
+
+def _remember_content(canonical_url, cached):
+    with _content_cache_lock:
+        _content_cache[canonical_url] = cached
+        _content_cache.move_to_end(canonical_url)
+        while len(_content_cache) > CONTENT_CACHE_MAX_ENTRIES:
+            _content_cache.popitem(last=False)
+
+def set_cached_content(canonical_url, verdict, ogp=None, summary_data=None):
+    """
+    分類結果（technical / none）と、technicalの場合は要約結果をキャッシュに保存する。
+    Firestore側の古いドキュメントは expiresAt に対するTTLポリシーで削除される想定。
+    """
+    cached = {
+        'canonicalUrl': canonical_url,
+        'verdict': verdict,
+        'ogp': ogp or {},
+        'expiresAt': datetime.now(timezone.utc) + CONTENT_CACHE_TTL
+    }
+    if summary_data:
+        for key in ['generatedTitle', 'source', 'summary', 'tags']:
+            if key in summary_data:
+                cached[key] = summary_data[key]
+    _remember_content(canonical_url, cached)
+
+    db = get_db()
+    if not db:
+        return
+    try:
+        db.collection(CONTENT_CACHE_COLLECTION).document(_content_cache_doc_id(canonical_url)).set(
+            dict(cached, cachedAt=firestore.SERVER_TIMESTAMP)
+        )
+    except Exception as e:
+        print(f"コンテンツキャッシュの保存中にエラー ({canonical_url}): {e}")
+
+def record_domain_verdict(url, verdict):
+    """
+    Geminiによる分類結果を、候補の優先順位付けに使うドメインの評判に加える。
+    """
+    try:
+        candidate_scheduler.record_verdict(url, verdict)
+    except Exception as e:
+        print(f"ドメインの評判の記録中にエラー ({url}): {e}")
+
+def build_article_from_cache(cached, title, url):
+    article_data = {'originalUrl': url, 'originalTitle': title}
+    for key in ['generatedTitle', 'source', 'summary', 'tags']:
+        if key in cached:
+            article_data[key] = cached[key]
+    article_data['ogp'] = cached.get('ogp', {})
+    return article_data
+
+SUMMARY_TAG_LIST = 'サーバー, ネットワーク,HTML, CSS, JavaScript, Java, Python, PHP, Ruby, Rust, swift, C言語, C#, C++, TypeScript, Go, サーバーレス, データベース, LLM, Linux, Windows, MacOS, OS,クラウド, AWS, Azure, GCP, Docker, フレームワーク, ライブラリ, API, JSON, SQL, NoSQL, Git, Github, AI, UI/UX, Cloud, ネットワーク, セキュリティ, フロントエンド, バックエンド, Web3'
+
+# 1回のGemini呼び出しでまとめて分類・要約する記事数
+LLM_BATCH_SIZE = int(os.environ.get('LLM_BATCH_SIZE', 10))
+
+# 取得段階の処理（フィルタリング・キャッシュ確認・スクレイピング）
+def check_entry(entry):
+    """
+    キーワードによるフィルタリングとキャッシュの確認を行う関数。
+    キャッシュに要約があれば {'article': ...} を、取得が必要な場合はURL情報を含む辞書を返す。
+    対象外の場合は None を返す。
     """
     title = entry.get('title', '')
     url = entry.get('url', '')
 
-    if not (url and url.startswith('http') and is_it_tech(title, url) and is_info_page(title, url)):
+    if not (url and url.startswith('http') and keyword_filter.default_matcher.is_candidate(title, url)):
         return None
 
-    scrape_result = scrape_content(url)
+    canonical_url = canonicalize_url(url)
+    cached = get_cached_content(canonical_url)
+    if cached:
+        if cached.get('verdict') != 'technical':
+            print(f"  -> ♻️ キャッシュ済み（技術記事ではない）: {title}")
+            return None
+        print(f"  -> ♻️ キャッシュから要約を再利用: {title}")
+        return {'article': build_article_from_cache(cached, title, url)}
+
+    return {'title': title, 'url': url, 'canonical_url': canonical_url}
+
+def finish_scraped_entry(item, scrape_result):
+    """
+    スクレイピング結果を検証し、Geminiに渡せる形にまとめる。本文が短すぎる場合は None を返す。
+    本文が短いのは一時的な失敗やJavaScriptで描画するページのこともあるため、ユーザー横断のキャッシュに判定として残さない
+    （同じURLの再取得は取得キャッシュの有効期間だけ抑えられる）。
+    """
     if not scrape_result:
         return None
-    
+
     content = scrape_result['text']
     ogp_data = scrape_result['ogp']
     if not content or len(content) < 100:
         return None
 
-    if not classify_content(content[:1000]):
+    return dict(item, content=content, ogp=ogp_data)
+
+# Geminiによる要約やタグ付の処理
+def summarize_scraped_entry(item):
+    """
+    スクレイピング済みの1件に対して、分類・要約を個別のGemini呼び出しで行う関数。
+    バッチ処理の結果が解釈できなかった場合のフォールバックとしても使われる。
+    要約できなかった場合は、その理由を item['outcome'] に残す。
+    """
+    title = item['title']
+    url = item['url']
+    canonical_url = item['canonical_url']
+    content = item['content']
+    ogp_data = item['ogp']
+
+    with metrics.stage('classify'):
+        is_technical = classify_content(content[:1000])
+    if is_technical is not None:
+        record_domain_verdict(url, 'technical' if is_technical else 'none')
+    if not is_technical:
+        if is_technical is False:
+            set_cached_content(canonical_url, 'none', ogp_data)
+            item['outcome'] = 'not_technical'
+        else:
+            item['outcome'] = 'classify_failed'
         print(f"  -> ❌ 技術記事ではないと判断: {title}")
         return None
     
     print(f"  -> ✅ 技術記事として分類: {title}")
 
-    if not model:
+    llm = get_llm()
+    if not llm:
+        item['outcome'] = 'summary_failed'
         return None
     try:
         prompt = f"""
@@ -205,9 +777,9 @@ def process_and_summarize_entry(entry):
             情報元:（ここにURLではなく、Webサイト名やサービス名を記載）
             要約:（サイト内容をIT技術の観点から一言で要約してください。タグ用語を必ず含めて、である調で記述してください。太字などはなしでシンプルなテキストで書いてください。）
             タグ:（重要：必ず下記の「タグリスト」の中から、内容に最も関連する単語を2つだけ選んでください。リストにない単語は絶対に使用しないでください。）
-            タグリスト: サーバー, ネットワーク,HTML, CSS, JavaScript, Java, Python, PHP, Ruby, Rust, swift, C言語, C#, C++, TypeScript, Go, サーバーレス, データベース, LLM, Linux, Windows, MacOS, OS,クラウド, AWS, Azure, GCP, Docker, フレームワーク, ライブラリ, API, JSON, SQL, NoSQL, Git, Github, AI, UI/UX, Cloud, ネットワーク, セキュリティ, フロントエンド, バックエンド, Web3
+            タグリスト: {SUMMARY_TAG_LIST}
         """
-        response = model.generate_content(prompt)
+        response = llm.generate_content(prompt)
         
         lines = response.text.strip().split('\n')
         article_data = {'originalUrl': url, 'originalTitle': title}
@@ -222,24 +794,719 @@ def process_and_summarize_entry(entry):
         article_data['ogp'] = ogp_data
         if all(k in article_data for k in ['generatedTitle', 'summary', 'tags']):
             print(f"  -> 📝 要約生成成功: {article_data.get('generatedTitle')}")
+            set_cached_content(canonical_url, 'technical', ogp_data, article_data)
             return article_data
         else:
             print(f"  -> ⚠️ 要約結果の形式が不正: {title}")
+            item['outcome'] = 'summary_invalid'
             return None
 
+    except gemini_client.GeminiUnavailableError:
+        raise
     except Exception as e:
         print(f"  -> 🚨 Geminiでの要約中にエラー: {e}")
+        item['outcome'] = 'summary_failed'
         return None
 
+def parse_batch_response(text, expected_ids):
+    """
+    バッチ要約のJSON応答を {id: 結果} の辞書に変換する。形式が不正な場合は ValueError を送出する。
+    """
+    results = json.loads(text)
+    if isinstance(results, dict):
+        results = results.get('items', [])
+    if not isinstance(results, list):
+        raise ValueError("応答がJSON配列ではありません")
+
+    parsed = {}
+    for result in results:
+        if not isinstance(result, dict):
+            continue
+        # id が文字列（"3" など）で返ってくることもあるため、数値に直してから照合する
+        try:
+            result_id = int(result.get('id'))
+        except (TypeError, ValueError):
+            continue
+        if result_id not in expected_ids:
+            continue
+        verdict = str(result.get('verdict', '')).strip().lower()
+        if verdict not in ('technical', 'none'):
+            continue
+        tags = result.get('tags')
+        if isinstance(tags, str):
+            tags = [tag.strip() for tag in tags.split(',')]
+        parsed[result_id] = {
+            'verdict': verdict,
+            'generatedTitle': result.get('title'),
+            'source': result.get('source'),
+            'summary': result.get('summary'),
+            'tags': [str(tag).strip() for tag in tags] if isinstance(tags, list) else None
+        }
+    if not parsed:
+        raise ValueError("有効な結果が1件も含まれていません")
+    return parsed
+
+def summarize_batch(items):
+    """
+    スクレイピング済みの複数記事を1回のGemini呼び出し（JSONモード）で分類・要約する関数。
+    同じ正規化URLの記事は1件分だけ送り、結果を各エントリに展開する。
+    応答が解釈できなかった記事は summarize_scraped_entry による個別処理にフォールバックする。
+    """
+    groups = OrderedDict()
+    for item in items:
+        groups.setdefault(item['canonical_url'], []).append(item)
+    representatives = [group[0] for group in groups.values()]
+
+    parsed = {}
+    llm = get_llm()
+    if llm and len(representatives) > 1:
+        pages = []
+        for i, item in enumerate(representatives):
+            pages.append(f"""
+            [id: {i}]
+            タイトル: {item['title']}
+            URL: {item['url']}
+            コンテンツ: {item['content'][:1500]}...
+            """)
+        prompt = f"""
+            以下の{len(representatives)}件のWebサイトについて、それぞれ「IT技術解説の記事」か「IT無関係の記事」かを分類し、IT技術解説の記事は要約してください。
+            情報サイトのTOPの場合もIT無関係として扱ってください。
+            {''.join(pages)}
+            必ず下記の形式のJSON配列だけを返してください。各要素は入力の id に対応させてください。
+            [{{"id": 入力のid(数値), "verdict": "technical" または "none", "title": "内容が分かりやすいタイトル", "source": "URLではなくWebサイト名やサービス名", "summary": "要約", "tags": ["タグ1", "タグ2"]}}]
+            verdict が none の場合、title・source・summary・tags は空で構いません。
+            要約: サイト内容をIT技術の観点から一言で要約してください。タグ用語を必ず含めて、である調で記述してください。太字などはなしでシンプルなテキストで書いてください。
+            タグ: 重要：必ず下記の「タグリスト」の中から、内容に最も関連する単語を2つだけ選んでください。リストにない単語は絶対に使用しないでください。
+            タグリスト: {SUMMARY_TAG_LIST}
+        """
+        try:
+            response = llm.generate_content(
+                prompt,
+                generation_config={'response_mime_type': 'application/json'}
+            )
+            parsed = parse_batch_response(response.text, set(range(len(representatives))))
+        except gemini_client.GeminiUnavailableError:
+            raise
+        except Exception as e:
+            print(f"  -> ⚠️ バッチ要約の結果を解釈できませんでした。個別処理に切り替えます: {e}")
+            parsed = {}
+
+    articles = []
+    for i, item in enumerate(representatives):
+        group = groups[item['canonical_url']]
+        result = parsed.get(i)
+        if result and result['verdict'] == 'none':
+            set_cached_content(item['canonical_url'], 'none', item['ogp'])
+            record_domain_verdict(item['url'], 'none')
+            print(f"  -> ❌ 技術記事ではないと判断: {item['title']}")
+            for member in group:
+                member['outcome'] = 'not_technical'
+            continue
+
+        if result and all(result.get(k) for k in ['generatedTitle', 'summary', 'tags']):
+            set_cached_content(item['canonical_url'], 'technical', item['ogp'], result)
+            record_domain_verdict(item['url'], 'technical')
+            print(f"  -> 📝 要約生成成功: {result['generatedTitle']}")
+        else:
+            article_data = summarize_scraped_entry(item)
+            if not article_data:
+                for member in group:
+                    member['outcome'] = item.get('outcome')
+                continue
+            result = article_data
+
+        for member in group:
+            article_data = {'originalUrl': member['url'], 'originalTitle': member['title']}
+            for key in ['generatedTitle', 'source', 'summary', 'tags']:
+                if result.get(key) is not None:
+                    article_data[key] = result[key]
+            article_data['ogp'] = member['ogp']
+            articles.append(article_data)
+    return articles
+
+# 非同期パイプライン（取得 → 解析 → 分類・要約）
+# 各段階は別々の同時実行数で動き、解析が終わった記事から順にGeminiへ流れていく。
+PARSE_CONCURRENCY = int(os.environ.get('PARSE_CONCURRENCY', 4))
+LLM_CONCURRENCY = int(os.environ.get('LLM_CONCURRENCY', 4))
+LLM_BATCH_WAIT_SECONDS = float(os.environ.get('LLM_BATCH_WAIT_SECONDS', 2))
+# キャッシュの確認（Firestore・SQLiteの読み込み）を同時に行うエントリの数
+CACHE_LOOKUP_CONCURRENCY = int(os.environ.get('CACHE_LOOKUP_CONCURRENCY', 8))
+
+async def run_history_pipeline(entries, on_entry_done=None, budget=None):
+    """
+    履歴エントリを非同期パイプラインで処理し、要約済みの記事のリストを返す。
+    ブロッキングな処理（Firestore・HTTP・HTML解析・Gemini）はスレッドプール上で実行する。
+    on_entry_done を渡すと、各エントリの処理が終わるたびに (entriesでの位置, 記事 or None) で呼ばれる。
+    budget（candidate_scheduler.JobBudget）を渡した場合、entries は優先順に並んでいるものとしてその順に処理を始め、
+    予算を使い切った後にページの取得やGeminiの呼び出しが必要になったエントリは budget.deferred に記録する
+    （on_entry_done は呼ばない）。キャッシュだけで済むエントリは予算を使い切った後も処理する。
+    Geminiのレート制限や予期しないエラーで処理できなかったエントリがあれば、他のエントリを処理し終えてから
+    GeminiUnavailableError を送出する（そのエントリについては on_entry_done を呼ばず、ジョブの再試行で処理し直す）。
+    """
+    loop = asyncio.get_running_loop()
+    lookup_semaphore = asyncio.Semaphore(CACHE_LOOKUP_CONCURRENCY)
+    fetch_semaphore = asyncio.Semaphore(FETCH_CONCURRENCY)
+    parse_semaphore = asyncio.Semaphore(PARSE_CONCURRENCY)
+    llm_semaphore = asyncio.Semaphore(LLM_CONCURRENCY)
+    host_semaphores = {}
+    llm_queue = asyncio.Queue()
+    summarized_articles = []
+    deferred_positions = []
+
+    executor = ThreadPoolExecutor(
+        max_workers=CACHE_LOOKUP_CONCURRENCY + FETCH_CONCURRENCY + PARSE_CONCURRENCY + LLM_CONCURRENCY
+    )
+
+    def run_blocking(func, *args):
+        # 計測中のジョブ（contextvars）をスレッドプール上の処理に引き継ぐ
+        return loop.run_in_executor(executor, partial(contextvars.copy_context().run, func, *args))
+
+    def within_budget(positions):
+        if budget and budget.exhausted():
+            budget.defer(positions)
+            metrics.record_outcome('budget_deferred', len(positions))
+            return False
+        return True
+
+    def defer_failed(positions):
+        # 予期しないエラーで処理できなかったエントリは、Geminiを呼び出せなかった場合と同じくジョブの再試行に回す
+        deferred_positions.extend(positions)
+        metrics.record_outcome('failed', len(positions))
+
+    def entry_done(position, article, outcome):
+        metrics.record_outcome(outcome)
+        if on_entry_done:
+            try:
+                on_entry_done(position, article)
+            except Exception as e:
+                print(f"進捗の記録中にエラー: {e}")
+
+    async def fetch_and_parse(position, entry):
+        async with lookup_semaphore:
+            with metrics.stage('cache_lookup'):
+                checked = await run_blocking(check_entry, entry)
+        if not checked:
+            entry_done(position, None, 'cached_not_technical')
+            return
+        if 'article' in checked:
+            summarized_articles.append(checked['article'])
+            entry_done(position, checked['article'], 'cached_summary')
+            return
+        checked['position'] = position
+
+        # 取得キャッシュで済む場合（新しい・失敗後の待機中など）は、ホストの取得間隔も取得枠も使わない
+        async with lookup_semaphore:
+            resolved, fetched = await run_blocking(lookup_fetch, checked['url'])
+        if not resolved:
+            host = host_scheduler.host_of(checked['url'])
+            host_semaphore = host_semaphores.setdefault(host, asyncio.Semaphore(FETCH_PER_HOST_LIMIT))
+            async with host_semaphore:
+                # 同じホストへは一定の間隔を空けて取得する（待っている間は取得枠を使わない）
+                await asyncio.sleep(host_scheduler.default_scheduler.reserve(host))
+                async with fetch_semaphore:
+                    if not within_budget([position]):
+                        return
+                    with metrics.stage('fetch'):
+                        fetched = await run_blocking(request_page, checked['url'], fetched)
+        if fetched is None:
+            entry_done(position, None, 'fetch_failed')
+            return
+
+        async with parse_semaphore:
+            try:
+                with metrics.stage('parse'):
+                    scrape_result = await run_blocking(parse_fetched_page, checked['url'], fetched)
+            except Exception as e:
+                print(f"スクレイピングエラー ({checked['url']}): {e}")
+                entry_done(position, None, 'parse_failed')
+                return
+
+        item = finish_scraped_entry(checked, scrape_result)
+        if item:
+            await llm_queue.put(item)
+        else:
+            entry_done(position, None, 'too_short')
+
+    async def summarize(batch):
+        async with llm_semaphore:
+            if not within_budget([item['position'] for item in batch]):
+                return
+            try:
+                with metrics.stage('summarize'):
+                    articles = await run_blocking(summarize_batch, batch)
+            except gemini_client.GeminiUnavailableError as e:
+                print(f"  -> ⏸️ Geminiを呼び出せないため {len(batch)} 件の要約を後回しにします: {e}")
+                deferred_positions.extend(item['position'] for item in batch)
+                metrics.record_outcome('deferred', len(batch))
+                return
+            except Exception as e:
+                print(f"  -> 🚨 バッチ要約中に予期しないエラー: {e}")
+                defer_failed([item['position'] for item in batch])
+                return
+            summarized_articles.extend(articles)
+
+            # 記事を元のエントリに対応付けて進捗を記録する
+            articles_by_url = {}
+            for article in articles:
+                articles_by_url.setdefault(article['originalUrl'], []).append(article)
+            for item in batch:
+                matched = articles_by_url.get(item['url'])
+                article = matched.pop() if matched else None
+                entry_done(item['position'], article, 'summarized' if article else item.get('outcome', 'not_summarized'))
+
+    async def llm_stage():
+        batch = []
+        tasks = []
+        while True:
+            try:
+                item = await asyncio.wait_for(llm_queue.get(), timeout=LLM_BATCH_WAIT_SECONDS)
+            except asyncio.TimeoutError:
+                # しばらく新しい記事が来なければ、揃っている分だけ先に処理する
+                if batch:
+                    tasks.append(asyncio.create_task(summarize(batch)))
+                    batch = []
+                continue
+            if item is None:
+                break
+            batch.append(item)
+            if len(batch) >= LLM_BATCH_SIZE:
+                tasks.append(asyncio.create_task(summarize(batch)))
+                batch = []
+        if batch:
+            tasks.append(asyncio.create_task(summarize(batch)))
+        await asyncio.gather(*tasks)
+
+    try:
+        llm_task = asyncio.create_task(llm_stage())
+        if budget:
+            # 優先順に並んでいるため、その順に開始する（同じホストの取得待ちは取得枠を使わない）
+            ordered = list(enumerate(entries))
+        else:
+            # 同じホストのURLが続くと取得枠が空くのを待つだけになるため、ホストが交互になる順で開始する
+            ordered = host_scheduler.interleave_by_host(list(enumerate(entries)), lambda pair: pair[1].get('url'))
+        results = await asyncio.gather(
+            *(fetch_and_parse(position, entry) for position, entry in ordered),
+            return_exceptions=True
+        )
+        for (position, _), result in zip(ordered, results):
+            if isinstance(result, Exception):
+                print(f"  -> 🚨 記事の取得中に予期しないエラー: {result}")
+                defer_failed([position])
+        await llm_queue.put(None)
+        await llm_task
+    finally:
+        executor.shutdown(wait=False)
+
+    if deferred_positions:
+        raise gemini_client.GeminiUnavailableError(f"{len(deferred_positions)} 件のエントリを処理できませんでした")
+    return summarized_articles
+
+# URLごとの訪問回数
+# users/{uid}/urlStats/{URLのハッシュ} にURLごとの記事数を持ち、
+# 記事には保存時点で何回目の学習か（visitNumber）を記録しておく。
+VISIT_COUNTS_VERSION = 1
+
+def _url_stats_ref(user_id, url):
+    doc_id = hashlib.sha256(url.encode('utf-8')).hexdigest()
+    return get_db().collection('users').document(user_id).collection('urlStats').document(doc_id)
+
+def get_url_visit_counts(user_id, urls):
+    """
+    URLごとの記事数を {URL: 件数} で返す（1回のまとめ読み）。
+    """
+    refs = [_url_stats_ref(user_id, url) for url in set(urls)]
+    counts = {}
+    if not refs:
+        return counts
+    for doc in get_db().get_all(refs):
+        if doc.exists:
+            data = doc.to_dict()
+            counts[data.get('url')] = data.get('count', 0)
+    return counts
+
+def backfill_visit_counts(user_id):
+    """
+    既存の記事から visitNumber と urlStats を作り直す。
+    """
+    db = get_db()
+    print(f"訪問回数を再計算します (User: {user_id})")
+    user_ref = db.collection('users').document(user_id)
+    docs = list(user_ref.collection('articles').select(['originalUrl', 'createdAt', 'visitNumber']).stream())
+    docs.sort(key=lambda doc: (doc.get('createdAt') is not None, doc.get('createdAt') or 0, doc.id))
+
+    counts = {}
+    writes = []
+    for doc in docs:
+        url = doc.get('originalUrl')
+        if not url:
+            continue
+        counts[url] = counts.get(url, 0) + 1
+        if doc.get('visitNumber') != counts[url]:
+            writes.append((doc.reference, {'visitNumber': counts[url]}))
+    for url, count in counts.items():
+        writes.append((_url_stats_ref(user_id, url), {'url': url, 'count': count}))
+
+    for i in range(0, len(writes), 500):
+        batch = db.batch()
+        for ref, data in writes[i:i + 500]:
+            batch.set(ref, data, merge=True)
+        batch.commit()
+    user_ref.set({'visitCountsVersion': VISIT_COUNTS_VERSION}, merge=True)
+    print(f"✅ 訪問回数を再計算しました (User: {user_id}, URL: {len(counts)}件)")
+
+def ensure_visit_counts(user_id):
+    """
+    urlStats が古い形式（または未作成）の場合は作り直す。
+    """
+    user_doc = get_db().collection('users').document(user_id).get()
+    if not user_doc.exists or (user_doc.to_dict() or {}).get('visitCountsVersion') != VISIT_COUNTS_VERSION:
+        backfill_visit_counts(user_id)
+
+def assign_visit_numbers(user_id, articles, known_counts):
+    """
+    保存前の記事に visitNumber を付け、urlStats に加算する件数を {URL: 件数} で返す。
+    known_counts（{URL: 保存済みの件数}）にないURLだけ urlStats から読み込んで加える。
+    known_counts は保存が終わるまで進めない（保存できたら呼び出し側が加算する件数の分だけ進める）。
+    """
+    urls = {article['originalUrl'] for article in articles if article.get('originalUrl')}
+    missing = [url for url in urls if url not in known_counts]
+    if missing:
+        counts = get_url_visit_counts(user_id, missing)
+        for url in missing:
+            known_counts[url] = counts.get(url, 0)
+
+    increments = {}
+    for article_data in articles:
+        url = article_data.get('originalUrl')
+        if not url:
+            continue
+        increments[url] = increments.get(url, 0) + 1
+        article_data['visitNumber'] = known_counts[url] + increments[url]
+    return increments
+
+def url_visit_writes(user_id, increments):
+    """
+    urlStats への加算を batch_writer の書き込みのリストで返す。
+    """
+    return [
+        ('set', _url_stats_ref(user_id, url), {'url': url, 'count': firestore.Increment(count)}, True)
+        for url, count in increments.items()
+    ]
+
+def remove_url_visit(user_id, article_data, batch):
+    """
+    記事の削除に合わせて urlStats を減らし、同じURLの後の記事の visitNumber を繰り上げる。
+    """
+    url = article_data.get('originalUrl')
+    if not url:
+        return
+    batch.set(_url_stats_ref(user_id, url), {'url': url, 'count': firestore.Increment(-1)}, merge=True)
+    visit_number = article_data.get('visitNumber')
+    if not visit_number:
+        return
+    articles_ref = get_db().collection('users').document(user_id).collection('articles')
+    for doc in articles_ref.where('originalUrl', '==', url).select(['visitNumber']).stream():
+        if (doc.get('visitNumber') or 0) > visit_number:
+            batch.update(doc.reference, {'visitNumber': firestore.Increment(-1)})
+
+# 履歴の差分取り込み
+# users/{uid}/ingest/state に、取り込み済みの最新の訪問時刻（watermark、ミリ秒）と
+# 今日（UTC）保存した記事のURLのハッシュ（seenHashes）を持つ。
+# watermark より古いエントリは受け付けず、今日保存済みのURLの確認は記事を検索せずに seenHashes で行う。
+SEEN_URL_HASH_LENGTH = 16
+
+def _ingest_state_ref(user_id):
+    return get_db().collection('users').document(user_id).collection('ingest').document('state')
+
+def url_hash(url):
+    return hashlib.sha256(url.encode('utf-8')).hexdigest()[:SEEN_URL_HASH_LENGTH]
+
+def entry_visit_time(entry):
+    """
+    履歴エントリの訪問時刻をミリ秒で返す。
+    拡張機能（chrome.history の lastVisitTime、ミリ秒）とTakeout（time_usec、マイクロ秒）の両方に対応する。
+    """
+    try:
+        if entry.get('lastVisitTime') is not None:
+            return float(entry['lastVisitTime'])
+        if entry.get('time_usec') is not None:
+            return float(entry['time_usec']) / 1000
+    except (TypeError, ValueError):
+        pass
+    return None
+
+def get_history_watermark(user_id):
+    doc = _ingest_state_ref(user_id).get()
+    return (doc.to_dict() or {}).get('watermark') if doc.exists else None
+
+def select_history_candidates(entries, watermark):
+    """
+    アップロードされた履歴エントリを1件ずつ見て、処理対象の候補だけを残す。
+    watermark 以前に訪問したエントリ、キーワードで対象外のエントリを除き、同じURLは最も新しい訪問の1件にまとめる。
+    まとめたエントリの visitCount には、アップロードされた中での訪問回数（エントリ自体の visitCount の方が多ければそちら）を入れる。
+    (候補のリスト, 新しいwatermark, 件数の内訳) を返す。訪問時刻のないエントリは watermark では除外しない。
+    """
+    candidates = {}
+    visits = {}
+    new_watermark = watermark
+    counts = {'received': 0, 'new': 0, 'candidates': 0}
+    for entry in entries:
+        counts['received'] += 1
+        if not isinstance(entry, dict):
+            continue
+        visit_time = entry_visit_time(entry)
+        if visit_time is not None:
+            if watermark is not None and visit_time <= watermark:
+                continue
+            new_watermark = visit_time if new_watermark is None else max(new_watermark, visit_time)
+        counts['new'] += 1
+
+        url = entry.get('url')
+        if not (isinstance(url, str) and url.startswith('http')):
+            continue
+        if not keyword_filter.default_matcher.is_candidate(entry.get('title'), url):
+            continue
+        visits[url] = visits.get(url, 0) + 1
+        current = candidates.get(url)
+        if current is None or (visit_time or 0) > (entry_visit_time(current) or 0):
+            candidates[url] = entry
+    for url, entry in candidates.items():
+        try:
+            entry['visitCount'] = max(int(entry.get('visitCount') or 0), visits[url])
+        except (TypeError, ValueError):
+            entry['visitCount'] = visits[url]
+    counts['candidates'] = len(candidates)
+    return list(candidates.values()), new_watermark, counts
+
+def load_seen_url_hashes(user_id, start_of_today):
+    """
+    今日保存した記事のURLのハッシュを返す。
+    日付が変わって最初の呼び出しでは、今日作成された記事から作り直して保存する（1回の検索）。
+    """
+    state_ref = _ingest_state_ref(user_id)
+    today = start_of_today.date().isoformat()
+    doc = state_ref.get()
+    state = (doc.to_dict() or {}) if doc.exists else {}
+    if state.get('seenDate') == today:
+        return set(state.get('seenHashes') or [])
+
+    articles_ref = get_db().collection('users').document(user_id).collection('articles')
+    seen_hashes = set()
+    for article_doc in articles_ref.where('createdAt', '>=', start_of_today).select(['originalUrl']).stream():
+        url = article_doc.get('originalUrl')
+        if url:
+            seen_hashes.add(url_hash(url))
+    state_ref.set({'seenDate': today, 'seenHashes': sorted(seen_hashes)}, merge=True)
+    return seen_hashes
+
+def seen_urls_write(user_id, start_of_today, urls):
+    """
+    保存した記事のURLを seenHashes に追加する書き込み（batch_writer の形式）を返す。
+    """
+    return ('set', _ingest_state_ref(user_id), {
+        'seenDate': start_of_today.date().isoformat(),
+        'seenHashes': firestore.ArrayUnion(sorted({url_hash(url) for url in urls}))
+    }, True)
+
+def forget_seen_url(user_id, article_data, batch):
+    """
+    今日作成された記事を削除した場合は、同じURLを今日もう一度取り込めるようにする。
+    """
+    url = article_data.get('originalUrl')
+    created_at = article_data.get('createdAt')
+    start_of_today = datetime.combine(datetime.now(timezone.utc).date(), time.min, tzinfo=timezone.utc)
+    if url and created_at and created_at >= start_of_today:
+        batch.set(_ingest_state_ref(user_id), {'seenHashes': firestore.ArrayRemove([url_hash(url)])}, merge=True)
+
+# 記事の保存
+# 要約が終わった記事を ARTICLE_COMMIT_BATCH_SIZE 件（または ARTICLE_COMMIT_INTERVAL_SECONDS 秒）ごとにまとめ、
+# batch_writer で保存する。同じバッチでジョブの newArticleIds にも追加するため、処理中から記事が見える。
+# visitNumber を保存できた件数から順番に付けるため、1件のジョブのまとまりは1つずつ順番にコミットする
+# （要約と並行して裏で保存するため、ジョブの処理時間はほとんど変わらない）。
+ARTICLE_COMMIT_INTERVAL_SECONDS = float(os.environ.get('ARTICLE_COMMIT_INTERVAL_SECONDS', 2))
+# 記事1件あたりの書き込み（記事・urlStats）と、まとまりごとの書き込み（ジョブ・ingest/state・ファセット）が1つのバッチに収まる件数
+ARTICLE_COMMIT_MAX_BATCH_SIZE = (batch_writer.FIRESTORE_BATCH_MAX_WRITES - 3) // 2
+ARTICLE_COMMIT_BATCH_SIZE = min(int(os.environ.get('ARTICLE_COMMIT_BATCH_SIZE', 50)), ARTICLE_COMMIT_MAX_BATCH_SIZE)
+
+def article_doc_id(job_id, entry_index):
+    """
+    ジョブのエントリごとに決まる記事ID。再試行で保存し直しても同じドキュメントを上書きするだけになる。
+    """
+    return hashlib.sha256(f'{job_id}:{entry_index}'.encode('utf-8')).hexdigest()[:20]
+
+class ArticleCommitter:
+    """
+    1件のジョブの記事を少しずつまとめて保存する。
+    保存できた記事のIDは article_ids に、保存できなかった記事の件数は failed_count に記録する。
+    on_commit を渡すと、まとまりを保存するたびに（コミットしたスレッドで）呼ばれる。
+    """
+    def __init__(self, user_id, job_id, start_of_today, on_commit=None):
+        db = get_db()
+        self.user_id = user_id
+        self.job_id = job_id
+        self.start_of_today = start_of_today
+        self.articles_ref = db.collection('users').document(user_id).collection('articles')
+        self.job_ref = db.collection('users').document(user_id).collection('jobs').document(job_id)
+        self.writer = batch_writer.BatchWriter(db, concurrency=1)
+        self.article_ids = []
+        self.failed_count = 0
+        self.on_commit = on_commit
+        self._pending = []
+        self._last_flush = time_module.monotonic()
+        self._lock = threading.Lock()
+        # URLごとの保存済みの件数（visitNumber の基準）。まとまりを保存できたときだけ進める
+        self._visit_counts = None
+        self._visit_increments = None
+
+    def add(self, entry_index, article_data):
+        with self._lock:
+            self._pending.append((entry_index, article_data))
+        self.flush_if_due()
+
+    def flush_if_due(self):
+        with self._lock:
+            due = self._pending and (
+                len(self._pending) >= ARTICLE_COMMIT_BATCH_SIZE
+                or time_module.monotonic() - self._last_flush >= ARTICLE_COMMIT_INTERVAL_SECONDS
+            )
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            group, self._pending = self._pending, []
+            self._last_flush = time_module.monotonic()
+        for i in range(0, len(group), ARTICLE_COMMIT_BATCH_SIZE):
+            chunk = group[i:i + ARTICLE_COMMIT_BATCH_SIZE]
+            self.writer.submit(
+                partial(self._build_writes, chunk),
+                on_commit=partial(self._on_commit, chunk),
+                on_error=partial(self._on_error, chunk),
+                is_applied=partial(self._is_applied, chunk)
+            )
+
+    def _build_writes(self, group):
+        # コミットするスレッドで呼ばれる（visitNumber の付与にFirestoreの読み込みが必要なため）
+        # まとまりは1つずつ順番にコミットされるため、前のまとまりの保存の結果が _visit_counts に反映されている
+        self._visit_increments = None
+        if self._visit_counts is None:
+            ensure_visit_counts(self.user_id)
+            self._visit_counts = {}
+        visit_increments = assign_visit_numbers(
+            self.user_id, [article_data for _, article_data in group], self._visit_counts
+        )
+        self._visit_increments = visit_increments
+        writes = []
+        for entry_index, article_data in group:
+            article_data['createdAt'] = firestore.SERVER_TIMESTAMP
+            article_data['searchTokens'] = build_search_tokens(article_data)
+            set_article_vector(article_data)
+            writes.append(('set', self.articles_ref.document(article_doc_id(self.job_id, entry_index)), article_data, False))
+        writes += url_visit_writes(self.user_id, visit_increments)
+        writes.append(seen_urls_write(self.user_id, self.start_of_today, [article_data['originalUrl'] for _, article_data in group]))
+        writes.append(('set', _facets_ref(self.user_id), facet_changes(after=[article_data for _, article_data in group]), True))
+        writes.append(('set', self.job_ref, {
+            'newArticleIds': firestore.ArrayUnion([article_doc_id(self.job_id, entry_index) for entry_index, _ in group])
+        }, True))
+        return writes
+
+    def _is_applied(self, group):
+        # 記事・urlStats・ジョブは1つのバッチで書き込むため、記事が保存されていればまとまり全体が反映されている
+        refs = [self.articles_ref.document(article_doc_id(self.job_id, entry_index)) for entry_index, _ in group]
+        return all(doc.exists for doc in get_db().get_all(refs, field_paths=['createdAt']))
+
+    def _on_commit(self, group):
+        for url, count in (self._visit_increments or {}).items():
+            self._visit_counts[url] += count
+        self._visit_increments = None
+        article_ids = {entry_index: article_doc_id(self.job_id, entry_index) for entry_index, _ in group}
+        with self._lock:
+            self.article_ids.extend(article_ids.values())
+        try:
+            job_queue.record_committed(self.job_id, article_ids)
+        except Exception as e:
+            print(f"保存済みの記録中にエラー: {e}")
+        if self.on_commit:
+            self.on_commit()
+
+    def _on_error(self, group, error):
+        # 保存できなかったまとまりの visitNumber は使わない（次のまとまりが同じ番号から付ける）
+        self._visit_increments = None
+        with self._lock:
+            self.failed_count += len(group)
+
+    def close(self):
+        """
+        残りの記事を保存し、全てのコミットを待つ。
+        """
+        self.flush()
+        self.writer.close()
+
+# ジョブの進捗を書き込む最小間隔（秒）
+# ジョブキュー（SQLite、進捗ストリーム用）には短い間隔で、Firestoreのジョブドキュメントには長めの間隔で書き込む。
+JOB_PROGRESS_STREAM_INTERVAL = float(os.environ.get('JOB_PROGRESS_STREAM_INTERVAL', 0.5))
+JOB_PROGRESS_WRITE_INTERVAL = float(os.environ.get('JOB_PROGRESS_WRITE_INTERVAL', 3))
+
 # 重複したURLの除外と並列処理、データベースへの保存
-def process_and_summarize_history(history_data, user_id, job_id):
+# 予算を使い切って残ったエントリを処理する続きのジョブを、キューから取り出せるようになるまでの時間（秒）
+# 続きのジョブは作成日時の順に取り出されるため、待っている他のジョブより後になる（長く空ける必要はない）
+JOB_CONTINUATION_DELAY_SECONDS = float(os.environ.get('JOB_CONTINUATION_DELAY_SECONDS', 30))
+
+def enqueue_continuation_job(user_id, job_id, entries):
+    """
+    処理しきれなかったエントリを新しいジョブとしてキューに積み、そのジョブIDを返す。
+    アップロードと同じ受付の上限を守り、上限に達している場合は job_queue.JobRejectedError を送出する。
+    """
+    continuation_job_id = str(uuid.uuid4())
+    # 取り出せるようになるまで JOB_CONTINUATION_DELAY_SECONDS あるため、受付できてからジョブドキュメントを作る
+    job_queue.enqueue_job(continuation_job_id, user_id, entries, delay=JOB_CONTINUATION_DELAY_SECONDS)
+    get_db().collection('users').document(user_id).collection('jobs').document(continuation_job_id).set({
+        'status': 'queued',
+        'createdAt': firestore.SERVER_TIMESTAMP,
+        'newArticleIds': [],
+        'receivedCount': len(entries),
+        'continuationOf': job_id
+    })
+    print(f"➡️  {len(entries)}件のエントリを続きのジョブに回しました (Job: {continuation_job_id})")
+    return continuation_job_id
+
+def process_and_summarize_history(history_data, user_id, job_id, final_attempt=True):
+    """
+    履歴を処理して要約した記事を保存し、ジョブを完了にする。
+    Geminiのレート制限で要約できなかったエントリがある場合、final_attempt でなければ
+    GeminiUnavailableError を送出してジョブごと後で再試行させる（処理済みの分はチェックポイントから再開する）。
+    final_attempt の場合は要約できた記事だけを保存し、残りの件数を skippedCount に記録する。
+    エントリは candidate_scheduler の点数の高い順に処理し、ジョブの予算（処理時間・Gemini呼び出し回数）を
+    使い切った後のエントリは続きのジョブ（continuationJobId）に回す。
+    段階ごとの処理時間やエントリごとの結果は metrics に記録し、ジョブのドキュメントにも集計（metrics）を保存する。
+    """
+    with metrics.job_scope(metrics.JobMetrics()) as job_metrics:
+        try:
+            _process_history(history_data, user_id, job_id, final_attempt, job_metrics)
+        except Exception:
+            metrics.inc('history_jobs_total', result='error')
+            raise
+        metrics.inc('history_jobs_total', result='complete')
+        summary = job_metrics.summary()
+        stages = ', '.join(f"{stage} {values['seconds']:.1f}秒" for stage, values in summary['stages'].items())
+        print(f"⏱️ 処理時間: 合計 {summary['totalSeconds']:.1f}秒 ({stages}) / Gemini呼び出し {summary['llm']['calls']}回")
+
+def _process_history(history_data, user_id, job_id, final_attempt, job_metrics):
+    db = get_db()
     print(f"\n--- 履歴の処理を開始します (User: {user_id}, Job: {job_id}) ---")
+
+    # 重複確認の前に、キーワードで対象外のエントリをまとめて除外する
+    received_count = len(history_data)
+    with metrics.stage('prefilter'):
+        history_data = keyword_filter.default_matcher.filter_entries(history_data)
+    metrics.record_outcome('keyword_filtered', received_count - len(history_data))
+    print(f"キーワードによるフィルタリングで {received_count} 件中 {len(history_data)} 件が対象になりました。")
     
     candidate_urls = list(set(entry.get('url') for entry in history_data if entry.get('url')))
     if not candidate_urls:
         print("処理対象のURLがありません。")
         job_ref = db.collection('users').document(user_id).collection('jobs').document(job_id)
-        job_ref.update({'status': 'complete', 'completedAt': firestore.SERVER_TIMESTAMP})
+        job_ref.update({'status': 'complete', 'completedAt': firestore.SERVER_TIMESTAMP, 'metrics': job_metrics.summary()})
         return
 
     print(f"履歴から {len(candidate_urls)} 件のユニークなURLを抽出しました。")
@@ -248,100 +1515,687 @@ def process_and_summarize_history(history_data, user_id, job_id):
     start_of_today = datetime.combine(now.date(), time.min, tzinfo=timezone.utc)
 
     urls_already_processed_today = set()
-    chunk_size = 30
-    for i in range(0, len(candidate_urls), chunk_size):
-        chunk = candidate_urls[i:i + chunk_size]
+    with metrics.stage('dedupe_query'):
         try:
-            query = db.collection('users').document(user_id).collection('articles') \
-                      .where('originalUrl', 'in', chunk) \
-                      .where('createdAt', '>=', start_of_today)
-            
-            docs = query.stream()
-            for doc in docs:
-                urls_already_processed_today.add(doc.to_dict().get('originalUrl'))
+            seen_hashes = load_seen_url_hashes(user_id, start_of_today)
+            urls_already_processed_today = {url for url in candidate_urls if url_hash(url) in seen_hashes}
         except Exception as e:
             print(f"URLの存在確認中にエラー: {e}")
 
     if urls_already_processed_today:
         print(f"今日既に保存済みのURLが {len(urls_already_processed_today)} 件見つかりました。これらはスキップされます。")
 
-    entries_to_process = [entry for entry in history_data if entry.get('url') not in urls_already_processed_today]
+    # 前回の実行（ワーカーが途中で落ちたもの）で処理済みのエントリは再利用する
+    checkpointed = job_queue.load_progress(job_id)
+    committed = job_queue.load_committed(job_id)
+    if checkpointed:
+        print(f"チェックポイントから {len(checkpointed)} 件の処理結果を復元しました（保存済み: {len(committed)}件）。")
+
+    indexes_to_process = [
+        i for i, entry in enumerate(history_data)
+        if entry.get('url') not in urls_already_processed_today and i not in checkpointed
+    ]
+    # 点数の高いエントリから処理する（予算を使い切ったら残りは次のジョブに回す）
+    with metrics.stage('prioritize'):
+        indexes_to_process = candidate_scheduler.prioritize(
+            indexes_to_process, [history_data[i] for i in indexes_to_process], entry_visit_time
+        )
+    entries_to_process = [history_data[i] for i in indexes_to_process]
+    metrics.record_outcome('already_saved_today', sum(
+        1 for entry in history_data if entry.get('url') in urls_already_processed_today
+    ))
     
     print(f"新規処理対象の記事は {len(entries_to_process)} 件です。並列処理を開始します。")
-    if not entries_to_process:
+    if not entries_to_process and not any(checkpointed.values()):
         print("新規処理対象の記事はありませんでした。処理を終了します。")
         job_ref = db.collection('users').document(user_id).collection('jobs').document(job_id)
-        job_ref.update({'status': 'complete', 'completedAt': firestore.SERVER_TIMESTAMP, 'newArticleIds': []})
+        job_ref.update({
+            'status': 'complete',
+            'completedAt': firestore.SERVER_TIMESTAMP,
+            'newArticleIds': [],
+            'metrics': job_metrics.summary()
+        })
         return
 
-    summarized_articles = []
-    with ThreadPoolExecutor(max_workers=5) as executor:
-        future_to_entry = {executor.submit(process_and_summarize_entry, entry): entry for entry in entries_to_process}
-        for future in as_completed(future_to_entry):
-            result = future.result()
-            if result:
-                summarized_articles.append(result)
-
-    new_article_ids = []
-    if summarized_articles:
-        print(f"\n{len(summarized_articles)}件の記事の要約が完了しました。データベースに一括保存します。")
-        try:
-            user_articles_ref = db.collection('users').document(user_id).collection('articles')
-            batch = db.batch()
-            for article_data in summarized_articles:
-                article_data['createdAt'] = firestore.SERVER_TIMESTAMP
-                doc_ref = user_articles_ref.document()
-                batch.set(doc_ref, article_data)
-                new_article_ids.append(doc_ref.id)
-            batch.commit()
-            print(f"✅ {len(new_article_ids)}件の記事をFirestoreに保存しました。")
-        except Exception as e:
-            print(f"❌ Firestoreへのバッチ保存中にエラー: {e}")
+    job_ref = db.collection('users').document(user_id).collection('jobs').document(job_id)
+    total_count = len(indexes_to_process) + len(checkpointed)
+    progress = {'processed': len(checkpointed), 'lastStream': 0.0, 'lastWrite': 0.0}
+    progress_lock = threading.Lock()
+
+    def publish_progress(force=False):
+        """
+        処理件数・段階ごとの処理速度（件/秒）・保存済みの記事IDを、間隔を空けてジョブキューとジョブドキュメントに書き込む。
+        """
+        with progress_lock:
+            now_ts = time_module.monotonic()
+            stream_due = force or now_ts - progress['lastStream'] >= JOB_PROGRESS_STREAM_INTERVAL
+            write_due = force or now_ts - progress['lastWrite'] >= JOB_PROGRESS_WRITE_INTERVAL
+            if not (stream_due or write_due):
+                return
+            summary = job_metrics.summary()
+            elapsed = summary['totalSeconds']
+            snapshot = {
+                'processed': progress['processed'],
+                'total': total_count,
+                'saved': len(committer.article_ids),
+                'elapsedSeconds': elapsed,
+                'stages': {
+                    stage: {'count': values['count'], 'perSecond': round(values['count'] / elapsed, 2) if elapsed else 0.0}
+                    for stage, values in summary['stages'].items()
+                }
+            }
+            if stream_due:
+                progress['lastStream'] = now_ts
+                try:
+                    job_queue.record_job_progress(job_id, dict(snapshot, articleIds=list(committer.article_ids)))
+                except Exception as e:
+                    print(f"ジョブの進捗記録中にエラー: {e}")
+            if write_due:
+                progress['lastWrite'] = now_ts
+                try:
+                    job_ref.update({'processedCount': progress['processed'], 'totalCount': total_count, 'progress': snapshot})
+                except Exception as e:
+                    print(f"ジョブの進捗更新中にエラー: {e}")
+
+    # 要約が終わった記事から順に保存する（前回保存できなかった記事も含める）
+    committer = ArticleCommitter(user_id, job_id, start_of_today, on_commit=publish_progress)
+    committer.article_ids.extend(committed.values())
+    publish_progress(force=True)
+    for entry_index, article in sorted(checkpointed.items()):
+        if article and entry_index not in committed:
+            committer.add(entry_index, article)
+
+    def on_entry_done(position, article):
+        entry_index = indexes_to_process[position]
+        job_queue.record_progress(job_id, entry_index, article)
+        if article:
+            committer.add(entry_index, article)
+        else:
+            committer.flush_if_due()
+        progress['processed'] += 1
+        publish_progress(force=progress['processed'] == total_count)
+
+    skipped_count = 0
+    budget = candidate_scheduler.JobBudget(job_metrics)
+    try:
+        if entries_to_process:
+            try:
+                with metrics.stage('pipeline'):
+                    asyncio.run(run_history_pipeline(entries_to_process, on_entry_done, budget))
+            except gemini_client.GeminiUnavailableError as e:
+                if not final_attempt:
+                    raise
+                print(f"⚠️ 再試行の上限に達したため、要約できた記事だけを保存します: {e}")
+                skipped_count = total_count - len(job_queue.load_progress(job_id))
+    finally:
+        # 中断する場合も、要約できた分は保存してから再試行に回す
+        with metrics.stage('batch_commit'):
+            committer.close()
+        publish_progress(force=True)
+
+    new_article_ids = committer.article_ids
+    if committer.failed_count:
+        if not final_attempt:
+            raise batch_writer.BatchCommitError(f"{committer.failed_count}件の記事を保存できませんでした")
+        print(f"❌ {committer.failed_count}件の記事を保存できませんでした。")
+    if new_article_ids:
+        print(f"✅ {len(new_article_ids)}件の記事をFirestoreに保存しました。")
     else:
         print("要約対象の記事は見つかりませんでした。")
+
+    # 予算を使い切って処理しなかったエントリは、次のジョブに回す
+    # （Geminiを呼び出せずに打ち切った場合は skippedCount に含まれているため回さない）
+    completion = {}
+    if budget.deferred and not skipped_count:
+        deferred_entries = [entries_to_process[position] for position in sorted(set(budget.deferred))]
+        try:
+            completion['continuationJobId'] = enqueue_continuation_job(user_id, job_id, deferred_entries)
+            completion['deferredCount'] = len(deferred_entries)
+        except job_queue.JobRejectedError as e:
+            print(f"⚠️ 受付の上限に達しているため、続きのジョブを作成できませんでした: {e}")
+            skipped_count += len(deferred_entries)
+        except Exception as e:
+            print(f"❌ 続きのジョブの作成中にエラー: {e}")
+            skipped_count += len(deferred_entries)
     
     try:
-        job_ref = db.collection('users').document(user_id).collection('jobs').document(job_id)
-        job_ref.update({
+        job_ref.update(dict(completion, **{
             'status': 'complete',
             'newArticleIds': new_article_ids,
+            'skippedCount': skipped_count + committer.failed_count,
+            'metrics': job_metrics.summary(),
             'completedAt': firestore.SERVER_TIMESTAMP
-        })
+        }))
         print(f"✅ ジョブが完了しました (Job: {job_id})。新規記事: {len(new_article_ids)}件")
     except Exception as e:
         print(f"❌ ジョブの更新中にエラー: {e}")
     print("\n--- 全ての処理が完了しました ---")
 
 
+# おすすめ候補の管理
+# S/Aティアの振り返り、または「後で見る」が設定された記事のIDを
+# users/{uid}/recommendations/candidates にまとめて持ち、おすすめ生成時に記事を全件読まずに済ませる。
+HIGH_VALUE_TIERS = ('tier-s', 'tier-a')
+
+def _recommendation_candidates_ref(user_id):
+    return get_db().collection('users').document(user_id).collection('recommendations').document('candidates')
+
+def is_recommendation_candidate(article_data):
+    reflection = article_data.get('reflection') or {}
+    return reflection.get('usefulness') in HIGH_VALUE_TIERS or bool(article_data.get('readLater'))
+
+def update_recommendation_candidate(user_id, article_id, article_data, batch=None):
+    """
+    記事の状態に合わせて、おすすめ候補に追加または候補から削除する。削除された記事は article_data に None を渡す。
+    """
+    if article_data and is_recommendation_candidate(article_data):
+        value = firestore.ArrayUnion([article_id])
+    else:
+        value = firestore.ArrayRemove([article_id])
+    candidates_ref = _recommendation_candidates_ref(user_id)
+    if batch:
+        batch.set(candidates_ref, {'articleIds': value}, merge=True)
+    else:
+        candidates_ref.set({'articleIds': value}, merge=True)
+
+def load_recommendation_candidates(user_id):
+    """
+    おすすめ候補の記事IDを返す。候補ドキュメントがまだなければ記事から作成する。
+    """
+    candidates_ref = _recommendation_candidates_ref(user_id)
+    candidates_doc = candidates_ref.get()
+    # 作成前に追加・削除だけが行われた場合もあるため、initialized で作成済みかどうかを判定する
+    if candidates_doc.exists and candidates_doc.to_dict().get('initialized'):
+        return candidates_doc.to_dict().get('articleIds', [])
+
+    articles_ref = get_db().collection('users').document(user_id).collection('articles')
+    candidate_ids = set()
+    for tier in HIGH_VALUE_TIERS:
+        candidate_ids.update(doc.id for doc in articles_ref.where('reflection.usefulness', '==', tier).select([]).stream())
+    candidate_ids.update(doc.id for doc in articles_ref.where('readLater', '==', True).select([]).stream())
+    candidate_ids = sorted(candidate_ids)
+    candidates_ref.set({'articleIds': candidate_ids, 'initialized': True})
+    return candidate_ids
+
+# タグなどの件数（ファセット）
+# users/{uid}/facets/articles に、タグごとの記事数（tags）・「後で見る」の件数（readLater）・
+# ティアごとの件数（tiers）・記事の総数（total）を持ち、記事の作成・削除・振り返り・「後で見る」の切り替えと同じバッチで加算する。
+# 加算がずれた場合に備え、FACET_RECONCILE_SECONDS ごと（と reconcile-facets コマンド）に記事から数え直す。
+# 数え直しは全記事を読むため、画面の表示では保存済みの値を返し、ワーカーに依頼して裏で行う。
+FACETS_VERSION = 1
+FACET_RECONCILE_SECONDS = float(os.environ.get('FACET_RECONCILE_SECONDS', 7 * 24 * 60 * 60))
+FACET_FIELDS = ['tags', 'readLater', 'reflection.usefulness']
+
+def _facets_ref(user_id):
+    return get_db().collection('users').document(user_id).collection('facets').document('articles')
+
+def _count_facets(articles, sign=1, counts=None):
+    counts = counts or {'tags': {}, 'tiers': {}, 'readLater': 0, 'total': 0}
+    for article_data in articles:
+        counts['total'] += sign
+        for tag in set(article_data.get('tags') or []):
+            if tag:
+                counts['tags'][tag] = counts['tags'].get(tag, 0) + sign
+        tier = (article_data.get('reflection') or {}).get('usefulness')
+        if tier:
+            counts['tiers'][tier] = counts['tiers'].get(tier, 0) + sign
+        if article_data.get('readLater'):
+            counts['readLater'] += sign
+    return counts
+
+def facet_changes(before=(), after=()):
+    """
+    記事の変更（変更前の記事のリスト → 変更後の記事のリスト）でファセットに加算する値を返す。変化がなければ None。
+    """
+    counts = _count_facets(after, 1, _count_facets(before, -1))
+    changes = {}
+    for key in ('tags', 'tiers'):
+        increments = {name: firestore.Increment(count) for name, count in counts[key].items() if count}
+        if increments:
+            changes[key] = increments
+    for key in ('readLater', 'total'):
+        if counts[key]:
+            changes[key] = firestore.Increment(counts[key])
+    return changes or None
+
+def update_facets(user_id, before, after, batch):
+    changes = facet_changes(before, after)
+    if changes:
+        batch.set(_facets_ref(user_id), changes, merge=True)
+
+def reconcile_facets(user_id):
+    """
+    全ての記事からファセットを数え直して保存し、その値を返す。
+    """
+    articles_ref = get_db().collection('users').document(user_id).collection('articles')
+    articles = [doc.to_dict() for doc in articles_ref.select(FACET_FIELDS).stream()]
+    counts = _count_facets(articles)
+    facets = dict(counts, version=FACETS_VERSION, reconciledAt=datetime.now(timezone.utc))
+    _facets_ref(user_id).set(facets)
+    print(f"✅ ファセットを数え直しました (User: {user_id}, 記事: {counts['total']}件, タグ: {len(counts['tags'])}件)")
+    return facets
+
+def load_facets(user_id):
+    """
+    ファセットを返す（1回の読み込み）。件数が0以下のタグ・ティアは除く。
+    まだ作成されていない場合や、前回数え直してから FACET_RECONCILE_SECONDS 以上経っている場合は
+    ワーカーに数え直しを依頼し、数え直しが終わるまでは保存済みの値（なければ0件）を返す。
+    """
+    doc = _facets_ref(user_id).get()
+    facets = (doc.to_dict() or {}) if doc.exists else {}
+    reconciled_at = facets.get('reconciledAt')
+    if (
+        facets.get('version') != FACETS_VERSION or not reconciled_at
+        or (datetime.now(timezone.utc) - reconciled_at).total_seconds() >= FACET_RECONCILE_SECONDS
+    ):
+        try:
+            job_queue.request_maintenance(user_id, 'facets')
+        except Exception as e:
+            print(f"ファセットの数え直しの依頼中にエラー: {e}")
+    return {
+        'tags': {tag: count for tag, count in (facets.get('tags') or {}).items() if count > 0},
+        'tiers': {tier: count for tier, count in (facets.get('tiers') or {}).items() if count > 0},
+        'readLater': max(facets.get('readLater') or 0, 0),
+        'total': max(facets.get('total') or 0, 0)
+    }
+
+def load_articles_by_ids(user_id, article_ids, field_paths=None):
+    """
+    記事IDのリストに対応する記事を1回のまとめ読みで取得し、IDの順に返す（存在しない記事は除く）。
+    """
+    if not article_ids:
+        return []
+    db = get_db()
+    articles_ref = db.collection('users').document(user_id).collection('articles')
+    refs = [articles_ref.document(article_id) for article_id in article_ids]
+    found = {}
+    for doc in db.get_all(refs, field_paths=field_paths):
+        if doc.exists:
+            article_data = doc.to_dict()
+            article_data['id'] = doc.id
+            found[doc.id] = article_data
+    return [found[article_id] for article_id in article_ids if article_id in found]
+
+# 記事のベクトルによるおすすめ・関連記事
+# 記事の保存時に recommender のベクトル（vector）を記事に保存しておき、ユーザーごとの VectorIndex に
+# プロセス内でまとめて持つ。初回は全記事のベクトルだけを読み込み、以降は新しく作成された記事だけを追加で読む。
+VECTOR_INDEX_MAX_USERS = int(os.environ.get('VECTOR_INDEX_MAX_USERS', 64))
+VECTOR_INDEX_REFRESH_SECONDS = float(os.environ.get('VECTOR_INDEX_REFRESH_SECONDS', 30))
+# 別のプロセスで削除された記事を反映するため、この間隔で全件読み直す
+VECTOR_INDEX_REBUILD_SECONDS = float(os.environ.get('VECTOR_INDEX_REBUILD_SECONDS', 60 * 60))
+# コミットの順序の前後で取りこぼさないよう、追加の読み込みは最後に読んだ作成日時より少し前から行う
+VECTOR_INDEX_OVERLAP = timedelta(seconds=60)
+RECOMMENDATION_COUNT = 3
+# おすすめの基準にする、最近の振り返りの件数とティアごとの重み
+RECOMMENDATION_PROFILE_SIZE = 20
+RECOMMENDATION_TIER_WEIGHTS = {'tier-s': 1.0, 'tier-a': 0.7}
+RELATED_ARTICLE_COUNT = 5
+
+_vector_indexes = OrderedDict()
+_vector_indexes_lock = threading.Lock()
+
+def set_article_vector(article_data):
+    article_data['vector'] = recommender.encode_vector(recommender.article_vector(article_data))
+    article_data['vectorVersion'] = recommender.VECTOR_VERSION
+
+def _load_article_vectors(user_id, since=None):
+    """
+    記事のベクトルを {記事ID: ベクトル} で返す。since を指定するとそれ以降に作成された記事だけを読む。
+    ベクトルがない（または古い）記事は、タイトル・要約・タグから作り直して保存する。
+    """
+    articles_ref = get_db().collection('users').document(user_id).collection('articles')
+    query = articles_ref.where('createdAt', '>=', since) if since else articles_ref
+    vectors = {}
+    missing_ids = []
+    last_created_at = None
+    for doc in query.select(['vector', 'vectorVersion', 'createdAt']).stream():
+        created_at = doc.get('createdAt')
+        if created_at and (last_created_at is None or created_at > last_created_at):
+            last_created_at = created_at
+        vector = recommender.decode_vector(doc.get('vector')) if doc.get('vectorVersion') == recommender.VECTOR_VERSION else None
+        if vector is None:
+            missing_ids.append(doc.id)
+        else:
+            vectors[doc.id] = vector
+
+    if missing_ids:
+        writer = batch_writer.BatchWriter(get_db())
+        writes = []
+        for article_data in load_articles_by_ids(user_id, missing_ids, field_paths=['generatedTitle', 'summary', 'tags']):
+            set_article_vector(article_data)
+            vectors[article_data['id']] = recommender.decode_vector(article_data['vector'])
+            writes.append(('update', articles_ref.document(article_data['id']), {
+                'vector': article_data['vector'], 'vectorVersion': article_data['vectorVersion']
+            }, False))
+        writer.submit(writes)
+        writer.close()
+        print(f"記事のベクトルを {len(writes)} 件作成しました (User: {user_id})")
+    return vectors, last_created_at
+
+def get_vector_index(user_id):
+    """
+    ユーザーの VectorIndex を返す。VECTOR_INDEX_REFRESH_SECONDS ごとに新しい記事を追加し、
+    VECTOR_INDEX_REBUILD_SECONDS ごとに作り直す。
+    """
+    now = time_module.monotonic()
+    with _vector_indexes_lock:
+        entry = _vector_indexes.get(user_id)
+        if entry:
+            _vector_indexes.move_to_end(user_id)
+
+    if entry is None or now - entry['loadedAt'] >= VECTOR_INDEX_REBUILD_SECONDS:
+        index = recommender.VectorIndex()
+        vectors, last_created_at = _load_article_vectors(user_id)
+        for article_id, vector in vectors.items():
+            index.add(article_id, vector)
+        entry = {'index': index, 'loadedAt': now, 'refreshedAt': now, 'lastCreatedAt': last_created_at}
+        with _vector_indexes_lock:
+            _vector_indexes[user_id] = entry
+            while len(_vector_indexes) > VECTOR_INDEX_MAX_USERS:
+                _vector_indexes.popitem(last=False)
+    elif now - entry['refreshedAt'] >= VECTOR_INDEX_REFRESH_SECONDS:
+        since = entry['lastCreatedAt'] - VECTOR_INDEX_OVERLAP if entry['lastCreatedAt'] else None
+        vectors, last_created_at = _load_article_vectors(user_id, since)
+        for article_id, vector in vectors.items():
+            entry['index'].add(article_id, vector)
+        entry['refreshedAt'] = now
+        if last_created_at and (entry['lastCreatedAt'] is None or last_created_at > entry['lastCreatedAt']):
+            entry['lastCreatedAt'] = last_created_at
+    return entry['index']
+
+def forget_article_vector(user_id, article_id):
+    with _vector_indexes_lock:
+        entry = _vector_indexes.get(user_id)
+    if entry:
+        entry['index'].remove(article_id)
+
+def recommend_article_ids(user_id, candidate_ids):
+    """
+    おすすめ候補の中から、最近S/Aティアを付けた振り返りの記事に似たものを RECOMMENDATION_COUNT 件選ぶ。
+    振り返りがまだない場合はランダムに選ぶ。
+    """
+    candidates = load_articles_by_ids(user_id, candidate_ids, field_paths=['reflection.usefulness', 'updatedAt'])
+    reflected = [
+        article for article in candidates
+        if (article.get('reflection') or {}).get('usefulness') in RECOMMENDATION_TIER_WEIGHTS
+    ]
+    reflected.sort(key=lambda article: article.get('updatedAt') or datetime.min.replace(tzinfo=timezone.utc), reverse=True)
+    profile = reflected[:RECOMMENDATION_PROFILE_SIZE]
+
+    index = get_vector_index(user_id)
+    query_vectors, query_weights = [], []
+    for article in profile:
+        vector = index.vector(article['id'])
+        if vector is not None:
+            query_vectors.append(vector)
+            query_weights.append(RECOMMENDATION_TIER_WEIGHTS[article['reflection']['usefulness']])
+    if not query_vectors:
+        return random.sample(candidate_ids, RECOMMENDATION_COUNT)
+
+    # 最近振り返ったばかりの記事は除く（候補が足りなくなる場合は除かない）
+    profile_ids = {article['id'] for article in profile}
+    pool = [article['id'] for article in candidates if article['id'] not in profile_ids]
+    if len(pool) < RECOMMENDATION_COUNT:
+        pool = [article['id'] for article in candidates]
+    recommended = index.rank(query_vectors, query_weights, candidate_ids=pool, limit=RECOMMENDATION_COUNT)
+    if len(recommended) < RECOMMENDATION_COUNT:
+        # ベクトルがまだない候補があると MMR で選べる数が足りなくなるので、
+        # 候補全体を似ている順に並べた中から補い、それでも足りない分はベクトルのない候補から選ぶ
+        ranked = index.rank(query_vectors, query_weights, candidate_ids=candidate_ids, limit=len(candidate_ids), diversity=0)
+        rest = [article_id for article_id in ranked if article_id not in recommended]
+        unindexed = [article_id for article_id in candidate_ids if article_id not in index and article_id not in recommended]
+        rest += random.sample(unindexed, len(unindexed))
+        recommended += rest[:RECOMMENDATION_COUNT - len(recommended)]
+    return recommended
+
+def related_article_ids(user_id, article_id, article_data):
+    index = get_vector_index(user_id)
+    vector = index.vector(article_id)
+    if vector is None:
+        vector = recommender.article_vector(article_data)
+    return index.rank([vector], exclude_ids={article_id}, limit=RELATED_ARTICLE_COUNT)
+
+# 記事検索用のインデックス
+# 記事ごとにフィールド別のn-gram（1文字・2文字）を searchTokens に持たせ、Firestoreの配列インデックスで候補を絞り込む。
+# 接頭辞は t: タイトル / g: タグ / r: 振り返り / s: 要約（2文字だけ）。「すべて」検索はこれらをまとめて探す。
+# 配列とそのインデックスが大きくなりすぎないよう、振り返り・要約は先頭の SEARCH_FIELD_MAX_CHARS 文字だけを対象にし、
+# トークンの数も SEARCH_MAX_TOKENS 個までにする（タイトル・タグ・振り返り・要約の順に優先）。
+# 候補を絞り込んだ後は元の部分一致の条件で判定するため、対象外の部分だけに一致する記事は検索に出ない。
+# バージョン1の記事（a: タイトル+要約+振り返り）も「すべて」検索で見つかるよう、a: も一緒に探す。
+SEARCH_INDEX_VERSION = 2
+SEARCH_FIELD_MAX_CHARS = int(os.environ.get('SEARCH_FIELD_MAX_CHARS', 300))
+SEARCH_MAX_TOKENS = int(os.environ.get('SEARCH_MAX_TOKENS', 600))
+SEARCH_PREFIXES = {'tag': ['g'], 'title': ['t'], 'reflection': ['r'], 'all': ['t', 'g', 'r', 's', 'a']}
+SEARCH_PAGE_SIZE = int(os.environ.get('SEARCH_PAGE_SIZE', 30))
+# 一覧表示用に読み込むフィールド（要約全文・振り返り本文・OGPの画像以外は読まない）
+ARTICLE_PAGE_SIZE = int(os.environ.get('ARTICLE_PAGE_SIZE', 30))
+ARTICLE_LIST_FIELDS = ['generatedTitle', 'originalUrl', 'ogp.image', 'tags', 'readLater', 'reflection.usefulness', 'createdAt', 'visitNumber']
+ARTICLE_SEARCH_FIELDS = ['generatedTitle', 'originalUrl', 'ogp.image', 'tags', 'readLater', 'reflection', 'summary', 'createdAt', 'visitNumber']
+SEARCH_FETCH_SIZE = 100
+COMMON_SEARCH_CHARS = re.compile(r'[\sぁ-んー、。・]')
+
+def _ngrams(text, sizes=(1, 2)):
+    # 先頭に近い順に並べる（トークンの数を制限する場合に先頭側を残すため）
+    grams = {}
+    for i in range(len(text)):
+        for size in sizes:
+            gram = text[i:i + size]
+            if len(gram) == size and gram.strip():
+                grams[gram] = True
+    return list(grams)
+
+def _reflection_text(article_data):
+    reflection = article_data.get('reflection')
+    if not isinstance(reflection, dict):
+        return ""
+    return ''.join((reflection.get(key) or '').lower() for key in ['specific_impression', 'why_important', 'what_i_got', 'memo'])
+
+def build_search_tokens(article_data):
+    """
+    記事の検索用トークン（フィールド接頭辞付きのn-gram）を作る。
+    """
+    title = (article_data.get('generatedTitle') or '').lower()
+    summary = (article_data.get('summary') or '').lower()[:SEARCH_FIELD_MAX_CHARS]
+    reflection_text = _reflection_text(article_data)[:SEARCH_FIELD_MAX_CHARS]
+
+    tokens = {}
+    candidates = [f't:{gram}' for gram in _ngrams(title)]
+    for tag in article_data.get('tags') or []:
+        candidates += [f'g:{gram}' for gram in _ngrams(tag.lower())]
+    candidates += [f'r:{gram}' for gram in _ngrams(reflection_text)]
+    candidates += [f's:{gram}' for gram in _ngrams(summary, sizes=(2,))]
+    for token in candidates:
+        if len(tokens) >= SEARCH_MAX_TOKENS:
+            break
+        tokens[token] = True
+    return sorted(tokens)
+
+def article_matches_keyword(article_data, keyword_lower, search_type):
+    gen_title = (article_data.get('generatedTitle') or '').lower()
+    summary = (article_data.get('summary') or '').lower()
+    tags = [t.lower() for t in article_data.get('tags') or []]
+    reflection_text = _reflection_text(article_data)
+
+    if search_type == 'tag':
+        return any(keyword_lower in tag for tag in tags)
+    elif search_type == 'title':
+        return keyword_lower in gen_title
+    elif search_type == 'reflection':
+        return keyword_lower in reflection_text
+    search_corpus = gen_title + summary + reflection_text
+    return (keyword_lower in search_corpus) or any(keyword_lower in tag for tag in tags)
+
+def _pick_search_gram(keyword_lower):
+    # ひらがな・記号だけのn-gramはほぼ全記事に含まれるため、できるだけ避ける
+    grams = [keyword_lower[i:i + 2] for i in range(len(keyword_lower) - 1) if keyword_lower[i:i + 2].strip()]
+    grams = grams or [c for c in keyword_lower if c.strip()]
+    if not grams:
+        return None
+    distinctive = [gram for gram in grams if not COMMON_SEARCH_CHARS.search(gram)]
+    return (distinctive or grams)[0]
+
+def ensure_search_index(user_id):
+    """
+    検索インデックスがない（または古い）記事の searchTokens を作り直す（ユーザーごとにバージョンが変わったときだけ実行）。
+    全記事を読み書きするため、Webのリクエストでは呼ばず、ワーカーのジョブ（と backfill-search-index コマンド）で行う。
+    """
+    db = get_db()
+    user_ref = db.collection('users').document(user_id)
+    user_doc = user_ref.get()
+    if user_doc.exists and (user_doc.to_dict() or {}).get('searchIndexVersion') == SEARCH_INDEX_VERSION:
+        return
+
+    print(f"検索インデックスを作成します (User: {user_id})")
+    batch = db.batch()
+    pending = 0
+    fields = ['generatedTitle', 'summary', 'tags', 'reflection']
+    for doc in user_ref.collection('articles').select(fields).stream():
+        batch.update(doc.reference, {'searchTokens': build_search_tokens(doc.to_dict())})
+        pending += 1
+        if pending >= 400:
+            batch.commit()
+            batch = db.batch()
+            pending = 0
+    if pending:
+        batch.commit()
+    user_ref.set({'searchIndexVersion': SEARCH_INDEX_VERSION}, merge=True)
+
+def attach_visit_numbers(user_id, articles):
+    """
+    記事ごとに、同じURLの記事の中で何回目の学習か（visit_number）と再訪かどうか（is_repeat）を付与する。
+    保存時に記録した visitNumber と urlStats を使い、記録がない古い記事だけ同じURLの記事を数えて求める。
+    """
+    counts = get_url_visit_counts(user_id, [article['originalUrl'] for article in articles if article.get('originalUrl')])
+    missing = []
+    for article in articles:
+        if article.get('visitNumber'):
+            article['visit_number'] = article['visitNumber']
+            article['is_repeat'] = counts.get(article.get('originalUrl'), 0) > 1
+        else:
+            missing.append(article)
+    if missing:
+        _count_visit_numbers(user_id, missing)
+    return articles
+
+def _count_visit_numbers(user_id, articles):
+    urls = list({article.get('originalUrl') for article in articles if article.get('originalUrl')})
+    created_by_url = {}
+    articles_ref = get_db().collection('users').document(user_id).collection('articles')
+    for i in range(0, len(urls), 30):
+        query = articles_ref.where('originalUrl', 'in', urls[i:i + 30]).select(['originalUrl', 'createdAt'])
+        for doc in query.stream():
+            data = doc.to_dict()
+            created_by_url.setdefault(data.get('originalUrl'), []).append((data.get('createdAt'), doc.id))
+
+    for article in articles:
+        visits = sorted(created_by_url.get(article.get('originalUrl'), []), key=lambda v: (v[0] is not None, v[0] or 0, v[1]))
+        visit_ids = [doc_id for _, doc_id in visits]
+        article['visit_number'] = visit_ids.index(article['id']) + 1 if article['id'] in visit_ids else 1
+        article['is_repeat'] = len(visit_ids) > 1
+
+def _cursor_snapshot(articles_ref, cursor):
+    if not cursor:
+        return None
+    cursor_doc = articles_ref.document(cursor).get(field_paths=['createdAt'])
+    return cursor_doc if cursor_doc.exists else None
+
+def list_articles(user_id, tag_filter=None, cursor=None, page_size=ARTICLE_PAGE_SIZE):
+    """
+    タグ・「後で見る」で絞り込んだ記事を新しい順に1ページ分返す。(記事のリスト, 次ページ用のカーソル) を返す。
+    一覧表示に必要なフィールドだけを読み込む。
+    """
+    articles_ref = get_db().collection('users').document(user_id).collection('articles')
+    
+    if tag_filter:
+        if tag_filter == 'readLater':
+            query = articles_ref.where('readLater', '==', True).order_by('createdAt', direction=firestore.Query.DESCENDING)
+        else:
+            query = articles_ref.where('tags', 'array_contains', tag_filter).order_by('createdAt', direction=firestore.Query.DESCENDING)
+    else:
+        query = articles_ref.order_by('createdAt', direction=firestore.Query.DESCENDING)
+    query = query.select(ARTICLE_LIST_FIELDS)
+
+    cursor_doc = _cursor_snapshot(articles_ref, cursor)
+    if cursor_doc:
+        query = query.start_after(cursor_doc)
+
+    docs = list(query.limit(page_size + 1).stream())
+    next_cursor = docs[page_size - 1].id if len(docs) > page_size else None
+
+    articles = []
+    for doc in docs[:page_size]:
+        article_data = doc.to_dict()
+        article_data['id'] = doc.id
+        articles.append(article_data)
+    return attach_visit_numbers(user_id, articles), next_cursor
+
+def search_articles(user_id, keyword_query, search_type='all', tag_filter=None, cursor=None, page_size=SEARCH_PAGE_SIZE):
+    """
+    検索インデックスを使って記事を検索し、(記事のリスト, 次ページ用のカーソル) を返す。
+    インデックスで絞り込んだ候補に対して、元の部分一致の条件で最終的な判定を行う。
+    """
+    keyword_lower = keyword_query.lower()
+    gram = _pick_search_gram(keyword_lower)
+    if not gram:
+        return [], None
+
+    prefixes = SEARCH_PREFIXES.get(search_type, SEARCH_PREFIXES['all'])
+    if len(gram) == 1:
+        # 要約は2文字のn-gramだけを持つ
+        prefixes = [prefix for prefix in prefixes if prefix != 's']
+    articles_ref = get_db().collection('users').document(user_id).collection('articles')
+    query = articles_ref.where('searchTokens', 'array_contains_any', [f'{prefix}:{gram}' for prefix in prefixes])
+    if tag_filter == 'readLater':
+        query = query.where('readLater', '==', True)
+    query = query.order_by('createdAt', direction=firestore.Query.DESCENDING).select(ARTICLE_SEARCH_FIELDS)
+
+    last_doc = _cursor_snapshot(articles_ref, cursor)
+
+    articles = []
+    next_cursor = None
+    while True:
+        page_query = query.start_after(last_doc) if last_doc else query
+        docs = list(page_query.limit(SEARCH_FETCH_SIZE).stream())
+        for doc in docs:
+            last_doc = doc
+            article_data = doc.to_dict()
+            if tag_filter and tag_filter != 'readLater' and tag_filter not in (article_data.get('tags') or []):
+                continue
+            if not article_matches_keyword(article_data, keyword_lower, search_type):
+                continue
+            article_data['id'] = doc.id
+            articles.append(article_data)
+            if len(articles) >= page_size:
+                next_cursor = doc.id
+                break
+        if next_cursor or len(docs) < SEARCH_FETCH_SIZE:
+            break
+
+    return attach_visit_numbers(user_id, articles), next_cursor
+
+
 @app.route('/')
 def index():
     id_token = request.cookies.get('firebaseToken')
     if id_token:
         try:
-            auth.verify_id_token(id_token)
+            verify_id_token_cached(id_token)
             return redirect(url_for('dashboard'))
         except:
             return render_template('login.html')
     return render_template('login.html')
 
-# @app.route('/select')
-# @login_required_for_web
-# def select_view():
-#     user_id = g.user_id
-#     try:
-#         articles_ref = db.collection('users').document(user_id).collection('articles').stream()
-#         all_tags = set()
-#         for doc in articles_ref:
-#             article_data = doc.to_dict()
-#             if 'tags' in article_data and article_data['tags']:
-#                 for tag in article_data['tags']:
-#                     all_tags.add(tag)
-#         sorted_tags = sorted(list(all_tags))
-#         return render_template('select_view.html', tags=sorted_tags, user_email=g.user.email)
-#     except Exception as e:
-#         print(f"❌ タグ一覧の取得エラー: {e}")
-#         return "タグの取得中にエラーが発生しました。", 500
-
+@app.route('/select')
+@login_required_for_web
+def select_view():
+    user_id = g.user_id
+    try:
+        facets = load_facets(user_id)
+        sorted_tags = sorted(facets['tags'].items(), key=lambda item: (-item[1], item[0]))
+        return render_template('select_view.html', tags=sorted_tags, facets=facets, user_email=g.user.email)
+    except Exception as e:
+        print(f"❌ タグ一覧の取得エラー: {e}")
+        return "タグの取得中にエラーが発生しました。", 500
 
 @app.route('/dashboard')
 @login_required_for_web
@@ -354,101 +2208,35 @@ def dashboard():
     try:
         recommended_articles = []
         recommended_ids = []
-        recommendation_ref = db.collection('users').document(user_id).collection('recommendations').document('weekly')
+        recommendation_ref = get_db().collection('users').document(user_id).collection('recommendations').document('weekly')
         recommendation_doc = recommendation_ref.get()
 
         if recommendation_doc.exists:
             recommended_ids = recommendation_doc.to_dict().get('articleIds', [])
-            if recommended_ids:
-                articles_ref_for_rec = db.collection('users').document(user_id).collection('articles')
-                for article_id in recommended_ids:
-                    doc = articles_ref_for_rec.document(article_id).get()
-                    if doc.exists:
-                        article_data = doc.to_dict()
-                        article_data['id'] = doc.id
-                        if 'createdAt' in article_data and article_data['createdAt']:
-                            article_data['formatted_date'] = article_data['createdAt'].strftime('%Y-%m-%d')
-                        recommended_articles.append(article_data)
-
-        articles_ref = db.collection('users').document(user_id).collection('articles')
-        
-        if tag_filter:
-            if tag_filter == 'readLater':
-                query = articles_ref.where('readLater', '==', True).order_by('createdAt', direction=firestore.Query.DESCENDING)
-            else:
-                query = articles_ref.where('tags', 'array_contains', tag_filter).order_by('createdAt', direction=firestore.Query.DESCENDING)
-        else:
-            query = articles_ref.order_by('createdAt', direction=firestore.Query.DESCENDING)
-        
-        docs = list(query.stream())
-        
-        url_counts = {}
-        for doc in docs:
-            url = doc.to_dict().get('originalUrl')
-            if url:
-                url_counts[url] = url_counts.get(url, 0) + 1
+            recommended_articles = load_articles_by_ids(user_id, recommended_ids, field_paths=ARTICLE_LIST_FIELDS)
+            for article_data in recommended_articles:
+                if 'createdAt' in article_data and article_data['createdAt']:
+                    article_data['formatted_date'] = article_data['createdAt'].strftime('%Y-%m-%d')
 
-        articles = []
-        seen_url_counter = {}
+        articles, next_cursor = load_article_page(user_id, tag_filter, keyword_query, search_type, request.args.get('after'))
 
-        for doc in docs:
-            article_data = doc.to_dict()
-            article_id = doc.id
-            url = article_data.get('originalUrl')
-            total_visits = url_counts.get(url, 0)
-            already_seen_count = seen_url_counter.get(url, 0)
-            
-            visit_number = total_visits - already_seen_count
-            seen_url_counter[url] = already_seen_count + 1
-
-            article_data['visit_number'] = visit_number
-            article_data['is_repeat'] = total_visits > 1
-            article_data['id'] = article_id
-
-            if keyword_query:
-                keyword_lower = keyword_query.lower()
-                is_match = False
-
-                gen_title = article_data.get('generatedTitle', '').lower()
-                orig_title = article_data.get('originalUrl', '').lower() 
-                summary = article_data.get('summary', '').lower()
-                tags = [t.lower() for t in article_data.get('tags', [])]
-
-                reflection_text = ""
-                if 'reflection' in article_data and isinstance(article_data['reflection'], dict):
-                    r = article_data['reflection']
-                    reflection_text += r.get('specific_impression', '').lower()
-                    reflection_text += r.get('why_important', '').lower()
-                    reflection_text += r.get('what_i_got', '').lower()
-                    reflection_text += r.get('memo', '').lower()
-
-                if search_type == 'tag':
-                    is_match = any(keyword_lower in tag for tag in tags)
-                elif search_type == 'title':
-                    is_match = (keyword_lower in gen_title)
-                elif search_type == 'reflection':
-                    is_match = (keyword_lower in reflection_text)
-                else:
-                    search_corpus = gen_title + summary + reflection_text
-                    is_match = (keyword_lower in search_corpus) or any(keyword_lower in tag for tag in tags)
-
-                if not is_match:
-                    continue
-
-            if 'createdAt' in article_data and article_data['createdAt']:
-                article_data['formatted_date'] = article_data['createdAt'].strftime('%Y-%m-%d')
-            else:
-                article_data['formatted_date'] = '日付なし'
-            
-            articles.append(article_data)
+        filter_count = None
+        if tag_filter and not keyword_query:
+            try:
+                facets = load_facets(user_id)
+                filter_count = facets['readLater'] if tag_filter == 'readLater' else facets['tags'].get(tag_filter, 0)
+            except Exception as e:
+                print(f"ファセットの取得中にエラー: {e}")
 
         return render_template('dashboard.html', 
                                user_email=g.user.email, 
                                articles=articles,
                                recommended_articles=recommended_articles,
                                current_filter=tag_filter,
+                               filter_count=filter_count,
                                keyword_query=keyword_query,
-                               search_type=search_type)
+                               search_type=search_type,
+                               next_cursor=next_cursor)
 
     except Exception as e:
         print(f"❌ データ取得エラー: {e}")
@@ -460,18 +2248,76 @@ def dashboard():
             return error_message, 500
         return "データの取得中にエラーが発生しました。", 500
     
+def load_article_page(user_id, tag_filter, keyword_query, search_type, cursor):
+    if keyword_query:
+        articles, next_cursor = search_articles(user_id, keyword_query, search_type, tag_filter, cursor=cursor)
+    else:
+        articles, next_cursor = list_articles(user_id, tag_filter, cursor=cursor)
+
+    for article_data in articles:
+        if 'createdAt' in article_data and article_data['createdAt']:
+            article_data['formatted_date'] = article_data['createdAt'].strftime('%Y-%m-%d')
+        else:
+            article_data['formatted_date'] = '日付なし'
+    return articles, next_cursor
+
+@app.route('/api/articles')
+@login_required_for_api
+def list_articles_api():
+    """
+    ダッシュボードの無限スクロール用に、記事一覧の次のページを返すAPI。
+    """
+    user_id = g.user_id
+    try:
+        articles, next_cursor = load_article_page(
+            user_id,
+            request.args.get('filter'),
+            request.args.get('q'),
+            request.args.get('search_type', 'all'),
+            request.args.get('after')
+        )
+        html = ''.join(render_template('article_card.html', article=article) for article in articles)
+        return jsonify({
+            "articles": [
+                {
+                    'id': article['id'],
+                    'generatedTitle': article.get('generatedTitle'),
+                    'tags': article.get('tags', []),
+                    'readLater': article.get('readLater', False),
+                    'visit_number': article.get('visit_number'),
+                    'is_repeat': article.get('is_repeat'),
+                    'formatted_date': article.get('formatted_date')
+                }
+                for article in articles
+            ],
+            "html": html,
+            "next_cursor": next_cursor
+        }), 200
+    except Exception as e:
+        print(f"❌ 記事一覧の取得エラー: {e}")
+        return jsonify({"error": "Failed to load articles"}), 500
+
 @app.route('/article/<article_id>')
 @login_required_for_web
 def article_detail(article_id):
     user_id = g.user_id
     try:
-        doc_ref = db.collection('users').document(user_id).collection('articles').document(article_id)
+        doc_ref = get_db().collection('users').document(user_id).collection('articles').document(article_id)
         doc = doc_ref.get()
         if doc.exists:
             article_data = doc.to_dict()
             article_data['id'] = doc.id
+
+            related_articles = []
+            try:
+                related_articles = load_articles_by_ids(
+                    user_id, related_article_ids(user_id, article_id, article_data),
+                    field_paths=['generatedTitle', 'tags', 'ogp.image']
+                )
+            except Exception as e:
+                print(f"関連記事の取得中にエラー: {e}")
             
-            return render_template('article_detail.html', article=article_data, user_email=g.user.email)
+            return render_template('article_detail.html', article=article_data, related_articles=related_articles, user_email=g.user.email)
         else:
             return "記事が見つかりません。", 404
     except Exception as e:
@@ -484,14 +2330,23 @@ def delete_article(article_id):
     """
     指定されたIDの記事をデータベースから削除するAPIエンドポイント。
     """
+    db = get_db()
     user_id = g.user_id
     try:
         doc_ref = db.collection('users').document(user_id).collection('articles').document(article_id)
+        doc = doc_ref.get()
 
-        if not doc_ref.get().exists:
+        if not doc.exists:
             return jsonify({"error": "Article not found"}), 404
 
-        doc_ref.delete()
+        batch = db.batch()
+        batch.delete(doc_ref)
+        remove_url_visit(user_id, doc.to_dict(), batch)
+        forget_seen_url(user_id, doc.to_dict(), batch)
+        update_recommendation_candidate(user_id, article_id, None, batch)
+        update_facets(user_id, [doc.to_dict()], [], batch)
+        batch.commit()
+        forget_article_vector(user_id, article_id)
         print(f"✅ 記事を削除しました (User: {user_id}, Article: {article_id})")
         return jsonify({"status": "success", "message": "Article deleted successfully"}), 200
     except Exception as e:
@@ -505,29 +2360,85 @@ def login_page():
 @app.route('/history', methods=['POST'])
 @login_required_for_api
 def receive_history():
-    history_data = request.get_json()
-    if not isinstance(history_data, list):
-        return jsonify({"error": "Invalid JSON"}), 400
-    
+    """
+    履歴を受け付けてジョブを作成するAPI。
+    本文はJSON配列またはNDJSON（gzip圧縮も可）で、少しずつ読みながら対象外・取り込み済み・重複したエントリを除き、
+    残った候補だけをジョブに渡す。
+    """
+    if request.content_length is not None and request.content_length > history_upload.HISTORY_MAX_BODY_BYTES:
+        return jsonify({"error": "History upload is too large"}), 413
+
     user_id = g.user_id
     job_id = str(uuid.uuid4())
     try:
-        job_ref = db.collection('users').document(user_id).collection('jobs').document(job_id)
+        admission_error = job_queue.admission_error(user_id)
+        if admission_error:
+            print(f"⚠️ ジョブの受付を制限しました (User: {user_id}): {admission_error}")
+            return jsonify({"error": admission_error}), 429
+
+        # 前回までに取り込んだ訪問は受け付けない
+        watermark = get_history_watermark(user_id)
+        entries = history_upload.iter_history_entries(
+            request.stream, request.content_type, request.headers.get('Content-Encoding', '')
+        )
+        try:
+            with metrics.stage('upload_parse'):
+                history_data, new_watermark, counts = select_history_candidates(entries, watermark)
+        except history_upload.HistoryUploadError as e:
+            print(f"⚠️ 履歴を読み込めませんでした (User: {user_id}): {e}")
+            return jsonify({"error": str(e)}), e.status_code
+
+        job_ref = get_db().collection('users').document(user_id).collection('jobs').document(job_id)
+        print(f"➡️  認証済みユーザー ({user_id}) から {counts['received']}件の履歴を受信（新しい訪問: {counts['new']}件、処理候補: {counts['candidates']}件）。Job ID: {job_id}")
+        if not history_data:
+            job_ref.set({
+                'status': 'complete',
+                'createdAt': firestore.SERVER_TIMESTAMP,
+                'completedAt': firestore.SERVER_TIMESTAMP,
+                'newArticleIds': [],
+                'receivedCount': counts['received']
+            })
+            # 候補がなくても新しい訪問は確認済みなので、watermark を進める
+            if new_watermark != watermark:
+                _ingest_state_ref(user_id).set({'watermark': new_watermark}, merge=True)
+            return jsonify({"status": "processing_started", "job_id": job_id, "watermark": new_watermark}), 202
+
         job_ref.set({
-            'status': 'processing',
+            'status': 'queued',
             'createdAt': firestore.SERVER_TIMESTAMP,
-            'newArticleIds': []
+            'newArticleIds': [],
+            'receivedCount': counts['received']
         })
-        print(f"➡️  認証済みユーザー ({user_id}) から {len(history_data)}件の履歴を受信。Job ID: {job_id}")
         
-        thread = threading.Thread(target=process_and_summarize_history, args=(history_data, user_id, job_id))
-        thread.start()
+        # 実際の処理は worker.py のワーカープロセスが行う
+        try:
+            job_queue.enqueue_job(job_id, user_id, history_data)
+        except job_queue.JobRejectedError as e:
+            # 事前の確認の後に他のアップロードで上限に達した場合
+            print(f"⚠️ ジョブの受付を制限しました (User: {user_id}): {e}")
+            job_ref.delete()
+            return jsonify({"error": str(e)}), 429
+        # キューに積んだ時点でエントリは失われないため、watermark を進める
+        if new_watermark != watermark:
+            _ingest_state_ref(user_id).set({'watermark': new_watermark}, merge=True)
         
-        return jsonify({"status": "processing_started", "job_id": job_id}), 202
+        return jsonify({"status": "processing_started", "job_id": job_id, "watermark": new_watermark}), 202
     except Exception as e:
         print(f"❌ ジョブの作成中にエラー: {e}")
         return jsonify({"error": "Failed to create a processing job"}), 500
 
+@app.route('/api/history/watermark')
+@login_required_for_api
+def history_watermark_api():
+    """
+    取り込み済みの最新の訪問時刻（ミリ秒）を返すAPI。クライアントはこれより新しい履歴だけを送ればよい。
+    """
+    try:
+        return jsonify({"watermark": get_history_watermark(g.user_id)}), 200
+    except Exception as e:
+        print(f"❌ watermarkの取得中にエラー: {e}")
+        return jsonify({"error": "Failed to load the watermark"}), 500
+
 @app.route('/create_user_profile', methods=['POST'])
 @login_required_for_api
 def create_user_profile():
@@ -537,7 +2448,7 @@ def create_user_profile():
     if not email:
         return jsonify({"error": "Email is required"}), 400
     try:
-        user_ref = db.collection('users').document(user_id)
+        user_ref = get_db().collection('users').document(user_id)
         if not user_ref.get().exists:
             user_ref.set({
                 'email': email,
@@ -552,6 +2463,7 @@ def create_user_profile():
 @app.route('/article/<article_id>/reflection', methods=['POST'])
 @login_required_for_api
 def save_reflection(article_id):
+    db = get_db()
     user_id = g.user_id
     data = request.get_json()
     reflection_data = {
@@ -569,10 +2481,19 @@ def save_reflection(article_id):
     
     try:
         doc_ref = db.collection('users').document(user_id).collection('articles').document(article_id)
-        doc_ref.update({
+        doc = doc_ref.get()
+        if not doc.exists:
+            return jsonify({"error": "Article not found"}), 404
+        article_data = dict(doc.to_dict(), reflection=reflection_data)
+        batch = db.batch()
+        batch.update(doc_ref, {
             'reflection': reflection_data,
+            'searchTokens': build_search_tokens(article_data),
             'updatedAt': firestore.SERVER_TIMESTAMP
         })
+        update_recommendation_candidate(user_id, article_id, article_data, batch)
+        update_facets(user_id, [doc.to_dict()], [article_data], batch)
+        batch.commit()
         print(f"✅ 振り返りを保存しました (User: {user_id}, Article: {article_id})")
         return jsonify({"status": "success", "message": "Reflection saved successfully"}), 200
     except Exception as e:
@@ -584,45 +2505,123 @@ def save_reflection(article_id):
 def processing_page(job_id):
     return render_template('processing.html', job_id=job_id, user_email=g.user.email)
 
+# 進捗ストリーム（Server-Sent Events）
+# 同期ワーカー（gunicorn の sync）を占有しないよう、1回の接続では現在の状態を1件だけ送ってすぐに閉じ、
+# retry で指定した間隔で EventSource に再接続させる（短い間隔のポーリングと同じ動きになる）。
+JOB_EVENTS_RETRY_MS = int(os.environ.get('JOB_EVENTS_RETRY_MS', 1000))
+
+def _sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def _job_result_event(job_data):
+    if job_data.get('status') == 'error':
+        return _sse_event('failed', {'status': 'error'})
+    return _sse_event('complete', {
+        'status': 'complete',
+        'newArticleIds': job_data.get('newArticleIds', []),
+        'skippedCount': job_data.get('skippedCount', 0),
+        'deferredCount': job_data.get('deferredCount', 0),
+        'continuationJobId': job_data.get('continuationJobId')
+    })
+
+@app.route('/api/jobs/<job_id>/events')
+@login_required_for_web
+def job_events(job_id):
+    """
+    ジョブの進捗を Server-Sent Events で返す。
+    progress イベントで処理件数・段階ごとの処理速度・保存済みの記事IDを、完了したら complete（失敗したら failed）を送る。
+    1回の接続で送るのは現在の状態の1件だけで、ブラウザは JOB_EVENTS_RETRY_MS 後に再接続して次の状態を受け取る。
+    """
+    user_id = g.user_id
+    status = job_queue.get_job_status(job_id)
+    if status and status['user_id'] != user_id:
+        return jsonify({"error": "Job not found"}), 404
+
+    body = f"retry: {JOB_EVENTS_RETRY_MS}\n\n"
+    if status and status['status'] not in ('done', 'failed'):
+        # 実行中はジョブキュー（SQLite）の進捗だけを読む（Firestoreは読まない）
+        payload = dict(status['progress'] or {}, status=status['status'])
+        if status['status'] == 'queued' and status['available_at'] and status['available_at'] > time_module.time():
+            payload['retryInSeconds'] = round(status['available_at'] - time_module.time())
+        body += _sse_event('progress', payload)
+    else:
+        # 完了の結果（記事IDの一覧）はジョブドキュメントから読む
+        job_ref = get_db().collection('users').document(user_id).collection('jobs').document(job_id)
+        try:
+            job_doc = job_ref.get()
+        except Exception as e:
+            print(f"❌ ジョブの取得中にエラー: {e}")
+            return jsonify({"error": "Failed to load the job"}), 500
+        if not job_doc.exists and status is None:
+            return jsonify({"error": "Job not found"}), 404
+        job_data = (job_doc.to_dict() or {}) if job_doc.exists else {}
+        if job_data.get('status') in ('complete', 'error'):
+            body += _job_result_event(job_data)
+        elif status is None:
+            body += _job_result_event({'status': 'error'})
+        else:
+            # ワーカーがジョブドキュメントを更新できなかった場合は、ジョブキューの記録から結果を作る
+            body += _job_result_event({
+                'status': 'complete' if status['status'] == 'done' else 'error',
+                'newArticleIds': (status['progress'] or {}).get('articleIds', [])
+            })
+
+    return Response(body, mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+# 振り返りの画面で使う記事のフィールド（ベクトルや検索用トークンなどは送らない）
+REFLECT_FIELDS = ['generatedTitle', 'source', 'originalUrl', 'summary']
+
 @app.route('/reflect')
 @login_required_for_web
 def reflect_page():
+    """
+    振り返りの画面。ids の記事を1回のまとめ読みで取得し、まとめてページに埋め込む（次の記事へはページ内で切り替える）。
+    job を指定した場合、まだ保存されていない記事があればジョブの完了を待たずに保存済みの記事だけで表示し、
+    ページが進捗ストリームでジョブの完了を受け取ってから、次の記事へ進むときに読み直す。
+    表示できる記事がまだない場合は処理中の画面に戻す。
+    """
     user_id = g.user_id
     ids_str = request.args.get('ids', '')
-    index_str = request.args.get('index', '0')
+    job_id = request.args.get('job', '')
     if not ids_str:
         return redirect(url_for('dashboard'))
-    ids = ids_str.split(',')
-    index = int(index_str)
+    ids = [article_id for article_id in ids_str.split(',') if article_id]
+    try:
+        index = int(request.args.get('index', '0'))
+    except ValueError:
+        index = 0
     if index >= len(ids):
         return redirect(url_for('dashboard'))
-    current_article_id = ids[index]
     try:
-        doc_ref = db.collection('users').document(user_id).collection('articles').document(current_article_id)
-        max_retries = 3
-        doc = None
-        for i in range(max_retries):
-            doc = doc_ref.get()
-            if doc.exists:
-                break
-            print(f"記事取得リトライ中... ({i + 1}/{max_retries}) ID: {current_article_id}")
-            time.sleep(0.5)
-        if doc and doc.exists:
-            article = doc.to_dict()
-            progress = f"{index + 1}/{len(ids)}"
-            return render_template('reflect.html', 
-                                   article=article, 
-                                   article_id=current_article_id,
-                                   all_ids=ids_str,
-                                   current_index=index,
-                                   progress=progress,
-                                   user_email=g.user.email)
-        else:
-            print(f"⚠️ 記事が見つかりませんでした (ID: {current_article_id})。スキップします。")
-            next_index = index + 1
-            if next_index >= len(ids):
-                return redirect(url_for('dashboard'))
-            return redirect(url_for('reflect_page', ids=ids_str, index=next_index))
+        found = {article['id']: article for article in load_articles_by_ids(user_id, ids, field_paths=REFLECT_FIELDS)}
+        pending_job_id = ''
+        if job_id and len(found) < len(ids):
+            status = job_queue.get_job_status(job_id)
+            if status and status['user_id'] == user_id and status['status'] not in ('done', 'failed'):
+                pending_job_id = job_id
+        if len(found) < len(ids) and not pending_job_id:
+            print(f"⚠️ {len(ids) - len(found)}件の記事が見つかりませんでした。スキップします。")
+
+        articles = []
+        for position, article_id in enumerate(ids):
+            if article_id in found:
+                articles.append(dict({field: found[article_id].get(field) for field in REFLECT_FIELDS}, id=article_id, index=position))
+        current = next((i for i, article in enumerate(articles) if article['index'] >= index), None)
+        if current is None:
+            if pending_job_id:
+                return redirect(url_for('processing_page', job_id=pending_job_id))
+            return redirect(url_for('dashboard'))
+        return render_template('reflect.html',
+                               article=articles[current],
+                               articles=articles,
+                               all_ids=','.join(ids),
+                               current_position=current,
+                               pending_job_id=pending_job_id,
+                               progress=f"{current + 1}/{len(articles)}",
+                               user_email=g.user.email)
     except Exception as e:
         print(f"❌ 振り返り記事の取得エラー: {e}")
         return "記事の取得中にエラーが発生しました。", 500
@@ -633,43 +2632,27 @@ def reflect_page():
 @login_required_for_api
 def generate_recommendations():
     """
-    【自動実行用API】S/Aティア、または「後で見る」が設定された記事からランダムで3つ選び、おすすめとして保存する。
+    【自動実行用API】S/Aティア、または「後で見る」が設定された記事から、最近の振り返りに近い記事を3つ選び、おすすめとして保存する。
     """
     user_id = g.user_id
     print(f"週次レコメンド生成を開始します (User: {user_id})")
     
     try:
-        articles_ref = db.collection('users').document(user_id).collection('articles')
-        
-        query_s = articles_ref.where('reflection.usefulness', '==', 'tier-s').stream()
-        query_a = articles_ref.where('reflection.usefulness', '==', 'tier-a').stream()
-        
-        query_read_later = articles_ref.where('readLater', '==', True).stream()
+        high_value_article_ids = load_recommendation_candidates(user_id)
 
-        candidate_articles = {}
-        for doc in query_s:
-            candidate_articles[doc.id] = doc
-        for doc in query_a:
-            candidate_articles[doc.id] = doc
-        for doc in query_read_later:
-            candidate_articles[doc.id] = doc
-
-        high_value_articles = list(candidate_articles.values())
-
-        if len(high_value_articles) < 3:
-            print(f"  -> おすすめ対象の記事が3件未満のため、処理をスキップしました。")
+        if len(high_value_article_ids) < RECOMMENDATION_COUNT:
+            print(f"  -> おすすめ対象の記事が{RECOMMENDATION_COUNT}件未満のため、処理をスキップしました。")
             return jsonify({"status": "skipped", "reason": "Not enough high-value articles"}), 200
 
-        recommended_docs = random.sample(high_value_articles, 3)
-        recommended_ids = [doc.id for doc in recommended_docs]
+        recommended_ids = recommend_article_ids(user_id, high_value_article_ids)
         
-        recommendation_ref = db.collection('users').document(user_id).collection('recommendations').document('weekly')
+        recommendation_ref = get_db().collection('users').document(user_id).collection('recommendations').document('weekly')
         recommendation_ref.set({
             'articleIds': recommended_ids,
             'createdAt': firestore.SERVER_TIMESTAMP
         })
         
-        print(f"✅ おすすめ記事を3件保存しました (User: {user_id})")
+        print(f"✅ おすすめ記事を{len(recommended_ids)}件保存しました (User: {user_id})")
         return jsonify({"status": "success", "recommended_ids": recommended_ids}), 200
 
     except Exception as e:
@@ -682,6 +2665,7 @@ def toggle_read_later(article_id):
     """
     記事の「後で見る」状態を切り替えるAPI。
     """
+    db = get_db()
     user_id = g.user_id
     try:
         doc_ref = db.collection('users').document(user_id).collection('articles').document(article_id)
@@ -690,10 +2674,15 @@ def toggle_read_later(article_id):
         if not doc.exists:
             return jsonify({"error": "Article not found"}), 404
 
-        current_status = doc.to_dict().get('readLater', False)
+        article_data = doc.to_dict()
+        current_status = article_data.get('readLater', False)
         new_status = not current_status
         
-        doc_ref.update({'readLater': new_status})
+        batch = db.batch()
+        batch.update(doc_ref, {'readLater': new_status})
+        update_recommendation_candidate(user_id, article_id, dict(article_data, readLater=new_status), batch)
+        update_facets(user_id, [article_data], [dict(article_data, readLater=new_status)], batch)
+        batch.commit()
         
         return jsonify({"status": "success", "readLater": new_status}), 200
 
@@ -701,6 +2690,87 @@ def toggle_read_later(article_id):
         print(f"❌「後で見る」状態の変更中にエラー: {e}")
         return jsonify({"error": "Failed to update status"}), 500
     
+@app.cli.command('backfill-visit-counts')
+@click.argument('user_id', required=False)
+def backfill_visit_counts_command(user_id):
+    """
+    既存ユーザーの記事に visitNumber と urlStats を付与する（flask --app app backfill-visit-counts [USER_ID]）。
+    """
+    user_ids = [user_id] if user_id else [ref.id for ref in get_db().collection('users').list_documents()]
+    for uid in user_ids:
+        try:
+            backfill_visit_counts(uid)
+        except Exception as e:
+            print(f"❌ 訪問回数の再計算中にエラー (User: {uid}): {e}")
+
+@app.cli.command('backfill-search-index')
+@click.argument('user_id', required=False)
+def backfill_search_index_command(user_id):
+    """
+    検索インデックスがない（または古い）記事の searchTokens を作り直す（flask --app app backfill-search-index [USER_ID]）。
+    """
+    user_ids = [user_id] if user_id else [ref.id for ref in get_db().collection('users').list_documents()]
+    for uid in user_ids:
+        try:
+            ensure_search_index(uid)
+        except Exception as e:
+            print(f"❌ 検索インデックスの作成中にエラー (User: {uid}): {e}")
+
+@app.cli.command('reconcile-facets')
+@click.argument('user_id', required=False)
+def reconcile_facets_command(user_id):
+    """
+    タグなどの件数を記事から数え直す（flask --app app reconcile-facets [USER_ID]）。
+    """
+    user_ids = [user_id] if user_id else [ref.id for ref in get_db().collection('users').list_documents()]
+    for uid in user_ids:
+        try:
+            reconcile_facets(uid)
+        except Exception as e:
+            print(f"❌ ファセットの数え直し中にエラー (User: {uid}): {e}")
+
+# 期限切れのコンテンツキャッシュを1回のバッチで削除する件数
+CONTENT_CACHE_PRUNE_BATCH_SIZE = 400
+
+def prune_content_cache():
+    """
+    期限切れ（expiresAt を過ぎた）のコンテンツキャッシュを削除し、削除した件数を返す。
+    FirestoreのTTLポリシーを設定していない環境や、TTLによる削除が遅れている場合に使う。
+    """
+    db = get_db()
+    collection = db.collection(CONTENT_CACHE_COLLECTION)
+    now = datetime.now(timezone.utc)
+    deleted = 0
+    while True:
+        docs = list(collection.where('expiresAt', '<', now).limit(CONTENT_CACHE_PRUNE_BATCH_SIZE).stream())
+        if not docs:
+            return deleted
+        batch = db.batch()
+        for doc in docs:
+            batch.delete(doc.reference)
+        batch.commit()
+        deleted += len(docs)
+
+@app.cli.command('prune-content-cache')
+def prune_content_cache_command():
+    """
+    期限切れのコンテンツキャッシュを削除する（flask --app app prune-content-cache）。
+    """
+    try:
+        print(f"✅ 期限切れのコンテンツキャッシュを{prune_content_cache()}件削除しました。")
+    except Exception as e:
+        print(f"❌ コンテンツキャッシュの削除中にエラー: {e}")
+
+@app.route('/api/auth-cache-stats')
+@login_required_for_api
+def auth_cache_stats_api():
+    """
+    認証キャッシュのヒット・ミス回数と現在のエントリ数を返すAPI。
+    """
+    with _auth_cache_lock:
+        stats = dict(auth_cache_stats, token_entries=len(_token_cache), user_entries=len(_user_cache))
+    return jsonify(stats), 200
+
 @app.route('/privacy')
 def privacy_policy_page():
     """
@@ -708,8 +2778,38 @@ def privacy_policy_page():
     このページはログイン不要でアクセス可能です。
     """
     return render_template('privacy.html')
-    
+
+@app.route('/readyz')
+def readiness():
+    """
+    FirebaseとGeminiの準備ができているかを返すAPI（ログイン不要）。
+    両方の準備ができるまでは 503 を返す。初期化は待たずに現在の状態だけを返す。
+    """
+    firebase_ready = _db is not None
+    gemini_ready = _llm is not None
+    status = {
+        'ready': firebase_ready and gemini_ready,
+        'firebase': _init_state['firebase']['status'],
+        'gemini': _init_state['gemini']['status'],
+        'model': _init_state['gemini']['model']
+    }
+    return jsonify(status), 200 if status['ready'] else 503
+
+# /metrics を保護するトークン（設定した場合は Authorization: Bearer <トークン> が必要）
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """
+    全プロセス（Webサーバー・ワーカー）の計測値をPrometheusのテキスト形式で返す。
+    """
+    if METRICS_TOKEN and request.headers.get('Authorization') != f'Bearer {METRICS_TOKEN}':
+        return jsonify({"error": "Unauthorized"}), 401
+    return metrics.render_prometheus(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
 if __name__ == '__main__':
+    init_local_stores()
+    start_warm_up()
     port = int(os.environ.get('PORT', 5001))
     
     debug_mode = os.environ.get('FLASK_DEBUG') == '1'
@@ -0,0 +1,170 @@
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from google.api_core import exceptions as google_exceptions
+from google.cloud.firestore_v1 import transforms
+
+# Firestoreへの書き込みのまとめ役
+# 書き込みを上限（1バッチ500件）以下のバッチに分け、スレッドプールで並列にコミットする。
+# 競合や一時的なエラーはジッター付きの指数バックオフで再試行し、1つのバッチが失敗しても他のバッチには影響しない。
+FIRESTORE_BATCH_MAX_WRITES = 500
+BATCH_COMMIT_CONCURRENCY = int(os.environ.get('BATCH_COMMIT_CONCURRENCY', 4))
+BATCH_COMMIT_MAX_RETRIES = int(os.environ.get('BATCH_COMMIT_MAX_RETRIES', 5))
+BATCH_BACKOFF_BASE_SECONDS = float(os.environ.get('BATCH_BACKOFF_BASE_SECONDS', 0.5))
+BATCH_BACKOFF_MAX_SECONDS = 10.0
+
+RETRYABLE_ERRORS = (
+    google_exceptions.Aborted,
+    google_exceptions.Conflict,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.InternalServerError,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.TooManyRequests,
+    google_exceptions.ResourceExhausted,
+    ConnectionError,
+    TimeoutError,
+)
+# コミットが反映されたかどうか分からないエラー（タイムアウトなど）
+# Increment などを含むバッチをそのまま再試行すると二重に加算されるおそれがあるため、
+# 反映されていないことを確かめられた場合だけ再試行する。
+AMBIGUOUS_ERRORS = (
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.InternalServerError,
+    google_exceptions.ServiceUnavailable,
+    ConnectionError,
+    TimeoutError,
+)
+NON_IDEMPOTENT_TRANSFORMS = (transforms.Increment, transforms.ArrayUnion, transforms.ArrayRemove)
+
+class BatchCommitError(Exception):
+    """
+    再試行してもコミットできなかった書き込みがあることを表す。
+    """
+
+def _has_transform(value):
+    if isinstance(value, NON_IDEMPOTENT_TRANSFORMS):
+        return True
+    if isinstance(value, dict):
+        return any(_has_transform(v) for v in value.values())
+    return False
+
+def is_idempotent(writes):
+    """
+    書き込みを2回反映しても結果が変わらないかどうか（Increment・ArrayUnion・ArrayRemove を含まないかどうか）を返す。
+    """
+    return not any(_has_transform(data) for _, _, data, _ in writes)
+
+def commit_with_retry(db, writes, is_applied=None):
+    """
+    書き込み（(操作, 参照, データ, merge) のリスト）を1つのバッチでコミットする。一時的なエラーは再試行する。
+    Increment などを含むバッチが反映されたか分からないエラーで失敗した場合は、is_applied（反映済みかどうかを返す関数）で
+    確かめ、反映済みならそのまま、反映されていなければ再試行する。is_applied がない場合は再試行せずに例外を送出する。
+    """
+    idempotent = is_idempotent(writes)
+    for attempt in range(BATCH_COMMIT_MAX_RETRIES + 1):
+        batch = db.batch()
+        for operation, reference, data, merge in writes:
+            if operation == 'set':
+                batch.set(reference, data, merge=merge)
+            elif operation == 'update':
+                batch.update(reference, data)
+            elif operation == 'delete':
+                batch.delete(reference)
+            else:
+                raise ValueError(f"Unknown write operation: {operation}")
+        try:
+            batch.commit()
+            return
+        except RETRYABLE_ERRORS as e:
+            if not idempotent and isinstance(e, AMBIGUOUS_ERRORS):
+                if is_applied is None:
+                    raise
+                try:
+                    applied = is_applied()
+                except Exception:
+                    raise e
+                if applied:
+                    print(f"  -> バッチのコミットはエラー（{e}）になりましたが、反映済みでした")
+                    return
+            if attempt == BATCH_COMMIT_MAX_RETRIES:
+                raise
+            delay = random.uniform(0, min(BATCH_BACKOFF_MAX_SECONDS, BATCH_BACKOFF_BASE_SECONDS * 2 ** attempt))
+            print(f"  -> ⏳ バッチのコミットに失敗したため{delay:.1f}秒後に再試行します ({attempt + 1}/{BATCH_COMMIT_MAX_RETRIES}): {e}")
+            time.sleep(delay)
+
+def split_writes(writes, max_writes=FIRESTORE_BATCH_MAX_WRITES):
+    return [writes[i:i + max_writes] for i in range(0, len(writes), max_writes)]
+
+class BatchWriter:
+    """
+    書き込みのまとまりを受け取り、上限以下のバッチに分けて並列にコミットする。
+
+    submit() には書き込みのリスト、またはそれを返す関数（コミットするスレッドで呼ばれる）を渡す。
+    まとまりの書き込みが全てコミットできたら on_commit が、失敗したら on_error が例外を引数に呼ばれる。
+    1つのまとまりが上限に収まる場合は1つのバッチ（全てが反映されるか、何も反映されないか）でコミットする。
+    is_applied（まとまりが反映済みかどうかを返す関数）は、1つのバッチに収まるまとまりの再試行の判断に使う
+    （commit_with_retry を参照）。
+    """
+    def __init__(self, db, max_writes=FIRESTORE_BATCH_MAX_WRITES, concurrency=BATCH_COMMIT_CONCURRENCY):
+        self.db = db
+        self.max_writes = max_writes
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+        self._futures = []
+        self._lock = threading.Lock()
+        self.committed_writes = 0
+        self.failed_writes = 0
+
+    def submit(self, writes, on_commit=None, on_error=None, is_applied=None):
+        future = self._executor.submit(self._commit, writes, on_commit, on_error, is_applied)
+        with self._lock:
+            self._futures.append(future)
+        return future
+
+    def _commit(self, writes, on_commit, on_error, is_applied):
+        total = committed = 0
+        try:
+            if callable(writes):
+                writes = writes()
+            total = len(writes)
+            chunks = split_writes(writes, self.max_writes)
+            for chunk in chunks:
+                commit_with_retry(self.db, chunk, is_applied if len(chunks) == 1 else None)
+                committed += len(chunk)
+        except Exception as e:
+            with self._lock:
+                self.committed_writes += committed
+                self.failed_writes += total - committed
+            print(f"❌ バッチのコミット中にエラー ({committed}/{total}件まで保存済み): {e}")
+            if on_error:
+                on_error(e)
+            return False
+        with self._lock:
+            self.committed_writes += committed
+        if on_commit:
+            on_commit()
+        return True
+
+    def wait(self):
+        """
+        送信済みの全てのまとまりのコミットを待ち、全て成功したかどうかを返す。
+        """
+        ok = True
+        while True:
+            with self._lock:
+                futures, self._futures = self._futures, []
+            if not futures:
+                return ok
+            for future in futures:
+                try:
+                    ok = future.result() and ok
+                except Exception as e:
+                    print(f"❌ バッチのコミット中にエラー: {e}")
+                    ok = False
+
+    def close(self):
+        ok = self.wait()
+        self._executor.shutdown(wait=True)
+        return ok
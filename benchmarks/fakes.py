@@ -0,0 +1,434 @@
+import json
+import random
+import re
+import threading
+import time
+import uuid
+import zlib
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from google.api_core import exceptions as google_exceptions
+from google.cloud import firestore as google_firestore
+from google.cloud.firestore_v1 import transforms
+
+# ベンチマーク用の代用品
+# Firestore（メモリ上）・Gemini（遅延とエラー率を指定できる偽モデル）・Webサイト（ローカルのHTTPサーバー）を用意し、
+# 外部サービスに接続せずに履歴処理を動かせるようにする。
+
+# --- Firestore ---
+# app.py が使う範囲（collection / document / where / order_by / limit / start_after / select /
+# batch / get_all / list_documents と ArrayUnion・ArrayRemove・Increment・SERVER_TIMESTAMP）だけを実装する。
+
+def _copy(value):
+    if isinstance(value, dict):
+        return {k: _copy(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_copy(v) for v in value]
+    return value
+
+def _get_path(data, path):
+    for part in path.split('.'):
+        if not isinstance(data, dict) or part not in data:
+            return None
+        data = data[part]
+    return data
+
+def _set_path(data, path, value, split=True):
+    parts = path.split('.') if split else [path]
+    for part in parts[:-1]:
+        data = data.setdefault(part, {})
+    current = data.get(parts[-1])
+    if value is google_firestore.SERVER_TIMESTAMP:
+        value = datetime.now(timezone.utc)
+    elif isinstance(value, transforms.ArrayUnion):
+        current = list(current or [])
+        current.extend(v for v in value.values if v not in current)
+        value = current
+    elif isinstance(value, transforms.ArrayRemove):
+        value = [v for v in (current or []) if v not in value.values]
+    elif isinstance(value, transforms.Increment):
+        value = (current or 0) + value.value
+    elif isinstance(value, dict):
+        resolved = {}
+        for k, v in value.items():
+            _set_path(resolved, k, v, split=False)
+        value = resolved
+    data[parts[-1]] = value
+
+class FakeSnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+        self.exists = data is not None
+
+    def to_dict(self):
+        return None if self._data is None else _copy(self._data)
+
+    def get(self, field):
+        return _get_path(self._data or {}, field)
+
+class _Store:
+    def __init__(self, latency=0.0):
+        self.docs = {}
+        self.lock = threading.RLock()
+        self.latency = latency
+        self.reads = 0
+        self.writes = 0
+
+    def round_trip(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+class FakeDocumentReference:
+    def __init__(self, store, path):
+        self._store = store
+        self.path = path
+        self.id = path.rsplit('/', 1)[-1]
+
+    def collection(self, name):
+        return FakeCollectionReference(self._store, f'{self.path}/{name}')
+
+    def get(self, field_paths=None, transaction=None):
+        self._store.round_trip()
+        return self._get()
+
+    def _get(self):
+        with self._store.lock:
+            self._store.reads += 1
+            data = self._store.docs.get(self.path)
+            return FakeSnapshot(self, _copy(data) if data is not None else None)
+
+    def set(self, data, merge=False):
+        self._store.round_trip()
+        self._set(data, merge)
+
+    def _set(self, data, merge=False):
+        with self._store.lock:
+            self._store.writes += 1
+            base = _copy(self._store.docs.get(self.path, {})) if merge else {}
+            for key, value in data.items():
+                if merge and isinstance(value, dict) and isinstance(base.get(key), dict):
+                    for sub_key, sub_value in value.items():
+                        _set_path(base[key], sub_key, sub_value, split=False)
+                else:
+                    _set_path(base, key, value)
+            self._store.docs[self.path] = base
+
+    def update(self, data):
+        self._store.round_trip()
+        self._update(data)
+
+    def _update(self, data):
+        with self._store.lock:
+            if self.path not in self._store.docs:
+                raise google_exceptions.NotFound(f'No document to update: {self.path}')
+            self._store.writes += 1
+            for key, value in data.items():
+                _set_path(self._store.docs[self.path], key, value)
+
+    def delete(self):
+        self._store.round_trip()
+        self._delete()
+
+    def _delete(self):
+        with self._store.lock:
+            self._store.writes += 1
+            self._store.docs.pop(self.path, None)
+
+class FakeQuery:
+    def __init__(self, store, path, filters=(), orders=(), limit=None, after=None, fields=None):
+        self._store = store
+        self._path = path
+        self._filters = list(filters)
+        self._orders = list(orders)
+        self._limit = limit
+        self._after = after
+        self._fields = fields
+
+    def _clone(self, **changes):
+        query = FakeQuery(self._store, self._path, self._filters, self._orders, self._limit, self._after, self._fields)
+        for key, value in changes.items():
+            setattr(query, key, value)
+        return query
+
+    def where(self, field=None, op=None, value=None, filter=None):
+        if filter is not None:
+            field, op, value = filter.field_path, filter.op_string, filter.value
+        return self._clone(_filters=self._filters + [(field, op, value)])
+
+    def order_by(self, field, direction='ASCENDING'):
+        return self._clone(_orders=self._orders + [(field, direction)])
+
+    def limit(self, count):
+        return self._clone(_limit=count)
+
+    def start_after(self, snapshot):
+        return self._clone(_after=snapshot)
+
+    def select(self, field_paths):
+        return self._clone(_fields=list(field_paths))
+
+    def _matches(self, data):
+        for field, op, value in self._filters:
+            current = _get_path(data, field)
+            if op == '==' and current != value:
+                return False
+            if op == 'in' and current not in value:
+                return False
+            if op == '>=' and (current is None or current < value):
+                return False
+            if op == '<' and (current is None or current >= value):
+                return False
+            if op == 'array_contains' and value not in (current or []):
+                return False
+            if op == 'array_contains_any' and not set(value) & set(current or []):
+                return False
+        return True
+
+    def _sort_key(self, item):
+        path, data = item
+        return [(_get_path(data, f) is not None, _get_path(data, f)) for f, _ in self._orders] + [path]
+
+    def stream(self, transaction=None):
+        self._store.round_trip()
+        with self._store.lock:
+            prefix = self._path + '/'
+            items = [
+                (path, _copy(data)) for path, data in self._store.docs.items()
+                if path.startswith(prefix) and '/' not in path[len(prefix):] and self._matches(data)
+            ]
+        descending = bool(self._orders) and self._orders[0][1] in ('DESCENDING', google_firestore.Query.DESCENDING)
+        items.sort(key=self._sort_key, reverse=descending)
+        if self._after is not None:
+            after_key = self._sort_key((self._after.reference.path, self._after._data or {}))
+            items = [
+                item for item in items
+                if (self._sort_key(item) < after_key if descending else self._sort_key(item) > after_key)
+            ]
+        if self._limit is not None:
+            items = items[:self._limit]
+        with self._store.lock:
+            self._store.reads += max(1, len(items))
+        for path, data in items:
+            if self._fields is not None:
+                data = {f: _get_path(data, f) for f in self._fields if _get_path(data, f) is not None}
+            yield FakeSnapshot(FakeDocumentReference(self._store, path), data)
+
+    def get(self):
+        return list(self.stream())
+
+class FakeCollectionReference(FakeQuery):
+    def __init__(self, store, path):
+        super().__init__(store, path)
+        self.id = path.rsplit('/', 1)[-1]
+
+    def document(self, document_id=None):
+        return FakeDocumentReference(self._store, f'{self._path}/{document_id or uuid.uuid4().hex[:20]}')
+
+    def add(self, data):
+        reference = self.document()
+        reference.set(data)
+        return None, reference
+
+    def list_documents(self):
+        prefix = self._path + '/'
+        with self._store.lock:
+            ids = {path[len(prefix):].split('/', 1)[0] for path in self._store.docs if path.startswith(prefix)}
+        return [self.document(document_id) for document_id in sorted(ids)]
+
+class FakeWriteBatch:
+    def __init__(self, store):
+        self._store = store
+        self._operations = []
+
+    def set(self, reference, data, merge=False):
+        self._operations.append(lambda: reference._set(data, merge=merge))
+
+    def update(self, reference, data):
+        self._operations.append(lambda: reference._update(data))
+
+    def delete(self, reference):
+        self._operations.append(reference._delete)
+
+    def commit(self):
+        if len(self._operations) > 500:
+            raise google_exceptions.InvalidArgument('maximum 500 writes allowed per request')
+        self._store.round_trip()
+        with self._store.lock:
+            for operation in self._operations:
+                operation()
+        self._operations = []
+
+    def __len__(self):
+        return len(self._operations)
+
+class FakeFirestore:
+    """
+    Firestoreクライアントのメモリ上の代用品。latency（秒）を指定すると、1往復ごとにその分だけ待つ。
+    """
+    def __init__(self, latency=0.0):
+        self.store = _Store(latency)
+
+    def collection(self, name):
+        return FakeCollectionReference(self.store, name)
+
+    def batch(self):
+        return FakeWriteBatch(self.store)
+
+    def get_all(self, references, field_paths=None):
+        self.store.round_trip()
+        return [reference._get() for reference in references]
+
+# --- Gemini ---
+
+class _Usage:
+    def __init__(self, prompt_token_count, candidates_token_count):
+        self.prompt_token_count = prompt_token_count
+        self.candidates_token_count = candidates_token_count
+
+class _Response:
+    def __init__(self, text, prompt):
+        self.text = text
+        self.usage_metadata = _Usage(len(prompt) // 2, len(text) // 2)
+
+BATCH_ID_PATTERN = re.compile(r'\[id: (\d+)\]')
+
+class FakeGeminiModel:
+    """
+    GenerativeModel の代用品。latency 秒（±jitter）待ってから応答し、error_rate の確率で 429 / 503 を送出する。
+    technical_rate の割合の記事を技術記事として扱う。
+    """
+    def __init__(self, latency=0.5, jitter=0.2, error_rate=0.0, technical_rate=0.7, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.technical_rate = technical_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = 0
+
+    def _roll(self):
+        with self.lock:
+            self.calls += 1
+            return self.random.random(), self.random.uniform(-self.jitter, self.jitter)
+
+    def generate_content(self, prompt, generation_config=None, **kwargs):
+        roll, jitter = self._roll()
+        time.sleep(max(0.0, self.latency + jitter))
+        if roll < self.error_rate:
+            error = google_exceptions.ResourceExhausted if roll < self.error_rate / 2 else google_exceptions.ServiceUnavailable
+            raise error('fake gemini error')
+
+        # 同じ記事には常に同じ判定を返す
+        is_technical = lambda text: zlib.crc32(text.encode('utf-8')) % 1000 / 1000 < self.technical_rate
+        sections = BATCH_ID_PATTERN.split(prompt)
+        if len(sections) > 1:
+            results = []
+            for page_id, section in zip(sections[1::2], sections[2::2]):
+                if is_technical(section.split('コンテンツ:')[0]):
+                    results.append({
+                        'id': int(page_id), 'verdict': 'technical', 'title': f'記事 {page_id}',
+                        'source': 'Fixture', 'summary': 'Pythonの要約である。', 'tags': ['Python', 'AI']
+                    })
+                else:
+                    results.append({'id': int(page_id), 'verdict': 'none'})
+            return _Response(json.dumps(results, ensure_ascii=False), prompt)
+        if 'technical、' in prompt:
+            return _Response('technical' if is_technical(prompt.split('文章:')[-1][:300]) else 'none', prompt)
+        return _Response('タイトル: 記事\n情報元: Fixture\n要約: Pythonの要約である。\nタグ: Python, AI', prompt)
+
+# --- Webサイト ---
+
+PAGE_TEMPLATE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>{title}</title>
+<meta property="og:title" content="{title}"><meta property="og:description" content="{title}の解説">
+<meta property="og:image" content="/img/{page}.png"></head>
+<body><nav>メニュー</nav><main><h1>{title}</h1>{body}</main><footer>フッター</footer></body></html>
+"""
+
+class FixtureServer:
+    """
+    ローカルの記事サイト。/page/<番号>.html に本文のあるHTMLを返す。
+    latency 秒（±jitter）待ってから応答し、error_rate の確率で 503 を返す。
+    ポートごとに別のホストとして扱われるため、hosts 個のサーバーを起動して複数サイトを再現する。
+    """
+    def __init__(self, hosts=4, latency=0.05, jitter=0.02, error_rate=0.0, body_paragraphs=20, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.body = ''.join(
+            f'<p>段落{i}: Pythonとクラウドの技術解説です。サンプルコードと設計の考え方を説明します。</p>'
+            for i in range(body_paragraphs)
+        )
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.servers = [ThreadingHTTPServer(('127.0.0.1', 0), self._handler()) for _ in range(hosts)]
+        for server in self.servers:
+            server.daemon_threads = True
+        self.threads = []
+
+    def _handler(self):
+        fixture = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                with fixture.lock:
+                    roll, jitter = fixture.random.random(), fixture.random.uniform(-fixture.jitter, fixture.jitter)
+                time.sleep(max(0.0, fixture.latency + jitter))
+                if roll < fixture.error_rate:
+                    self.send_response(503)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                page = self.path.rsplit('/', 1)[-1].split('.')[0]
+                body = PAGE_TEMPLATE.format(title=f'Python 技術記事 {page}', page=page, body=fixture.body).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    @property
+    def base_urls(self):
+        return [f'http://127.0.0.1:{server.server_address[1]}' for server in self.servers]
+
+    def start(self):
+        for server in self.servers:
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def stop(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+def synthetic_history(base_urls, count, duplicate_rate=0.1, noise_rate=0.3, seed=None):
+    """
+    Chromeの履歴（[{'title', 'url', 'time_usec'}, ...]）を模したデータを作る。
+    noise_rate の割合はキーワードで除外されるエントリ、duplicate_rate の割合は同じURLの再訪問にする。
+    """
+    rng = random.Random(seed)
+    history = []
+    now_usec = int(time.time() * 1_000_000)
+    for i in range(count):
+        if history and rng.random() < duplicate_rate:
+            entry = dict(rng.choice(history))
+        elif rng.random() < noise_rate:
+            entry = {'title': f'今日の献立 {i}', 'url': f'https://example.com/recipe/{i}'}
+        else:
+            base_url = base_urls[i % len(base_urls)]
+            entry = {'title': f'Python 技術記事 {i}', 'url': f'{base_url}/page/{i}.html'}
+        entry['time_usec'] = now_usec - i * 1_000_000
+        history.append(entry)
+    return history
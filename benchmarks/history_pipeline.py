@@ -0,0 +1,247 @@
+"""
+履歴処理（process_and_summarize_history）のオフラインベンチマーク。
+
+Firebase・Gemini・実際のWebサイトの代わりに benchmarks/fakes.py の代用品を使い、
+同時実行数の設定ごとにスループット（URL/秒）、エントリごとの処理時間（p50 / p99）、メモリのピークを計測する。
+
+    python -m benchmarks.history_pipeline --entries 500 --concurrency 4,8,16
+    python -m benchmarks.history_pipeline --history takeout.json --gemini-latency 1.0 --json
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import argparse
+import tempfile
+import threading
+import tracemalloc
+import zlib
+from urllib.parse import urlsplit
+
+# app.py を読み込む前に、外部サービスへの接続と作業用ファイルの作成先を止めておく
+os.environ.setdefault('WARM_UP_ON_START', '0')
+_WORK_DIR = tempfile.mkdtemp(prefix='techlog-bench-')
+for _name in ('JOB_QUEUE_PATH', 'FETCH_CACHE_PATH', 'GEMINI_LIMITER_PATH', 'METRICS_PATH', 'CANDIDATE_SCHEDULER_PATH'):
+    os.environ.setdefault(_name, os.path.join(_WORK_DIR, f'{_name.lower()}.sqlite3'))
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+import candidate_scheduler  # noqa: E402
+import fetch_cache  # noqa: E402
+import gemini_client  # noqa: E402
+import host_scheduler  # noqa: E402
+import job_queue  # noqa: E402
+import keyword_filter  # noqa: E402
+
+from benchmarks.fakes import FakeFirestore, FakeGeminiModel, FixtureServer, synthetic_history  # noqa: E402
+
+BENCH_USER_ID = 'benchmark-user'
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * (len(ordered) - 1)))))
+    return ordered[index]
+
+def load_history(path, base_urls):
+    """
+    記録済みの履歴（JSON配列、またはTakeoutの {"Browser History": [...]}）を読み込む。
+    URLはパスを残したままローカルサイトに置き換える（元のホストごとに同じローカルホストへ割り当てる）。
+    """
+    with open(path, encoding='utf-8') as f:
+        history = json.load(f)
+    if isinstance(history, dict):
+        history = history.get('Browser History', [])
+
+    replayed = []
+    for entry in history:
+        url = entry.get('url') or ''
+        if url.startswith('http'):
+            parts = urlsplit(url)
+            base_url = base_urls[zlib.crc32(parts.netloc.encode('utf-8')) % len(base_urls)]
+            url = f"{base_url}{parts.path or '/'}{'?' + parts.query if parts.query else ''}"
+        replayed.append(dict(entry, url=url))
+    return replayed
+
+def reset_state(run_dir, args):
+    """
+    前の計測の影響（各種キャッシュ・ホストごとの状態・計測値）が残らないよう、計測ごとに状態を作り直す。
+    """
+    fetch_cache.FETCH_CACHE_PATH = os.path.join(run_dir, 'fetch_cache.sqlite3')
+    fetch_cache.init_cache()
+    job_queue.JOB_QUEUE_PATH = os.path.join(run_dir, 'jobs.sqlite3')
+    job_queue.init_queue()
+    gemini_client.GEMINI_LIMITER_PATH = os.path.join(run_dir, 'gemini_limiter.sqlite3')
+    gemini_client.init_limiter()
+    candidate_scheduler.CANDIDATE_SCHEDULER_PATH = os.path.join(run_dir, 'candidate_scheduler.sqlite3')
+    candidate_scheduler.init_reputation()
+    candidate_scheduler.JOB_TIME_BUDGET_SECONDS = args.time_budget
+    candidate_scheduler.JOB_LLM_CALL_BUDGET = args.llm_budget
+
+    with app._content_cache_lock:
+        app._content_cache.clear()
+    host_scheduler.HOST_MIN_INTERVAL_SECONDS = args.host_interval
+    host_scheduler.default_scheduler = host_scheduler.HostScheduler()
+    gemini_client.GEMINI_RPM = args.rpm
+    gemini_client.GEMINI_TPM = args.tpm
+    gemini_client.GEMINI_MAX_IN_FLIGHT = args.gemini_in_flight
+    gemini_client.GEMINI_BACKOFF_BASE_SECONDS = args.gemini_backoff
+
+    app._db = FakeFirestore(latency=args.firestore_latency)
+    app._llm = gemini_client.GeminiClient(FakeGeminiModel(
+        latency=args.gemini_latency, jitter=args.gemini_jitter,
+        error_rate=args.gemini_error_rate, seed=args.seed
+    ))
+
+def run_once(history, concurrency, args):
+    """
+    1回分の計測を行い、結果を辞書で返す。
+    エントリごとの処理時間は、エントリの確認（check_entry）が始まってから進捗が記録されるまでの時間。
+    """
+    run_dir = tempfile.mkdtemp(dir=_WORK_DIR)
+    reset_state(run_dir, args)
+    app.FETCH_CONCURRENCY = concurrency
+    app.PARSE_CONCURRENCY = max(1, concurrency // 4)
+    app.LLM_CONCURRENCY = max(1, min(concurrency // 4, args.gemini_in_flight))
+    app.FETCH_PER_HOST_LIMIT = args.per_host_limit
+
+    job_id = str(uuid.uuid4())
+    app._db.collection('users').document(BENCH_USER_ID).collection('jobs').document(job_id).set({'status': 'queued'})
+
+    # 処理対象になるエントリ（process_and_summarize_history 内のフィルタリングと同じもの）
+    filtered = keyword_filter.default_matcher.filter_entries(history)
+    started_at = {}
+    latencies = []
+    lock = threading.Lock()
+
+    original_check_entry = app.check_entry
+    original_record_progress = job_queue.record_progress
+
+    def timed_check_entry(entry):
+        with lock:
+            started_at.setdefault(id(entry), time.perf_counter())
+        return original_check_entry(entry)
+
+    def timed_record_progress(progress_job_id, entry_index, article):
+        finished = time.perf_counter()
+        with lock:
+            started = started_at.get(id(filtered_by_index[entry_index]))
+            if started is not None:
+                latencies.append(finished - started)
+        return original_record_progress(progress_job_id, entry_index, article)
+
+    # フィルタリング後のリストは process_and_summarize_history の中で作り直されるため、同じ辞書を指すように位置で対応付ける
+    filtered_by_index = {}
+    original_filter_entries = keyword_filter.default_matcher.filter_entries
+
+    def capturing_filter_entries(entries):
+        result = original_filter_entries(entries)
+        filtered_by_index.update(enumerate(result))
+        return result
+
+    app.check_entry = timed_check_entry
+    job_queue.record_progress = timed_record_progress
+    keyword_filter.default_matcher.filter_entries = capturing_filter_entries
+    if args.trace_memory:
+        tracemalloc.start()
+    try:
+        started = time.perf_counter()
+        app.process_and_summarize_history(history, BENCH_USER_ID, job_id)
+        elapsed = time.perf_counter() - started
+        peak_memory = tracemalloc.get_traced_memory()[1] if args.trace_memory else None
+    finally:
+        if args.trace_memory:
+            tracemalloc.stop()
+        app.check_entry = original_check_entry
+        job_queue.record_progress = original_record_progress
+        keyword_filter.default_matcher.filter_entries = original_filter_entries
+
+    job = app._db.collection('users').document(BENCH_USER_ID).collection('jobs').document(job_id).get().to_dict()
+    return {
+        'concurrency': concurrency,
+        'entries': len(history),
+        'candidates': len(filtered),
+        'articles': len(job.get('newArticleIds', [])),
+        'deferred': job.get('deferredCount', 0),
+        'seconds': round(elapsed, 3),
+        'urlsPerSecond': round(len(filtered) / elapsed, 2) if elapsed else 0.0,
+        'p50Seconds': round(percentile(latencies, 0.5), 3),
+        'p99Seconds': round(percentile(latencies, 0.99), 3),
+        'peakMemoryMB': round(peak_memory / 1024 / 1024, 1) if peak_memory is not None else None,
+        'firestoreReads': app._db.store.reads,
+        'firestoreWrites': app._db.store.writes,
+        'stages': job.get('metrics', {}).get('stages', {}),
+    }
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='履歴処理のオフラインベンチマーク')
+    parser.add_argument('--history', help='記録済みの履歴JSON（省略時は合成データ）')
+    parser.add_argument('--entries', type=int, default=300, help='合成する履歴の件数')
+    parser.add_argument('--concurrency', default='4,8,16', help='計測する取得の同時実行数（カンマ区切り）')
+    parser.add_argument('--repeat', type=int, default=1, help='同時実行数ごとの計測回数')
+    parser.add_argument('--hosts', type=int, default=4, help='ローカルサイトのホスト数')
+    parser.add_argument('--per-host-limit', type=int, default=app.FETCH_PER_HOST_LIMIT, help='ホストごとの同時取得数')
+    parser.add_argument('--site-latency', type=float, default=0.05)
+    parser.add_argument('--site-jitter', type=float, default=0.02)
+    parser.add_argument('--site-error-rate', type=float, default=0.0)
+    parser.add_argument('--gemini-latency', type=float, default=0.5)
+    parser.add_argument('--gemini-jitter', type=float, default=0.2)
+    parser.add_argument('--gemini-error-rate', type=float, default=0.0)
+    parser.add_argument('--gemini-in-flight', type=int, default=4)
+    parser.add_argument('--gemini-backoff', type=float, default=0.1, help='再試行の待ち時間の基準（秒）')
+    parser.add_argument('--rpm', type=int, default=100000)
+    parser.add_argument('--tpm', type=int, default=100000000)
+    parser.add_argument('--firestore-latency', type=float, default=0.0, help='Firestoreの1往復あたりの遅延（秒）')
+    parser.add_argument('--host-interval', type=float, default=0.0, help='同じホストへの取得間隔（秒）')
+    parser.add_argument('--time-budget', type=float, default=0.0, help='ジョブごとの処理時間の予算（秒、0で無制限）')
+    parser.add_argument('--llm-budget', type=int, default=0, help='ジョブごとのGemini呼び出し回数の予算（0で無制限）')
+    parser.add_argument('--trace-memory', action='store_true', help='tracemallocでメモリのピークを計測する（遅くなる）')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='結果をJSONで出力する')
+    parser.add_argument('--verbose', action='store_true', help='app.py のログを表示する')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    app.init_local_stores()
+    server = FixtureServer(
+        hosts=args.hosts, latency=args.site_latency, jitter=args.site_jitter,
+        error_rate=args.site_error_rate, seed=args.seed
+    ).start()
+    try:
+        if args.history:
+            history = load_history(args.history, server.base_urls)
+        else:
+            history = synthetic_history(server.base_urls, args.entries, seed=args.seed)
+
+        results = []
+        for concurrency in [int(value) for value in args.concurrency.split(',')]:
+            for _ in range(args.repeat):
+                if args.verbose:
+                    result = run_once(history, concurrency, args)
+                else:
+                    with open(os.devnull, 'w') as devnull:
+                        stdout = sys.stdout
+                        sys.stdout = devnull
+                        try:
+                            result = run_once(history, concurrency, args)
+                        finally:
+                            sys.stdout = stdout
+                results.append(result)
+                if not args.json:
+                    memory = f"{result['peakMemoryMB']:>7.1f}MB" if result['peakMemoryMB'] is not None else '       -'
+                    print(
+                        f"同時実行数 {concurrency:>3}: {result['candidates']:>5}件 {result['seconds']:>7.2f}秒 "
+                        f"{result['urlsPerSecond']:>7.2f} URL/秒  p50 {result['p50Seconds']:.3f}秒  "
+                        f"p99 {result['p99Seconds']:.3f}秒  メモリ {memory}  記事 {result['articles']}件  繰り越し {result['deferred']}件"
+                    )
+        if args.json:
+            print(json.dumps(results, ensure_ascii=False, indent=2))
+    finally:
+        server.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+import os
+import math
+import sqlite3
+import time
+import threading
+
+import host_scheduler
+import keyword_filter
+
+# 履歴ジョブの候補の優先順位と予算
+# 候補ごとに点数（キーワードの強さ・ドメインの評判・訪問の新しさ・訪問回数）を付けて高い順に処理し、
+# ジョブごとの処理時間とGemini呼び出し回数の予算を使い切ったら、残りの候補は次のジョブに回す。
+# ドメインの評判は、過去の分類結果（technical / none）の件数からホストごとに学習する（SQLite）。
+CANDIDATE_SCHEDULER_PATH = os.environ.get('CANDIDATE_SCHEDULER_PATH', 'candidate_scheduler.sqlite3')
+# 0 の場合は制限しない
+JOB_TIME_BUDGET_SECONDS = float(os.environ.get('JOB_TIME_BUDGET_SECONDS', 300))
+JOB_LLM_CALL_BUDGET = int(os.environ.get('JOB_LLM_CALL_BUDGET', 30))
+SCORE_WEIGHTS = {'keyword': 0.3, 'reputation': 0.35, 'recency': 0.2, 'visits': 0.15}
+# この数以上のキーワード・訪問回数は同じ点数として扱う
+KEYWORD_STRENGTH_SATURATION = 3
+VISIT_COUNT_SATURATION = 8
+# 最も新しい訪問からこの日数が経つごとに、新しさの点数が半分になる
+RECENCY_HALF_LIFE_DAYS = float(os.environ.get('RECENCY_HALF_LIFE_DAYS', 7))
+# SQLiteの1回のクエリに渡すホストの数
+_HOST_QUERY_CHUNK = 500
+
+def _connect():
+    conn = sqlite3.connect(CANDIDATE_SCHEDULER_PATH, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+def init_reputation():
+    conn = _connect()
+    try:
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS domain_reputation (
+                host TEXT PRIMARY KEY,
+                technical INTEGER NOT NULL DEFAULT 0,
+                total INTEGER NOT NULL DEFAULT 0,
+                updated_at REAL NOT NULL
+            );
+        """)
+    finally:
+        conn.close()
+
+def record_verdict(url, verdict):
+    """
+    Geminiによる分類結果（technical / none）をURLのホストの評判に加える。
+    """
+    host = host_scheduler.host_of(url)
+    if not host:
+        return
+    conn = _connect()
+    try:
+        conn.execute("""
+            INSERT INTO domain_reputation (host, technical, total, updated_at) VALUES (?, ?, 1, ?)
+            ON CONFLICT(host) DO UPDATE SET
+                technical = technical + excluded.technical, total = total + 1, updated_at = excluded.updated_at
+        """, (host, 1 if verdict == 'technical' else 0, time.time()))
+    finally:
+        conn.close()
+
+def load_reputation(hosts):
+    """
+    ホストごとの評判（技術記事だった割合、0〜1）を {ホスト: 評判} で返す。
+    件数の少ないホストは 0.5 に寄せる（分類結果のないホストは 0.5）。
+    """
+    hosts = list(set(hosts))
+    reputation = {host: 0.5 for host in hosts}
+    conn = _connect()
+    try:
+        for i in range(0, len(hosts), _HOST_QUERY_CHUNK):
+            chunk = hosts[i:i + _HOST_QUERY_CHUNK]
+            rows = conn.execute(
+                f"SELECT host, technical, total FROM domain_reputation WHERE host IN ({','.join('?' * len(chunk))})",
+                chunk
+            ).fetchall()
+            for row in rows:
+                reputation[row['host']] = (row['technical'] + 1) / (row['total'] + 2)
+    finally:
+        conn.close()
+    return reputation
+
+def _visit_count(entry):
+    try:
+        return max(1, int(entry.get('visitCount') or 1))
+    except (TypeError, ValueError):
+        return 1
+
+def score_entries(entries, visit_time_of, matcher=None):
+    """
+    履歴エントリごとの点数（0〜1）をリストで返す。
+    訪問の新しさは、アップロードされた中で最も新しい訪問を基準にする（古い履歴をまとめて送った場合も差が付くように）。
+    """
+    matcher = matcher or keyword_filter.default_matcher
+    visit_times = [visit_time_of(entry) for entry in entries]
+    newest = max((visit_time for visit_time in visit_times if visit_time is not None), default=None)
+    try:
+        reputation = load_reputation(host_scheduler.host_of(entry.get('url') or '') for entry in entries)
+    except Exception as e:
+        print(f"ドメインの評判の読み込み中にエラー: {e}")
+        reputation = {}
+
+    scores = []
+    for entry, visit_time in zip(entries, visit_times):
+        url = entry.get('url') or ''
+        strength = matcher.keyword_strength(entry.get('title'), url)
+        if visit_time is None or newest is None:
+            recency = 0.0
+        else:
+            age_days = (newest - visit_time) / (24 * 60 * 60 * 1000)
+            recency = 0.5 ** (age_days / RECENCY_HALF_LIFE_DAYS)
+        components = {
+            'keyword': min(strength, KEYWORD_STRENGTH_SATURATION) / KEYWORD_STRENGTH_SATURATION,
+            'reputation': reputation.get(host_scheduler.host_of(url), 0.5),
+            'recency': recency,
+            'visits': min(math.log2(_visit_count(entry)) / math.log2(VISIT_COUNT_SATURATION), 1.0)
+        }
+        scores.append(sum(SCORE_WEIGHTS[name] * value for name, value in components.items()))
+    return scores
+
+def prioritize(indexes, entries, visit_time_of):
+    """
+    エントリ番号（indexes）を、対応するエントリ（entries）の点数の高い順に並べ替えて返す。同点の場合は元の順番のまま。
+    """
+    scores = score_entries(entries, visit_time_of)
+    order = sorted(range(len(indexes)), key=lambda i: -scores[i])
+    return [indexes[i] for i in order]
+
+class JobBudget:
+    """
+    1件のジョブの予算（処理時間とGemini呼び出し回数）。
+    Gemini呼び出し回数は job_metrics の集計から再試行分を除いた回数（1回の要約依頼を1回と数える）で、
+    同時に実行中の呼び出しの分だけ上限を超えることがある。
+    予算を使い切った後に処理を始めるエントリは defer() で記録しておき、次のジョブに回す。
+    """
+    def __init__(self, job_metrics, time_seconds=None, llm_calls=None):
+        self.job_metrics = job_metrics
+        self.time_seconds = JOB_TIME_BUDGET_SECONDS if time_seconds is None else time_seconds
+        self.llm_calls = JOB_LLM_CALL_BUDGET if llm_calls is None else llm_calls
+        self.started = time.monotonic()
+        self.deferred = []
+        self._lock = threading.Lock()
+        self._reported = False
+
+    def llm_calls_used(self):
+        # 再試行した呼び出しは最後の試行（成功・失敗）だけを数える
+        return self.job_metrics.llm['calls'] - self.job_metrics.llm['retries']
+
+    def exhausted(self):
+        if self.time_seconds and time.monotonic() - self.started >= self.time_seconds:
+            reason = f"処理時間の予算（{self.time_seconds:g}秒）"
+        elif self.llm_calls and self.llm_calls_used() >= self.llm_calls:
+            reason = f"Gemini呼び出しの予算（{self.llm_calls}回）"
+        else:
+            return False
+        with self._lock:
+            if not self._reported:
+                self._reported = True
+                print(f"  -> ⏳ {reason}を使い切ったため、残りのエントリは次のジョブに回します")
+        return True
+
+    def defer(self, positions):
+        with self._lock:
+            self.deferred.extend(positions)
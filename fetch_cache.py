@@ -0,0 +1,120 @@
+import os
+import json
+import sqlite3
+import time
+from urllib.parse import urlsplit
+
+# スクレイピング結果のキャッシュ（SQLite）
+# URLごとに抽出済みの本文・OGPと ETag / Last-Modified を保存し、次回は条件付きリクエストで再検証する。
+# 取得に失敗したURLは失敗回数に応じて間隔を空け（指数バックオフ）、その間は取得しない。
+FETCH_CACHE_PATH = os.environ.get('FETCH_CACHE_PATH', 'fetch_cache.sqlite3')
+FETCH_CACHE_FRESH_SECONDS = int(os.environ.get('FETCH_CACHE_FRESH_SECONDS', 60 * 60))
+FETCH_CACHE_MAX_AGE_SECONDS = int(os.environ.get('FETCH_CACHE_MAX_AGE_SECONDS', 30 * 24 * 60 * 60))
+FETCH_BACKOFF_BASE_SECONDS = int(os.environ.get('FETCH_BACKOFF_BASE_SECONDS', 5 * 60))
+FETCH_BACKOFF_MAX_SECONDS = int(os.environ.get('FETCH_BACKOFF_MAX_SECONDS', 24 * 60 * 60))
+
+def _connect():
+    conn = sqlite3.connect(FETCH_CACHE_PATH, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+def init_cache():
+    conn = _connect()
+    try:
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS fetch_cache (
+                url TEXT PRIMARY KEY,
+                host TEXT NOT NULL,
+                text TEXT,
+                ogp TEXT,
+                etag TEXT,
+                last_modified TEXT,
+                fetched_at REAL,
+                failures INTEGER NOT NULL DEFAULT 0,
+                retry_after REAL,
+                last_error TEXT
+            );
+            CREATE INDEX IF NOT EXISTS fetch_cache_host ON fetch_cache (host);
+        """)
+        conn.execute(
+            "DELETE FROM fetch_cache WHERE COALESCE(fetched_at, 0) < ? AND COALESCE(retry_after, 0) < ?",
+            (time.time() - FETCH_CACHE_MAX_AGE_SECONDS, time.time())
+        )
+    finally:
+        conn.close()
+
+def lookup(url):
+    """
+    URLのキャッシュを辞書で返す。なければ None を返す。
+    """
+    conn = _connect()
+    try:
+        row = conn.execute("SELECT * FROM fetch_cache WHERE url = ?", (url,)).fetchone()
+    finally:
+        conn.close()
+    if not row:
+        return None
+    entry = dict(row)
+    entry['ogp'] = json.loads(entry['ogp']) if entry['ogp'] else {}
+    return entry
+
+def is_fresh(entry, now=None):
+    now = now or time.time()
+    return entry['text'] is not None and now - (entry['fetched_at'] or 0) < FETCH_CACHE_FRESH_SECONDS
+
+def is_backing_off(entry, now=None):
+    now = now or time.time()
+    return bool(entry['retry_after'] and entry['retry_after'] > now)
+
+def store_success(url, text, ogp, etag=None, last_modified=None):
+    conn = _connect()
+    try:
+        conn.execute("""
+            INSERT OR REPLACE INTO fetch_cache (url, host, text, ogp, etag, last_modified, fetched_at, failures, retry_after, last_error)
+            VALUES (?, ?, ?, ?, ?, ?, ?, 0, NULL, NULL)
+        """, (url, urlsplit(url).netloc.lower(), text, json.dumps(ogp or {}, ensure_ascii=False), etag, last_modified, time.time()))
+    finally:
+        conn.close()
+
+def mark_not_modified(url):
+    """
+    304 Not Modified が返ったURLの取得日時を更新する。
+    """
+    conn = _connect()
+    try:
+        conn.execute(
+            "UPDATE fetch_cache SET fetched_at = ?, failures = 0, retry_after = NULL, last_error = NULL WHERE url = ?",
+            (time.time(), url)
+        )
+    finally:
+        conn.close()
+
+def store_failure(url, error):
+    """
+    取得の失敗を記録し、失敗回数に応じて次に取得してよい時刻を延ばす。保存済みの本文は残す。
+    """
+    now = time.time()
+    conn = _connect()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        row = conn.execute("SELECT failures FROM fetch_cache WHERE url = ?", (url,)).fetchone()
+        failures = (row['failures'] if row else 0) + 1
+        retry_after = now + min(FETCH_BACKOFF_BASE_SECONDS * 2 ** (failures - 1), FETCH_BACKOFF_MAX_SECONDS)
+        if row:
+            conn.execute(
+                "UPDATE fetch_cache SET failures = ?, retry_after = ?, last_error = ? WHERE url = ?",
+                (failures, retry_after, str(error)[:500], url)
+            )
+        else:
+            conn.execute(
+                "INSERT INTO fetch_cache (url, host, failures, retry_after, last_error) VALUES (?, ?, ?, ?, ?)",
+                (url, urlsplit(url).netloc.lower(), failures, retry_after, str(error)[:500])
+            )
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
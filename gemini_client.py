@@ -0,0 +1,214 @@
+import os
+import random
+import sqlite3
+import time
+import uuid
+
+import requests
+from google.api_core import exceptions as google_exceptions
+
+import metrics
+
+# Gemini呼び出しの共通ラッパー
+# 全ワーカープロセスで共有するSQLite上のトークンバケット（RPM・TPM）と同時実行数の上限を守って呼び出し、
+# 一時的なエラー（429・5xx・タイムアウト）はジッター付きの指数バックオフで再試行する。
+# 再試行しても失敗した場合は GeminiUnavailableError を送出し、「技術記事ではない」とは扱わない。
+GEMINI_LIMITER_PATH = os.environ.get('GEMINI_LIMITER_PATH', 'gemini_limiter.sqlite3')
+GEMINI_RPM = int(os.environ.get('GEMINI_RPM', 15))
+GEMINI_TPM = int(os.environ.get('GEMINI_TPM', 250000))
+GEMINI_MAX_IN_FLIGHT = int(os.environ.get('GEMINI_MAX_IN_FLIGHT', 4))
+GEMINI_MAX_RETRIES = int(os.environ.get('GEMINI_MAX_RETRIES', 5))
+GEMINI_BACKOFF_BASE_SECONDS = float(os.environ.get('GEMINI_BACKOFF_BASE_SECONDS', 2))
+GEMINI_BACKOFF_MAX_SECONDS = float(os.environ.get('GEMINI_BACKOFF_MAX_SECONDS', 60))
+# プロセスが落ちても同時実行枠が残り続けないよう、枠には期限を付ける
+GEMINI_SLOT_TTL_SECONDS = 180
+GEMINI_POLL_MAX_SECONDS = 1.0
+# 日本語を含むプロンプトの大まかなトークン数の見積もり（1トークンあたりの文字数）と、応答分の見込み
+CHARS_PER_TOKEN = 2
+OUTPUT_TOKEN_ALLOWANCE = 512
+
+RETRYABLE_ERRORS = (
+    google_exceptions.TooManyRequests,
+    google_exceptions.ResourceExhausted,
+    google_exceptions.InternalServerError,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.DeadlineExceeded,
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    ConnectionError,
+    TimeoutError,
+)
+
+class GeminiUnavailableError(Exception):
+    """
+    レート制限や一時的な障害のため、再試行してもGeminiを呼び出せなかったことを表す。
+    """
+
+def _connect():
+    conn = sqlite3.connect(GEMINI_LIMITER_PATH, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+def init_limiter():
+    conn = _connect()
+    try:
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS buckets (
+                name TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS in_flight (
+                slot_id TEXT PRIMARY KEY,
+                expires_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS pause (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                until REAL NOT NULL
+            );
+        """)
+    finally:
+        conn.close()
+
+def _refill(conn, name, capacity, now):
+    """
+    バケットを経過時間分だけ補充して現在のトークン数を返す（1分で capacity まで回復する）。
+    """
+    row = conn.execute("SELECT tokens, updated_at FROM buckets WHERE name = ?", (name,)).fetchone()
+    if row is None:
+        return float(capacity)
+    return min(float(capacity), row['tokens'] + (now - row['updated_at']) * capacity / 60.0)
+
+def _try_acquire(tokens):
+    """
+    同時実行枠とバケットのトークンを取得できれば (枠ID, 0) を、できなければ (None, 待つべき秒数) を返す。
+    """
+    now = time.time()
+    tokens = min(tokens, GEMINI_TPM)
+    conn = _connect()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        paused = conn.execute("SELECT until FROM pause WHERE id = 1").fetchone()
+        if paused and paused['until'] > now:
+            conn.execute('COMMIT')
+            return None, paused['until'] - now
+
+        conn.execute("DELETE FROM in_flight WHERE expires_at < ?", (now,))
+        in_flight = conn.execute("SELECT COUNT(*) FROM in_flight").fetchone()[0]
+        if in_flight >= GEMINI_MAX_IN_FLIGHT:
+            conn.execute('COMMIT')
+            return None, 0.1
+
+        requests_left = _refill(conn, 'requests', GEMINI_RPM, now)
+        tokens_left = _refill(conn, 'tokens', GEMINI_TPM, now)
+        wait = max(
+            (1 - requests_left) * 60.0 / GEMINI_RPM,
+            (tokens - tokens_left) * 60.0 / GEMINI_TPM,
+            0
+        )
+        if wait > 0:
+            conn.execute('COMMIT')
+            return None, wait
+
+        slot_id = uuid.uuid4().hex
+        conn.executemany(
+            "INSERT OR REPLACE INTO buckets (name, tokens, updated_at) VALUES (?, ?, ?)",
+            [('requests', requests_left - 1, now), ('tokens', tokens_left - tokens, now)]
+        )
+        conn.execute("INSERT INTO in_flight (slot_id, expires_at) VALUES (?, ?)", (slot_id, now + GEMINI_SLOT_TTL_SECONDS))
+        conn.execute('COMMIT')
+        return slot_id, 0
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+
+def acquire(tokens):
+    """
+    呼び出し枠が空くまで待ってから枠IDを返す。待った秒数も合わせて返す。
+    """
+    started = time.monotonic()
+    while True:
+        slot_id, wait = _try_acquire(tokens)
+        if slot_id:
+            return slot_id, time.monotonic() - started
+        # 同時に待っているプロセスが一斉に動き出さないよう、待ち時間を少しずらす
+        time.sleep(min(wait, GEMINI_POLL_MAX_SECONDS) * random.uniform(0.8, 1.2) + 0.01)
+
+def release(slot_id):
+    conn = _connect()
+    try:
+        conn.execute("DELETE FROM in_flight WHERE slot_id = ?", (slot_id,))
+    finally:
+        conn.close()
+
+def adjust_tokens(delta):
+    """
+    見積もりと実際の使用トークン数の差をバケットに反映する。
+    """
+    conn = _connect()
+    try:
+        conn.execute("UPDATE buckets SET tokens = MIN(tokens - ?, ?) WHERE name = 'tokens'", (delta, GEMINI_TPM))
+    finally:
+        conn.close()
+
+def pause_until(until):
+    """
+    429が返った場合に、全プロセスの呼び出しを指定時刻まで止める。
+    """
+    conn = _connect()
+    try:
+        conn.execute(
+            "INSERT INTO pause (id, until) VALUES (1, ?) ON CONFLICT(id) DO UPDATE SET until = MAX(until, excluded.until)",
+            (until,)
+        )
+    finally:
+        conn.close()
+
+def estimate_tokens(prompt):
+    return len(prompt) // CHARS_PER_TOKEN + OUTPUT_TOKEN_ALLOWANCE
+
+class GeminiClient:
+    """
+    GenerativeModel をラップし、レート制限・同時実行数の上限・再試行をまとめて行う。
+    """
+    def __init__(self, model):
+        self.model = model
+
+    def generate_content(self, prompt, **kwargs):
+        estimated = estimate_tokens(prompt)
+        last_error = None
+        for attempt in range(GEMINI_MAX_RETRIES + 1):
+            slot_id, waited = acquire(estimated)
+            try:
+                response = self.model.generate_content(prompt, **kwargs)
+            except RETRYABLE_ERRORS as e:
+                last_error = e
+                metrics.record_llm_call('retry' if attempt < GEMINI_MAX_RETRIES else 'unavailable', waited)
+            except Exception:
+                metrics.record_llm_call('error', waited)
+                raise
+            else:
+                usage = getattr(response, 'usage_metadata', None)
+                prompt_tokens = getattr(usage, 'prompt_token_count', 0) if usage else 0
+                output_tokens = getattr(usage, 'candidates_token_count', 0) if usage else 0
+                if prompt_tokens or output_tokens:
+                    adjust_tokens(prompt_tokens + output_tokens - estimated)
+                metrics.record_llm_call('ok', waited, prompt_tokens, output_tokens)
+                return response
+            finally:
+                release(slot_id)
+
+            if attempt == GEMINI_MAX_RETRIES:
+                break
+            # Full Jitter: 0 〜 上限の間でランダムに待つ
+            delay = random.uniform(0, min(GEMINI_BACKOFF_MAX_SECONDS, GEMINI_BACKOFF_BASE_SECONDS * 2 ** attempt))
+            if isinstance(last_error, (google_exceptions.TooManyRequests, google_exceptions.ResourceExhausted)):
+                pause_until(time.time() + delay)
+            print(f"  -> ⏳ Gemini呼び出しに失敗したため{delay:.1f}秒後に再試行します ({attempt + 1}/{GEMINI_MAX_RETRIES}): {last_error}")
+            time.sleep(delay)
+
+        raise GeminiUnavailableError(f"Geminiを呼び出せませんでした: {last_error}") from last_error
@@ -0,0 +1,201 @@
+import os
+import json
+import zlib
+import codecs
+import itertools
+
+# /history へアップロードされた履歴の逐次読み込み
+# リクエストの本文を少しずつ読みながら（gzipなら展開しながら）エントリを1件ずつ返し、
+# 本文全体やエントリのリスト全体をメモリに持たないようにする。
+# JSON配列（[{...}, {...}]）とNDJSON（1行に1エントリ）に対応する。
+HISTORY_MAX_BODY_BYTES = int(os.environ.get('HISTORY_MAX_BODY_BYTES', 64 * 1024 * 1024))
+HISTORY_READ_CHUNK_SIZE = 64 * 1024
+NDJSON_CONTENT_TYPES = ('application/x-ndjson', 'application/ndjson', 'application/jsonl', 'application/x-jsonlines')
+GZIP_MAGIC = b'\x1f\x8b'
+
+class HistoryUploadError(Exception):
+    """
+    アップロードされた履歴を読み込めなかったことを表す。status_code はクライアントに返すHTTPステータス。
+    """
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+def _read_chunks(stream, content_encoding, max_bytes):
+    """
+    本文を展開しながらチャンクごとに返す。展開後の大きさが max_bytes を超えたら HistoryUploadError を送出する。
+    Content-Encoding がなくても、先頭がgzipのマジックナンバーであれば展開する。
+    """
+    decompressor = None
+    total = 0
+    first = True
+    while True:
+        chunk = stream.read(HISTORY_READ_CHUNK_SIZE)
+        if not chunk:
+            break
+        if first:
+            first = False
+            while len(chunk) < len(GZIP_MAGIC):
+                more = stream.read(HISTORY_READ_CHUNK_SIZE)
+                if not more:
+                    break
+                chunk += more
+            if content_encoding == 'gzip' or chunk.startswith(GZIP_MAGIC):
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            elif content_encoding not in ('', 'identity'):
+                raise HistoryUploadError(f"Unsupported Content-Encoding: {content_encoding}", 415)
+        if decompressor:
+            try:
+                # 展開後の大きさも上限で抑え、圧縮率の極端に高いデータでメモリを使い切らないようにする
+                chunk = decompressor.decompress(chunk, max_bytes - total + 1)
+            except zlib.error as e:
+                raise HistoryUploadError(f"Invalid gzip body: {e}")
+            if decompressor.unconsumed_tail:
+                raise HistoryUploadError("History upload is too large", 413)
+        total += len(chunk)
+        if total > max_bytes:
+            raise HistoryUploadError("History upload is too large", 413)
+        yield chunk
+    if decompressor:
+        try:
+            rest = decompressor.flush()
+        except zlib.error as e:
+            raise HistoryUploadError(f"Invalid gzip body: {e}")
+        if total + len(rest) > max_bytes:
+            raise HistoryUploadError("History upload is too large", 413)
+        if rest:
+            yield rest
+
+def _read_text(stream, content_encoding, max_bytes):
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    for chunk in _read_chunks(stream, content_encoding, max_bytes):
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    text = decoder.decode(b'', final=True)
+    if text:
+        yield text
+
+def _iter_ndjson(texts, head=''):
+    pending = ''
+    for text in itertools.chain([head], texts):
+        pending += text
+        lines = pending.split('\n')
+        pending = lines.pop()
+        for line in lines:
+            if line.strip():
+                yield _decode_entry(line)
+    if pending.strip():
+        yield _decode_entry(pending)
+
+def _decode_entry(line):
+    try:
+        return json.loads(line)
+    except json.JSONDecodeError as e:
+        raise HistoryUploadError(f"Invalid JSON line: {e}")
+
+def _iter_json_array(texts, head=''):
+    """
+    JSON配列の要素を、配列全体を読み終える前から1件ずつ返す。
+    """
+    decoder = json.JSONDecoder()
+    texts = iter(texts)
+    buffer = head
+    position = 0
+    finished = False
+    state = 'start'
+
+    def skip_whitespace(buffer, position):
+        while position < len(buffer) and buffer[position] in ' \t\r\n':
+            position += 1
+        return position
+
+    while True:
+        position = skip_whitespace(buffer, position)
+        if position >= len(buffer) and not finished:
+            # 読み終えた部分は捨てて、次のチャンクを読み足す
+            buffer = buffer[position:]
+            position = 0
+            text = next(texts, None)
+            if text is None:
+                finished = True
+            else:
+                buffer += text
+            continue
+        if position >= len(buffer):
+            raise HistoryUploadError("Unexpected end of JSON array")
+
+        char = buffer[position]
+        if state == 'start':
+            if char != '[':
+                raise HistoryUploadError("Invalid JSON: expected an array of history entries")
+            position += 1
+            state = 'first'
+        elif state == 'first' and char == ']':
+            position += 1
+            state = 'end'
+        elif state in ('first', 'value'):
+            try:
+                entry, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError as e:
+                if finished:
+                    raise HistoryUploadError(f"Invalid JSON: {e}")
+                entry, end = None, None
+            # 要素がチャンクの境目で切れている場合（末尾まで読めた数値なども含む）は読み足してから解析し直す
+            if end is None or (end >= len(buffer) and not finished):
+                text = next(texts, None)
+                if text is None:
+                    finished = True
+                else:
+                    buffer = buffer[position:] + text
+                    position = 0
+                continue
+            yield entry
+            position = end
+            state = 'separator'
+        elif state == 'separator':
+            if char == ',':
+                state = 'value'
+            elif char == ']':
+                state = 'end'
+            else:
+                raise HistoryUploadError("Invalid JSON: expected ',' or ']'")
+            position += 1
+        else:
+            raise HistoryUploadError("Invalid JSON: unexpected data after the array")
+
+        if state == 'end':
+            position = skip_whitespace(buffer, position)
+            while position >= len(buffer) and not finished:
+                text = next(texts, None)
+                if text is None:
+                    finished = True
+                else:
+                    buffer, position = text, skip_whitespace(text, 0)
+            if position < len(buffer):
+                raise HistoryUploadError("Invalid JSON: unexpected data after the array")
+            return
+
+def iter_history_entries(stream, content_type='', content_encoding='', max_bytes=None):
+    """
+    リクエストの本文（ファイルのようなオブジェクト）から履歴エントリを1件ずつ返す。
+    Content-TypeがNDJSONのもの、または先頭が '{' の場合はNDJSON、それ以外はJSON配列として読む。
+    """
+    max_bytes = HISTORY_MAX_BODY_BYTES if max_bytes is None else max_bytes
+    content_type = (content_type or '').split(';')[0].strip().lower()
+    content_encoding = (content_encoding or '').strip().lower()
+    texts = _read_text(stream, content_encoding, max_bytes)
+
+    # 先頭の空白を読み飛ばして形式を判定する
+    head = ''
+    for text in texts:
+        head = text.lstrip('\ufeff \t\r\n')
+        if head:
+            break
+    if not head:
+        raise HistoryUploadError("Empty history upload")
+
+    if content_type in NDJSON_CONTENT_TYPES or head.startswith('{'):
+        yield from _iter_ndjson(texts, head)
+    else:
+        yield from _iter_json_array(texts, head)
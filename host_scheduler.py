@@ -0,0 +1,142 @@
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+
+# ホストごとの取得スケジューラ
+# 同じサイトへの間隔（レート制限）、応答時間に合わせたタイムアウト、
+# 失敗が続くホストを一定時間飛ばすサーキットブレーカーをプロセス全体で管理する。
+HOST_MIN_INTERVAL_SECONDS = float(os.environ.get('HOST_MIN_INTERVAL_SECONDS', 0.5))
+HOST_CONNECT_TIMEOUT = float(os.environ.get('HOST_CONNECT_TIMEOUT', 5))
+HOST_READ_TIMEOUT = float(os.environ.get('HOST_READ_TIMEOUT', 20))
+HOST_MIN_READ_TIMEOUT = float(os.environ.get('HOST_MIN_READ_TIMEOUT', 3))
+HOST_TIMEOUT_MULTIPLIER = float(os.environ.get('HOST_TIMEOUT_MULTIPLIER', 4))
+HOST_LATENCY_SAMPLES = 3
+HOST_LATENCY_ALPHA = 0.3
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get('CIRCUIT_FAILURE_THRESHOLD', 3))
+CIRCUIT_OPEN_SECONDS = float(os.environ.get('CIRCUIT_OPEN_SECONDS', 60))
+CIRCUIT_MAX_OPEN_SECONDS = float(os.environ.get('CIRCUIT_MAX_OPEN_SECONDS', 30 * 60))
+
+def host_of(url):
+    return urlsplit(url).netloc.lower()
+
+class _HostState:
+    def __init__(self):
+        self.next_allowed = 0.0
+        self.latency = None
+        self.samples = 0
+        self.failures = 0
+        self.open_until = 0.0
+        self.open_count = 0
+
+class HostScheduler:
+    """
+    ホストごとの状態（次に取得してよい時刻・応答時間・連続失敗数）を保持する。
+    取得処理はスレッドプールから呼ばれるため、状態の更新はロックの中で行う。
+    """
+    def __init__(self):
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def _state(self, host):
+        state = self._hosts.get(host)
+        if state is None:
+            state = self._hosts[host] = _HostState()
+        return state
+
+    def allow(self, host):
+        """
+        サーキットが開いているホストは False を返す（状態は変えない）。
+        """
+        now = time.monotonic()
+        with self._lock:
+            state = self._hosts.get(host)
+            return state is None or state.open_until <= now
+
+    def start_request(self, host):
+        """
+        実際にリクエストを送る直前に呼び、送ってよければ True を返す。
+        サーキットの待機時間が過ぎたホストには1件だけ試しに通し（半開）、その結果で閉じるか開き直すかを決める。
+        """
+        now = time.monotonic()
+        with self._lock:
+            state = self._state(host)
+            if state.open_until > now:
+                return False
+            if state.failures >= CIRCUIT_FAILURE_THRESHOLD:
+                # 試しの1件が終わるまでは他のリクエストを通さない
+                state.open_until = now + HOST_CONNECT_TIMEOUT + HOST_READ_TIMEOUT
+            return True
+
+    def reserve(self, host):
+        """
+        ホストへの次の取得枠を予約し、それまで待つべき秒数を返す。
+        """
+        now = time.monotonic()
+        with self._lock:
+            state = self._state(host)
+            start = max(now, state.next_allowed)
+            state.next_allowed = start + HOST_MIN_INTERVAL_SECONDS
+            return start - now
+
+    def timeout_for(self, host):
+        """
+        これまでの応答時間から (接続タイムアウト, 読み込みタイムアウト) を決める。
+        数回分の記録が揃うまでは既定値を使う。
+        """
+        with self._lock:
+            state = self._hosts.get(host)
+            if state is None or state.samples < HOST_LATENCY_SAMPLES:
+                return (HOST_CONNECT_TIMEOUT, HOST_READ_TIMEOUT)
+            read_timeout = min(HOST_READ_TIMEOUT, max(HOST_MIN_READ_TIMEOUT, state.latency * HOST_TIMEOUT_MULTIPLIER))
+            return (HOST_CONNECT_TIMEOUT, read_timeout)
+
+    def record_success(self, host, elapsed):
+        with self._lock:
+            state = self._state(host)
+            state.latency = elapsed if state.latency is None else (
+                HOST_LATENCY_ALPHA * elapsed + (1 - HOST_LATENCY_ALPHA) * state.latency
+            )
+            state.samples += 1
+            state.failures = 0
+            state.open_until = 0.0
+            state.open_count = 0
+
+    def record_failure(self, host, retry_after=None):
+        """
+        接続エラー・タイムアウト・5xx・429 を記録する。連続して失敗したホストはサーキットを開く。
+        retry_after（秒）が指定された場合は、それまで次の取得を遅らせる。
+        """
+        now = time.monotonic()
+        with self._lock:
+            state = self._state(host)
+            state.failures += 1
+            if retry_after:
+                state.next_allowed = max(state.next_allowed, now + retry_after)
+            if state.failures >= CIRCUIT_FAILURE_THRESHOLD:
+                open_seconds = min(CIRCUIT_OPEN_SECONDS * 2 ** state.open_count, CIRCUIT_MAX_OPEN_SECONDS)
+                state.open_until = now + open_seconds
+                state.open_count += 1
+                print(f"⚠️ 失敗が続いているため {host} への取得を{int(open_seconds)}秒間停止します")
+
+def interleave_by_host(items, url_of):
+    """
+    同じホストのURLが固まらないよう、ホストごとに1件ずつ順番に並べ替える。
+    各ホスト内の順番は元の順番のまま。
+    """
+    queues = {}
+    for item in items:
+        queues.setdefault(host_of(url_of(item) or ''), []).append(item)
+    interleaved = []
+    rounds = [iter(queue) for queue in queues.values()]
+    while rounds:
+        remaining = []
+        for queue in rounds:
+            item = next(queue, None)
+            if item is not None:
+                interleaved.append(item)
+                remaining.append(queue)
+        rounds = remaining
+    return interleaved
+
+default_scheduler = HostScheduler()
@@ -0,0 +1,338 @@
+import os
+import json
+import sqlite3
+import time
+import uuid
+
+# 履歴処理ジョブの永続キュー（SQLite）
+# Webワーカーはジョブを積むだけで、実際の処理は worker.py のワーカープロセスが取り出して行う。
+# 記事ごとの進捗もここに記録し、ワーカーが落ちても途中から再開できるようにする。
+JOB_QUEUE_PATH = os.environ.get('JOB_QUEUE_PATH', 'jobs.sqlite3')
+JOB_LEASE_SECONDS = int(os.environ.get('JOB_LEASE_SECONDS', 120))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 3))
+MAX_RUNNING_JOBS = int(os.environ.get('MAX_RUNNING_JOBS', 4))
+MAX_RUNNING_JOBS_PER_USER = int(os.environ.get('MAX_RUNNING_JOBS_PER_USER', 1))
+MAX_QUEUED_JOBS = int(os.environ.get('MAX_QUEUED_JOBS', 200))
+MAX_QUEUED_JOBS_PER_USER = int(os.environ.get('MAX_QUEUED_JOBS_PER_USER', 3))
+
+def _connect():
+    conn = sqlite3.connect(JOB_QUEUE_PATH, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+def init_queue():
+    conn = _connect()
+    try:
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                worker_id TEXT,
+                lease_until REAL,
+                available_at REAL,
+                progress TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (status, created_at);
+            CREATE INDEX IF NOT EXISTS jobs_user_status ON jobs (user_id, status);
+            CREATE TABLE IF NOT EXISTS job_progress (
+                job_id TEXT NOT NULL,
+                entry_index INTEGER NOT NULL,
+                article TEXT,
+                article_id TEXT,
+                PRIMARY KEY (job_id, entry_index)
+            );
+            CREATE TABLE IF NOT EXISTS maintenance_requests (
+                user_id TEXT NOT NULL,
+                task TEXT NOT NULL,
+                requested_at REAL NOT NULL,
+                PRIMARY KEY (user_id, task)
+            );
+        """)
+        # 後から追加した列（既存のキューファイル向け）
+        columns = {row['name'] for row in conn.execute("PRAGMA table_info(jobs)")}
+        if 'available_at' not in columns:
+            conn.execute("ALTER TABLE jobs ADD COLUMN available_at REAL")
+        if 'progress' not in columns:
+            conn.execute("ALTER TABLE jobs ADD COLUMN progress TEXT")
+        progress_columns = {row['name'] for row in conn.execute("PRAGMA table_info(job_progress)")}
+        if 'article_id' not in progress_columns:
+            conn.execute("ALTER TABLE job_progress ADD COLUMN article_id TEXT")
+    finally:
+        conn.close()
+
+class JobRejectedError(Exception):
+    """
+    キューの上限（全体・ユーザーごとの待ちジョブ数）に達しているため、ジョブを受け付けられないことを表す。
+    """
+
+def _admission_error(conn, user_id):
+    total = conn.execute(
+        "SELECT COUNT(*) FROM jobs WHERE status IN ('queued', 'running')"
+    ).fetchone()[0]
+    if total >= MAX_QUEUED_JOBS:
+        return "Too many jobs are waiting. Please try again later."
+    per_user = conn.execute(
+        "SELECT COUNT(*) FROM jobs WHERE user_id = ? AND status IN ('queued', 'running')", (user_id,)
+    ).fetchone()[0]
+    if per_user >= MAX_QUEUED_JOBS_PER_USER:
+        return "You already have jobs in progress. Please wait for them to finish."
+    return None
+
+def admission_error(user_id):
+    """
+    新しいジョブを受け付けられない場合はその理由を、受け付けられる場合は None を返す。
+    アップロードを読み込む前に断るための事前の確認で、実際の受付は enqueue_job が同じ確認と合わせて行う。
+    """
+    conn = _connect()
+    try:
+        return _admission_error(conn, user_id)
+    finally:
+        conn.close()
+
+def enqueue_job(job_id, user_id, history_data, delay=0):
+    """
+    ジョブをキューに積む。delay を指定した場合は、その秒数が経つまで取り出さない。
+    上限の確認と追加は1つのトランザクションで行い、上限に達していれば JobRejectedError を送出する。
+    """
+    now = time.time()
+    conn = _connect()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            error = _admission_error(conn, user_id)
+            if not error:
+                conn.execute(
+                    "INSERT INTO jobs (job_id, user_id, payload, status, available_at, created_at, updated_at) VALUES (?, ?, ?, 'queued', ?, ?, ?)",
+                    (job_id, user_id, json.dumps(history_data, ensure_ascii=False), now + delay if delay else None, now, now)
+                )
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+    finally:
+        conn.close()
+    if error:
+        raise JobRejectedError(error)
+
+def claim_job(worker_id):
+    """
+    実行可能なジョブを1件取り出してリースを取得する。
+    全体とユーザーごとの同時実行数の上限を守り、リースが切れたジョブ（ワーカーが落ちたもの）も再取得の対象にする。
+    取り出せるジョブがなければ None を返す。
+    """
+    now = time.time()
+    conn = _connect()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        running = conn.execute(
+            "SELECT COUNT(*) FROM jobs WHERE status = 'running' AND lease_until >= ?", (now,)
+        ).fetchone()[0]
+        if running >= MAX_RUNNING_JOBS:
+            conn.execute('COMMIT')
+            return None
+
+        row = conn.execute("""
+            SELECT job_id, user_id, payload, attempts FROM jobs
+            WHERE ((status = 'queued' AND COALESCE(available_at, 0) <= :now) OR (status = 'running' AND lease_until < :now))
+              AND user_id NOT IN (
+                  SELECT user_id FROM jobs
+                  WHERE status = 'running' AND lease_until >= :now
+                  GROUP BY user_id HAVING COUNT(*) >= :per_user
+              )
+            ORDER BY created_at
+            LIMIT 1
+        """, {'now': now, 'per_user': MAX_RUNNING_JOBS_PER_USER}).fetchone()
+        if not row:
+            conn.execute('COMMIT')
+            return None
+
+        conn.execute(
+            "UPDATE jobs SET status = 'running', worker_id = ?, lease_until = ?, attempts = attempts + 1, updated_at = ? WHERE job_id = ?",
+            (worker_id, now + JOB_LEASE_SECONDS, now, row['job_id'])
+        )
+        conn.execute('COMMIT')
+        return {
+            'job_id': row['job_id'],
+            'user_id': row['user_id'],
+            'history_data': json.loads(row['payload']),
+            'attempts': row['attempts'] + 1
+        }
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+
+def extend_lease(job_id, worker_id):
+    conn = _connect()
+    try:
+        now = time.time()
+        conn.execute(
+            "UPDATE jobs SET lease_until = ?, updated_at = ? WHERE job_id = ? AND worker_id = ? AND status = 'running'",
+            (now + JOB_LEASE_SECONDS, now, job_id, worker_id)
+        )
+    finally:
+        conn.close()
+
+def finish_job(job_id, status='done'):
+    """
+    ジョブを完了（done）または失敗（failed）として記録し、記事ごとの進捗を削除する。
+    """
+    conn = _connect()
+    try:
+        conn.execute(
+            "UPDATE jobs SET status = ?, payload = '[]', lease_until = NULL, updated_at = ? WHERE job_id = ?",
+            (status, time.time(), job_id)
+        )
+        conn.execute("DELETE FROM job_progress WHERE job_id = ?", (job_id,))
+    finally:
+        conn.close()
+
+def release_job(job_id, retry_delay=0):
+    """
+    処理に失敗したジョブをキューに戻す。試行回数が上限に達していれば failed にして False を返す。
+    retry_delay（秒）を指定すると、その間は再取得されない。
+    """
+    conn = _connect()
+    try:
+        attempts = conn.execute("SELECT attempts FROM jobs WHERE job_id = ?", (job_id,)).fetchone()[0]
+        if attempts >= JOB_MAX_ATTEMPTS:
+            finish_job(job_id, status='failed')
+            return False
+        conn.execute(
+            "UPDATE jobs SET status = 'queued', worker_id = NULL, lease_until = NULL, available_at = ?, updated_at = ? WHERE job_id = ?",
+            (time.time() + retry_delay, time.time(), job_id)
+        )
+        return True
+    finally:
+        conn.close()
+
+def record_job_progress(job_id, progress):
+    """
+    ジョブ全体の進捗（件数・段階ごとの処理速度・保存済みの記事ID）を記録する。Webサーバーの進捗ストリームが読む。
+    """
+    conn = _connect()
+    try:
+        conn.execute(
+            "UPDATE jobs SET progress = ? WHERE job_id = ?",
+            (json.dumps(progress, ensure_ascii=False), job_id)
+        )
+    finally:
+        conn.close()
+
+def get_job_status(job_id):
+    """
+    ジョブの状態と進捗を返す。ジョブがなければ None を返す。
+    """
+    conn = _connect()
+    try:
+        row = conn.execute(
+            "SELECT user_id, status, attempts, available_at, progress FROM jobs WHERE job_id = ?", (job_id,)
+        ).fetchone()
+        if not row:
+            return None
+        return {
+            'user_id': row['user_id'],
+            'status': row['status'],
+            'attempts': row['attempts'],
+            'available_at': row['available_at'],
+            'progress': json.loads(row['progress']) if row['progress'] else None
+        }
+    finally:
+        conn.close()
+
+def load_progress(job_id):
+    """
+    チェックポイント済みのエントリを {エントリ番号: 記事 or None} の形で返す。
+    """
+    conn = _connect()
+    try:
+        rows = conn.execute(
+            "SELECT entry_index, article FROM job_progress WHERE job_id = ?", (job_id,)
+        ).fetchall()
+        return {row['entry_index']: (json.loads(row['article']) if row['article'] else None) for row in rows}
+    finally:
+        conn.close()
+
+def record_progress(job_id, entry_index, article):
+    conn = _connect()
+    try:
+        conn.execute(
+            "INSERT OR REPLACE INTO job_progress (job_id, entry_index, article) VALUES (?, ?, ?)",
+            (job_id, entry_index, json.dumps(article, ensure_ascii=False) if article else None)
+        )
+    finally:
+        conn.close()
+
+def load_committed(job_id):
+    """
+    Firestoreへの保存が済んだエントリを {エントリ番号: 記事ID} の形で返す。
+    """
+    conn = _connect()
+    try:
+        rows = conn.execute(
+            "SELECT entry_index, article_id FROM job_progress WHERE job_id = ? AND article_id IS NOT NULL", (job_id,)
+        ).fetchall()
+        return {row['entry_index']: row['article_id'] for row in rows}
+    finally:
+        conn.close()
+
+def record_committed(job_id, article_ids):
+    """
+    保存が済んだエントリの記事ID（{エントリ番号: 記事ID}）を記録し、再試行の際に保存し直さないようにする。
+    """
+    conn = _connect()
+    try:
+        conn.executemany(
+            "UPDATE job_progress SET article_id = ? WHERE job_id = ? AND entry_index = ?",
+            [(article_id, job_id, entry_index) for entry_index, article_id in article_ids.items()]
+        )
+    finally:
+        conn.close()
+
+# ユーザーごとの作り直し（ファセットの数え直しなど）の依頼
+# 全記事を読むような処理はWebのリクエストでは行わず、ここに依頼を積んでワーカーが空いているときに行う。
+# 同じユーザー・同じ作業の依頼は1件にまとめる。
+
+def request_maintenance(user_id, task):
+    conn = _connect()
+    try:
+        conn.execute(
+            "INSERT OR IGNORE INTO maintenance_requests (user_id, task, requested_at) VALUES (?, ?, ?)",
+            (user_id, task, time.time())
+        )
+    finally:
+        conn.close()
+
+def claim_maintenance():
+    """
+    最も古い依頼を1件取り出して (ユーザーID, 作業) を返す。依頼がなければ None を返す。
+    """
+    conn = _connect()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute(
+                "SELECT user_id, task FROM maintenance_requests ORDER BY requested_at LIMIT 1"
+            ).fetchone()
+            if row:
+                conn.execute(
+                    "DELETE FROM maintenance_requests WHERE user_id = ? AND task = ?", (row['user_id'], row['task'])
+                )
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        return (row['user_id'], row['task']) if row else None
+    finally:
+        conn.close()
+
+def new_worker_id():
+    return f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
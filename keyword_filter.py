@@ -0,0 +1,107 @@
+import os
+import re
+import json
+
+# キーワードによる履歴のフィルタリング
+# 含めたいキーワード・除外したいキーワードをそれぞれ1つの正規表現にまとめて起動時にコンパイルし、
+# タイトルとURLは1度だけ小文字化して使い回す。
+TECH_KEYWORDS = [
+    '技術', 'IT', 'プログラミング', 'エンジニア', '開発', 'API', 'AI', '人工知能', 'Python', 'JavaScript',
+    'プログラム', 'システム', 'ソフトウェア', 'ハードウェア', 'クラウド', 'サーバ', 'データ', 'ネットワーク', 'セキュリティ', 'Web技術',
+    'IT技術', 'Google', 'Chrome', 'Takeout', 'GitHub', 'コード', 'ML', '機械学習',
+    'Deep Learning', 'チュートリアル', '基礎', 'HTML', 'CSS', 'React', 'フロントエンド', 'バックエンド'
+]
+
+EXCLUDE_KEYWORDS = [
+    'ホーム', 'トップ', 'home', 'drive', 'mail', 'inbox', 'login', 'signin', 'sign in', '検索結果',
+    'Google cloud', 'Google 検索', 'google_vignette',
+    'twitter.com', 'x.com', 'facebook.com', 'youtube.com', 'youtu.be', 'instagram.com',
+    'amazon.co.jp', 'amazon.com', 'rakuten.co.jp', 'finance.yahoo.co.jp',
+    'ツイッター', 'フェイスブック', 'ユーチューブ', 'アマゾン', '楽天', 'ヤフーファイナンス'
+]
+
+# キーワードがまたがって一致しないよう、タイトルとURLの間に挟む文字
+_SEPARATOR = '\x00'
+
+def _normalize(keywords):
+    normalized = []
+    for keyword in keywords:
+        keyword = keyword.lower()
+        if keyword and keyword not in normalized:
+            normalized.append(keyword)
+    # 同じ位置から始まる場合は長いキーワードを優先する
+    return sorted(normalized, key=len, reverse=True)
+
+def _alternation(keywords):
+    return '|'.join(re.escape(keyword) for keyword in keywords)
+
+class KeywordMatcher:
+    """
+    含めるキーワード・除外キーワードをそれぞれまとめた正規表現で履歴エントリを判定する。
+    """
+    def __init__(self, include_keywords=TECH_KEYWORDS, exclude_keywords=EXCLUDE_KEYWORDS):
+        self.include_keywords = _normalize(include_keywords)
+        self.exclude_keywords = _normalize(exclude_keywords)
+        self.include_pattern = re.compile(_alternation(self.include_keywords)) if self.include_keywords else None
+        self.exclude_pattern = re.compile(_alternation(self.exclude_keywords)) if self.exclude_keywords else None
+
+    @classmethod
+    def from_config(cls, path=None):
+        """
+        JSONファイル（{"include": [...], "exclude": [...]}）からキーワードを読み込む。
+        ファイルがない場合や指定されていないキーの場合は既定のキーワードを使う。
+        """
+        path = path or os.environ.get('KEYWORD_FILTER_PATH')
+        if not path or not os.path.exists(path):
+            return cls()
+        with open(path, encoding='utf-8') as f:
+            config = json.load(f)
+        return cls(config.get('include', TECH_KEYWORDS), config.get('exclude', EXCLUDE_KEYWORDS))
+
+    @staticmethod
+    def _text(title, url):
+        return f'{title or ""}{_SEPARATOR}{url or ""}'.lower()
+
+    @staticmethod
+    def _is_google_service(url):
+        url = url or ""
+        return '.google.com' in url and not 'developers.google.com' in url and not 'cloud.google.com/blog' in url
+
+    def _has_tech_keyword(self, text):
+        return bool(self.include_pattern and self.include_pattern.search(text))
+
+    def _has_exclude_keyword(self, text):
+        return bool(self.exclude_pattern and self.exclude_pattern.search(text))
+
+    def is_tech(self, title, url):
+        return self._has_tech_keyword(self._text(title, url))
+
+    def keyword_strength(self, title, url):
+        """
+        タイトルとURLに含まれる技術系キーワードの種類の数を返す。
+        """
+        if not self.include_pattern:
+            return 0
+        return len(set(self.include_pattern.findall(self._text(title, url))))
+
+    def is_info(self, title, url):
+        return not self._has_exclude_keyword(self._text(title, url)) and not self._is_google_service(url)
+
+    def is_candidate(self, title, url):
+        """
+        is_tech と is_info の両方を満たすかどうかを判定する。
+        ほとんどのエントリは技術系キーワードを含まないため、除外キーワードはその後にだけ確認する。
+        """
+        text = self._text(title, url)
+        return self._has_tech_keyword(text) and not self._has_exclude_keyword(text) and not self._is_google_service(url)
+
+    def filter_entries(self, entries):
+        """
+        履歴エントリのリストから、http(s)のURLで技術系キーワードを含み、除外キーワードを含まないものだけを返す。
+        """
+        return [
+            entry for entry in entries
+            if (entry.get('url') or '').startswith('http') and self.is_candidate(entry.get('title'), entry.get('url'))
+        ]
+
+default_matcher = KeywordMatcher.from_config()
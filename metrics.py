@@ -0,0 +1,246 @@
+import os
+import json
+import sqlite3
+import threading
+import time
+import contextvars
+from contextlib import contextmanager
+
+# 履歴処理の計測
+# 段階ごとの処理時間（ヒストグラム）・URLごとの結果・Geminiのトークン数・キャッシュのヒット数などを記録する。
+# 値はプロセス内に溜めておき、METRICS_FLUSH_SECONDS ごとにSQLiteへ加算して全プロセスで共有し、
+# Webサーバーの /metrics からPrometheusのテキスト形式で返す。
+# 処理中のジョブがあれば（job_scope の中では）、同じ値をジョブごとの集計（JobMetrics）にも記録する。
+METRICS_PATH = os.environ.get('METRICS_PATH', 'metrics.sqlite3')
+METRICS_FLUSH_SECONDS = float(os.environ.get('METRICS_FLUSH_SECONDS', 10))
+HISTOGRAM_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# 名前: (種類, 説明)
+METRICS = {
+    'history_stage_seconds': ('histogram', 'Duration of each history processing stage.'),
+    'history_url_outcomes_total': ('counter', 'History entries by final outcome.'),
+    'history_jobs_total': ('counter', 'History jobs by result.'),
+    'gemini_calls_total': ('counter', 'Gemini API calls by result.'),
+    'gemini_tokens_total': ('counter', 'Gemini tokens by kind.'),
+    'gemini_queue_seconds': ('histogram', 'Time spent waiting for a Gemini rate limit slot.'),
+    'cache_requests_total': ('counter', 'Cache lookups by cache and result.'),
+}
+
+_current_job = contextvars.ContextVar('current_job_metrics', default=None)
+
+def _connect():
+    conn = sqlite3.connect(METRICS_PATH, timeout=30, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+def init_metrics():
+    conn = _connect()
+    try:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS metrics (
+                name TEXT NOT NULL,
+                labels TEXT NOT NULL,
+                value REAL NOT NULL,
+                PRIMARY KEY (name, labels)
+            )
+        """)
+    finally:
+        conn.close()
+
+def _label_key(labels):
+    return json.dumps(labels, sort_keys=True, ensure_ascii=False)
+
+class _Registry:
+    """
+    プロセス内の未送信の値（{(名前, ラベル): 値}）を保持する。
+    """
+    def __init__(self):
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+
+    def add(self, name, labels, value):
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._pending[key] = self._pending.get(key, 0) + value
+            due = time.monotonic() - self._last_flush >= METRICS_FLUSH_SECONDS
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+            self._last_flush = time.monotonic()
+        if not pending:
+            return
+        try:
+            conn = _connect()
+            try:
+                conn.executemany("""
+                    INSERT INTO metrics (name, labels, value) VALUES (?, ?, ?)
+                    ON CONFLICT(name, labels) DO UPDATE SET value = value + excluded.value
+                """, [(name, labels, value) for (name, labels), value in pending.items()])
+            finally:
+                conn.close()
+        except Exception as e:
+            print(f"計測値の保存中にエラー: {e}")
+
+_registry = _Registry()
+
+def inc(name, value=1, **labels):
+    _registry.add(name, labels, value)
+
+def observe(name, seconds, **labels):
+    for bound in HISTOGRAM_BUCKETS:
+        if seconds <= bound:
+            _registry.add(f'{name}_bucket', dict(labels, le=str(bound)), 1)
+    _registry.add(f'{name}_bucket', dict(labels, le='+Inf'), 1)
+    _registry.add(f'{name}_sum', labels, seconds)
+    _registry.add(f'{name}_count', labels, 1)
+
+def flush():
+    _registry.flush()
+
+class JobMetrics:
+    """
+    1件のジョブの集計。完了時に summary() をジョブのドキュメントに保存する。
+    """
+    def __init__(self):
+        self.started = time.monotonic()
+        self.stages = {}
+        self.outcomes = {}
+        self.cache = {}
+        self.llm = {'calls': 0, 'retries': 0, 'promptTokens': 0, 'outputTokens': 0, 'queueSeconds': 0.0}
+        self._lock = threading.Lock()
+
+    def add_stage(self, stage, seconds):
+        with self._lock:
+            current = self.stages.setdefault(stage, {'count': 0, 'seconds': 0.0, 'maxSeconds': 0.0})
+            current['count'] += 1
+            current['seconds'] += seconds
+            current['maxSeconds'] = max(current['maxSeconds'], seconds)
+
+    def add(self, group, key, value=1):
+        with self._lock:
+            target = getattr(self, group)
+            target[key] = target.get(key, 0) + value
+
+    def summary(self):
+        with self._lock:
+            return {
+                'totalSeconds': round(time.monotonic() - self.started, 3),
+                'stages': {
+                    stage: {k: round(v, 3) if isinstance(v, float) else v for k, v in values.items()}
+                    for stage, values in self.stages.items()
+                },
+                'outcomes': dict(self.outcomes),
+                'cache': dict(self.cache),
+                'llm': {k: round(v, 3) if isinstance(v, float) else v for k, v in self.llm.items()}
+            }
+
+@contextmanager
+def job_scope(job_metrics):
+    """
+    この中で記録した値を job_metrics にも集計する。
+    スレッドプールで実行する処理には contextvars.copy_context() で引き継ぐ。
+    """
+    token = _current_job.set(job_metrics)
+    try:
+        yield job_metrics
+    finally:
+        _current_job.reset(token)
+        flush()
+
+@contextmanager
+def stage(name):
+    """
+    処理段階の所要時間を計測する。
+    """
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        record_stage(name, time.monotonic() - started)
+
+def record_stage(name, seconds):
+    observe('history_stage_seconds', seconds, stage=name)
+    job_metrics = _current_job.get()
+    if job_metrics:
+        job_metrics.add_stage(name, seconds)
+
+def record_outcome(outcome, count=1):
+    if not count:
+        return
+    inc('history_url_outcomes_total', count, outcome=outcome)
+    job_metrics = _current_job.get()
+    if job_metrics:
+        job_metrics.add('outcomes', outcome, count)
+
+def record_cache(cache, result):
+    inc('cache_requests_total', cache=cache, result=result)
+    job_metrics = _current_job.get()
+    if job_metrics:
+        job_metrics.add('cache', f'{cache}.{result}')
+
+def record_llm_call(result, queue_seconds=0.0, prompt_tokens=0, output_tokens=0):
+    inc('gemini_calls_total', result=result)
+    observe('gemini_queue_seconds', queue_seconds)
+    if prompt_tokens:
+        inc('gemini_tokens_total', prompt_tokens, kind='prompt')
+    if output_tokens:
+        inc('gemini_tokens_total', output_tokens, kind='output')
+    job_metrics = _current_job.get()
+    if job_metrics:
+        job_metrics.add('llm', 'calls')
+        job_metrics.add('llm', 'queueSeconds', queue_seconds)
+        job_metrics.add('llm', 'promptTokens', prompt_tokens)
+        job_metrics.add('llm', 'outputTokens', output_tokens)
+        if result == 'retry':
+            job_metrics.add('llm', 'retries')
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    formatted = []
+    for key, value in sorted(labels.items(), key=lambda item: (item[0] == 'le', item[0])):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        formatted.append(f'{key}="{value}"')
+    return '{' + ','.join(formatted) + '}'
+
+def render_prometheus():
+    """
+    全プロセスの集計値をPrometheusのテキスト形式で返す。
+    """
+    flush()
+    conn = _connect()
+    try:
+        rows = conn.execute("SELECT name, labels, value FROM metrics").fetchall()
+    finally:
+        conn.close()
+
+    samples = {}
+    for name, labels, value in rows:
+        base = name
+        for suffix in ('_bucket', '_sum', '_count'):
+            if name.endswith(suffix) and name[:-len(suffix)] in METRICS:
+                base = name[:-len(suffix)]
+        samples.setdefault(base, []).append((name, json.loads(labels), value))
+
+    lines = []
+    for base in sorted(samples):
+        kind, help_text = METRICS.get(base, ('untyped', ''))
+        lines.append(f'# HELP {base} {help_text}')
+        lines.append(f'# TYPE {base} {kind}')
+
+        def sort_key(sample):
+            name, labels, _ = sample
+            le = labels.get('le')
+            bound = float('inf') if le == '+Inf' else float(le) if le else 0
+            return (_label_key({k: v for k, v in labels.items() if k != 'le'}), name, bound)
+
+        for name, labels, value in sorted(samples[base], key=sort_key):
+            formatted = int(value) if float(value).is_integer() else value
+            lines.append(f'{name}{_format_labels(labels)} {formatted}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,179 @@
+import re
+import math
+import zlib
+import threading
+
+import numpy as np
+
+# 記事のベクトル化と類似度によるおすすめ
+# 記事のタイトル・要約・タグから特徴（英数字の単語・日本語の2文字の組・タグ）を取り出し、
+# 特徴ハッシングで VECTOR_DIM 次元のベクトルにして記事ごとに保存しておく（外部サービスは使わない）。
+# ユーザーごとのベクトルはプロセス内の行列（VectorIndex）にまとめ、コサイン類似度で採点し、
+# 似た記事ばかりにならないよう MMR（Maximal Marginal Relevance）で並べ替える。
+VECTOR_DIM = 256
+# 特徴の取り出し方を変えた場合は上げる（古いベクトルは読み込み時に作り直す）
+VECTOR_VERSION = 1
+FIELD_WEIGHTS = {'generatedTitle': 2.0, 'summary': 1.0}
+TAG_WEIGHT = 3.0
+# MMRで並べ替える候補の数（表示件数に対する倍率）
+RERANK_POOL_FACTOR = 10
+
+WORD_PATTERN = re.compile(r'[a-z0-9][a-z0-9+#.\-]*')
+CJK_PATTERN = re.compile(r'[\u3040-\u30ff\u3400-\u9fff]+')
+
+def _features(text):
+    text = (text or '').lower()
+    features = WORD_PATTERN.findall(text)
+    for run in CJK_PATTERN.findall(text):
+        if len(run) == 1:
+            features.append(run)
+        features.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return features
+
+def article_vector(article_data):
+    """
+    記事のベクトル（L2正規化済み、float32）を返す。特徴がない場合はゼロベクトルになる。
+    """
+    weights = {}
+    for field, field_weight in FIELD_WEIGHTS.items():
+        counts = {}
+        for feature in _features(article_data.get(field)):
+            counts[feature] = counts.get(feature, 0) + 1
+        for feature, count in counts.items():
+            weights[feature] = weights.get(feature, 0.0) + field_weight * (1 + math.log(count))
+    for tag in article_data.get('tags') or []:
+        feature = f'tag:{str(tag).strip().lower()}'
+        weights[feature] = weights.get(feature, 0.0) + TAG_WEIGHT
+
+    vector = np.zeros(VECTOR_DIM, dtype=np.float32)
+    for feature, weight in weights.items():
+        hashed = zlib.crc32(feature.encode('utf-8'))
+        # 衝突した特徴が打ち消し合うよう、ハッシュの最上位ビットで符号を決める
+        vector[hashed % VECTOR_DIM] += weight if hashed & 0x80000000 else -weight
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+def encode_vector(vector):
+    return np.asarray(vector, dtype=np.float16).tobytes()
+
+def decode_vector(data):
+    if not data or len(data) != VECTOR_DIM * 2:
+        return None
+    return np.frombuffer(data, dtype=np.float16).astype(np.float32)
+
+class VectorIndex:
+    """
+    1人のユーザーの記事ベクトルをまとめた行列。
+    追加は末尾に（容量を倍々に広げて）、削除は末尾の行との入れ替えで行い、行列全体を作り直さない。
+    """
+    def __init__(self, dim=VECTOR_DIM):
+        self.dim = dim
+        self.ids = []
+        self.rows = {}
+        self._matrix = np.zeros((0, dim), dtype=np.float32)
+        self._normalized = None
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, article_id):
+        return article_id in self.rows
+
+    def add(self, article_id, vector):
+        with self.lock:
+            row = self.rows.get(article_id)
+            if row is None:
+                row = len(self.ids)
+                if row >= len(self._matrix):
+                    grown = np.zeros((max(64, len(self._matrix) * 2), self.dim), dtype=np.float32)
+                    grown[:row] = self._matrix[:row]
+                    self._matrix = grown
+                self.ids.append(article_id)
+                self.rows[article_id] = row
+            self._matrix[row] = vector
+            self._normalized = None
+
+    def remove(self, article_id):
+        with self.lock:
+            row = self.rows.pop(article_id, None)
+            if row is None:
+                return
+            last = len(self.ids) - 1
+            if row != last:
+                moved_id = self.ids[last]
+                self._matrix[row] = self._matrix[last]
+                self.ids[row] = moved_id
+                self.rows[moved_id] = row
+            self.ids.pop()
+            self._matrix[last] = 0
+            self._normalized = None
+
+    def vector(self, article_id):
+        with self.lock:
+            row = self.rows.get(article_id)
+            return None if row is None else self._matrix[row].copy()
+
+    def _normalized_matrix(self):
+        """
+        行ごとに正規化し直した行列を返す（float16で保存したときの誤差をならす。変更があるまで使い回す）。lock の中で呼ぶ。
+        ハッシュ後の次元はほとんどの記事で0にならないため、次元ごとのIDFでは重み付けしない。
+        """
+        if self._normalized is None:
+            matrix = self._matrix[:len(self.ids)]
+            norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+            norms[norms == 0] = 1
+            self._normalized = matrix / norms
+        return self._normalized
+
+    def rank(self, query_vectors, query_weights=None, candidate_ids=None, exclude_ids=(), limit=3, diversity=0.3):
+        """
+        クエリのベクトル（複数可）に似た記事のIDを、似ている順に最大 limit 件返す。
+        記事の点数は、クエリごとのコサイン類似度に query_weights を掛けた中で最大のもの。
+        diversity（0〜1）が大きいほど、すでに選んだ記事に似た記事の点数を下げる（0なら単に似ている順）。
+        """
+        if not len(query_vectors) or limit <= 0:
+            return []
+        with self.lock:
+            if not self.ids:
+                return []
+            normalized = self._normalized_matrix()
+            queries = np.asarray(query_vectors, dtype=np.float32).reshape(-1, self.dim).copy()
+            norms = np.linalg.norm(queries, axis=1, keepdims=True)
+            norms[norms == 0] = 1
+            queries /= norms
+            weights = np.ones(len(queries), dtype=np.float32) if query_weights is None else np.asarray(query_weights, dtype=np.float32)
+
+            if candidate_ids is None:
+                rows = np.arange(len(self.ids))
+            else:
+                rows = np.array([self.rows[article_id] for article_id in candidate_ids if article_id in self.rows], dtype=np.int64)
+            excluded = {self.rows[article_id] for article_id in exclude_ids if article_id in self.rows}
+            if excluded:
+                rows = rows[~np.isin(rows, list(excluded))]
+            if not len(rows):
+                return []
+
+            candidates = normalized[rows]
+            scores = ((candidates @ queries.T) * weights).max(axis=1)
+            if diversity <= 0:
+                order = np.argsort(-scores, kind='stable')[:limit]
+                return [self.ids[rows[i]] for i in order]
+            # 点数の高い候補だけを MMR で並べ替える
+            pool_size = min(len(rows), limit * RERANK_POOL_FACTOR)
+            pool = np.argpartition(-scores, pool_size - 1)[:pool_size] if pool_size < len(rows) else np.arange(len(rows))
+            pool = pool[np.argsort(-scores[pool])]
+            pool_vectors = candidates[pool]
+            pool_scores = scores[pool]
+
+            selected = []
+            max_similarity = np.zeros(len(pool), dtype=np.float32)
+            available = np.ones(len(pool), dtype=bool)
+            for _ in range(min(limit, len(pool))):
+                mmr = (1 - diversity) * pool_scores - diversity * max_similarity
+                mmr[~available] = -np.inf
+                best = int(np.argmax(mmr))
+                selected.append(best)
+                available[best] = False
+                max_similarity = np.maximum(max_similarity, pool_vectors @ pool_vectors[best])
+            return [self.ids[rows[pool[i]]] for i in selected]
@@ -0,0 +1,96 @@
+import os
+import sys
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+os.environ.setdefault('WARM_UP_ON_START', '0')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+import gemini_client  # noqa: E402
+import candidate_scheduler  # noqa: E402
+
+CONTENT = 'テスト用の本文です。' * 20
+
+def _entry(index):
+    return {'url': f'https://pipeline{index}.example.com/article', 'title': f'記事{index}'}
+
+def _article(item):
+    return {'originalUrl': item['url'], 'generatedTitle': item['title']}
+
+@pytest.fixture
+def pipeline(monkeypatch):
+    """
+    キャッシュ・取得・解析を差し替えて、どのエントリも取得と要約が必要な状態にする。
+    """
+    monkeypatch.setattr(app, 'LLM_BATCH_WAIT_SECONDS', 0.01)
+    monkeypatch.setattr(app, 'check_entry', lambda entry: {'url': entry['url'], 'canonical_url': entry['url'], 'title': entry['title']})
+    monkeypatch.setattr(app, 'lookup_fetch', lambda url: (True, {'text': CONTENT}))
+    monkeypatch.setattr(app, 'parse_fetched_page', lambda url, fetched: {'text': fetched['text'], 'ogp': {}})
+    monkeypatch.setattr(app, 'summarize_batch', lambda batch: [_article(item) for item in batch])
+    return monkeypatch
+
+def _run(entries, budget=None):
+    done = {}
+    def on_entry_done(position, article):
+        done[position] = article
+    try:
+        articles = asyncio.run(app.run_history_pipeline(entries, on_entry_done=on_entry_done, budget=budget))
+    except gemini_client.GeminiUnavailableError:
+        return None, done
+    return articles, done
+
+def test_summarizes_every_entry(pipeline):
+    entries = [_entry(i) for i in range(3)]
+    articles, done = _run(entries)
+    assert len(articles) == 3
+    assert set(done) == {0, 1, 2}
+    assert all(done[position]['originalUrl'] == entries[position]['url'] for position in done)
+
+def test_unexpected_summarize_error_is_retried(pipeline):
+    def summarize_batch(batch):
+        raise RuntimeError('boom')
+    pipeline.setattr(app, 'summarize_batch', summarize_batch)
+    articles, done = _run([_entry(i) for i in range(3)])
+    # 予期しないエラーで要約できなかったエントリは完了扱いにせず、ジョブの再試行に回す
+    assert articles is None
+    assert done == {}
+
+def test_gemini_unavailable_is_retried(pipeline):
+    def summarize_batch(batch):
+        raise gemini_client.GeminiUnavailableError('rate limited')
+    pipeline.setattr(app, 'summarize_batch', summarize_batch)
+    articles, done = _run([_entry(i) for i in range(2)])
+    assert articles is None
+    assert done == {}
+
+def test_unexpected_fetch_error_defers_only_that_entry(pipeline):
+    entries = [_entry(i) for i in range(3)]
+    def lookup_fetch(url):
+        if url == entries[1]['url']:
+            raise RuntimeError('boom')
+        return True, {'text': CONTENT}
+    pipeline.setattr(app, 'lookup_fetch', lookup_fetch)
+    articles, done = _run(entries)
+    # 他のエントリは処理し終えてから再試行を求める
+    assert articles is None
+    assert set(done) == {0, 2}
+
+def test_exhausted_budget_defers_entries_that_need_work(pipeline):
+    cached = {'originalUrl': 'https://cached.example.com/', 'generatedTitle': 'キャッシュ'}
+    def check_entry(entry):
+        if entry['url'] == cached['originalUrl']:
+            return {'article': cached}
+        return {'url': entry['url'], 'canonical_url': entry['url'], 'title': entry['title']}
+    pipeline.setattr(app, 'check_entry', check_entry)
+    pipeline.setattr(app, 'summarize_batch', lambda batch: pytest.fail('予算を使い切った後に要約を呼び出した'))
+    budget = candidate_scheduler.JobBudget(SimpleNamespace(llm={'calls': 1, 'retries': 0}), time_seconds=0, llm_calls=1)
+
+    entries = [_entry(0), {'url': cached['originalUrl'], 'title': 'キャッシュ'}, _entry(2)]
+    articles, done = _run(entries, budget=budget)
+    # キャッシュだけで済むエントリは処理し、残りは次のジョブに回す（失敗扱いにはしない）
+    assert articles == [cached]
+    assert done == {1: cached}
+    assert sorted(budget.deferred) == [0, 2]
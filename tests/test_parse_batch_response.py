@@ -0,0 +1,31 @@
+import os
+import sys
+import json
+
+import pytest
+
+os.environ.setdefault('WARM_UP_ON_START', '0')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+def _item(item_id, verdict='technical'):
+    return {'id': item_id, 'verdict': verdict, 'title': 'T', 'source': 'S', 'summary': 'sum', 'tags': ['Python', 'API']}
+
+def test_accepts_integer_ids():
+    parsed = app.parse_batch_response(json.dumps([_item(0), _item(1, 'none')]), {0, 1})
+    assert set(parsed) == {0, 1}
+    assert parsed[1]['verdict'] == 'none'
+
+def test_accepts_string_ids():
+    parsed = app.parse_batch_response(json.dumps([_item('0'), _item(' 2 ')]), {0, 1, 2})
+    assert set(parsed) == {0, 2}
+    assert parsed[0]['generatedTitle'] == 'T'
+
+def test_ignores_unknown_and_invalid_ids():
+    parsed = app.parse_batch_response(json.dumps([_item('7'), _item('x'), _item(None), _item(1)]), {0, 1})
+    assert set(parsed) == {1}
+
+def test_raises_when_no_item_matches():
+    with pytest.raises(ValueError):
+        app.parse_batch_response(json.dumps([_item('9')]), {0, 1})
@@ -0,0 +1,117 @@
+import os
+import time
+import threading
+import multiprocessing
+
+import job_queue
+
+# 履歴処理ジョブのワーカー
+# Webサーバー（gunicorn）とは別に `python worker.py` で起動する。
+# WORKER_PROCESSES 個のプロセスがそれぞれキューからジョブを1件ずつ取り出して処理する。
+# 取り出せるジョブがないときは、ユーザーごとの作り直し（ファセット・検索インデックス）の依頼を処理する。
+WORKER_PROCESSES = int(os.environ.get('WORKER_PROCESSES', 2))
+WORKER_POLL_SECONDS = float(os.environ.get('WORKER_POLL_SECONDS', 2))
+# Geminiのレート制限で中断したジョブを再開するまでの待ち時間
+JOB_LLM_RETRY_DELAY_SECONDS = float(os.environ.get('JOB_LLM_RETRY_DELAY_SECONDS', 120))
+
+def _keep_lease(job_id, worker_id, stop_event):
+    while not stop_event.wait(job_queue.JOB_LEASE_SECONDS / 3):
+        try:
+            job_queue.extend_lease(job_id, worker_id)
+        except Exception as e:
+            print(f"リースの延長中にエラー (Job: {job_id}): {e}")
+
+def run_job(app_module, job, worker_id):
+    job_id = job['job_id']
+    user_id = job['user_id']
+    job_ref = app_module.get_db().collection('users').document(user_id).collection('jobs').document(job_id)
+
+    # 途中でプロセスごと落ち続けるジョブは、リース切れで再取得された時点で打ち切る
+    if job['attempts'] > job_queue.JOB_MAX_ATTEMPTS:
+        job_queue.finish_job(job_id, status='failed')
+        mark_job_error(app_module, job_ref, job_id)
+        return
+
+    stop_event = threading.Event()
+    lease_thread = threading.Thread(target=_keep_lease, args=(job_id, worker_id, stop_event), daemon=True)
+    lease_thread.start()
+    try:
+        job_ref.update({'status': 'processing', 'attempts': job['attempts']})
+        app_module.process_and_summarize_history(
+            job['history_data'], user_id, job_id,
+            final_attempt=job['attempts'] >= job_queue.JOB_MAX_ATTEMPTS
+        )
+        job_queue.finish_job(job_id)
+        maintain_user_indexes(app_module, user_id)
+    except Exception as e:
+        print(f"❌ ジョブの処理中にエラー (Job: {job_id}): {e}")
+        retry_delay = JOB_LLM_RETRY_DELAY_SECONDS if isinstance(e, app_module.gemini_client.GeminiUnavailableError) else 0
+        if not job_queue.release_job(job_id, retry_delay):
+            mark_job_error(app_module, job_ref, job_id)
+    finally:
+        stop_event.set()
+
+def maintain_user_indexes(app_module, user_id):
+    # 全記事の読み書きが必要な検索インデックスの作り直しは、ジョブの後にワーカーが空いているときに行う
+    try:
+        job_queue.request_maintenance(user_id, 'search_index')
+    except Exception as e:
+        print(f"❌ 作り直しの依頼中にエラー (User: {user_id}): {e}")
+
+# ワーカーが空いているときに行う作り直しの作業
+MAINTENANCE_TASKS = {
+    'facets': lambda app_module, user_id: app_module.reconcile_facets(user_id),
+    'search_index': lambda app_module, user_id: app_module.ensure_search_index(user_id),
+}
+
+def run_maintenance(app_module, user_id, task):
+    handler = MAINTENANCE_TASKS.get(task)
+    if handler is None:
+        print(f"⚠️ 不明な作業のためスキップします (User: {user_id}, 作業: {task})")
+        return
+    try:
+        handler(app_module, user_id)
+    except Exception as e:
+        print(f"❌ 作り直しの作業中にエラー (User: {user_id}, 作業: {task}): {e}")
+
+def mark_job_error(app_module, job_ref, job_id):
+    print(f"❌ 再試行の上限に達したためジョブを中止します (Job: {job_id})")
+    try:
+        job_ref.update({'status': 'error', 'completedAt': app_module.firestore.SERVER_TIMESTAMP})
+    except Exception as e:
+        print(f"❌ ジョブの更新中にエラー: {e}")
+
+def worker_loop():
+    # Firebase・Geminiの初期化はプロセスごとに行う
+    import app as app_module
+    app_module.init_local_stores()
+
+    worker_id = job_queue.new_worker_id()
+    print(f"✅ ワーカーを起動しました (Worker: {worker_id})")
+    while True:
+        try:
+            job = job_queue.claim_job(worker_id)
+        except Exception as e:
+            print(f"❌ ジョブの取得中にエラー: {e}")
+            job = None
+        if not job:
+            try:
+                maintenance = job_queue.claim_maintenance()
+            except Exception as e:
+                print(f"❌ 作り直しの依頼の取得中にエラー: {e}")
+                maintenance = None
+            if maintenance:
+                run_maintenance(app_module, *maintenance)
+            else:
+                time.sleep(WORKER_POLL_SECONDS)
+            continue
+        print(f"➡️  ジョブを開始します (Job: {job['job_id']}, 試行: {job['attempts']}回目)")
+        run_job(app_module, job, worker_id)
+
+if __name__ == '__main__':
+    job_queue.init_queue()
+    processes = [multiprocessing.Process(target=worker_loop) for _ in range(WORKER_PROCESSES)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()